@@ -1,11 +1,21 @@
-from flask import Flask, request, redirect, url_for, render_template, send_from_directory, session, request, jsonify
-from flask_session import Session
+from flask import Flask, request, redirect, url_for, render_template, send_from_directory, send_file, session, request, jsonify, Response, g
+from flask.sessions import SecureCookieSession, SecureCookieSessionInterface
+from flask.logging import default_handler
 from werkzeug.security import generate_password_hash, check_password_hash
-from werkzeug.utils import secure_filename
-import geoip2.database
-import shutil, requests, os, re, json, random, string
-from datetime import datetime
-from PIL import Image
+import geoip2.database, geoip2.errors
+import click
+import shutil, requests, os, re, json, random, string, sqlite3, threading, bisect, base64, math, html, queue, time, hashlib, ipaddress, atexit, signal, socket, functools, io, subprocess, gzip, sys, cProfile, secrets, zlib, contextlib, tempfile, copy, logging
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from collections.abc import MutableMapping
+from datetime import datetime, timedelta, timezone
+from PIL import Image, ImageOps
+import numpy as np
+try:
+    import fcntl
+except ImportError:
+    # Windows: без gunicorn процесс один, блокировка между процессами не нужна
+    fcntl = None
 
 # ======================
 # Конфигурация и константы
@@ -14,9 +24,50 @@ app = Flask(__name__)
 app.config['UPLOAD_FOLDER'] = 'static/users'
 app.config['UPLOAD_FOLDER_IMG'] = 'static/imgs'
 app.config['MAX_CONTENT_LENGTH'] = 8192 * 1024 * 1024 # 8GB максимум для загрузки видео
-app.config['SESSION_TYPE'] = 'filesystem'
 app.config['SECRET_KEY'] = 'your-secret-key' # заменить на всё что угодно
-Session(app)
+app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(days=31) # сколько живёт сессия вошедшего пользователя без запросов
+app.config['SESSION_SWEEP_INTERVAL'] = 3600 # как часто удалять просроченные сессии из хранилища, секунд
+app.config['PASSWORD_HASH_WORKERS'] = 2 # одновременно вычисляемых хэшей паролей (scrypt нагружает процессор)
+app.config['PASSWORD_HASH_QUEUE'] = 32 # хэшей в работе и в очереди, сверх этого вход и регистрация отвечают 503
+app.config['LOGIN_RATE_LIMIT'] = 10 # попыток входа с одного IP и неудачных на один email подряд
+app.config['LOGIN_RATE_PERIOD'] = 300 # за столько секунд попытки восстанавливаются полностью
+app.config['STORAGE_BACKEND'] = 'sqlite' # 'sqlite', 'journal' (снимок и журнал, один процесс) или 'json' (старый формат, для совместимости)
+app.config['JOURNAL_COMPACT_BYTES'] = 16 * 1024 * 1024 # хранилище 'journal': журнал такого размера сжимается в новый снимок
+app.config['VIDEO_OFFLOAD'] = None # None, 'x-accel-redirect' (nginx) или 'x-sendfile' (apache, lighttpd)
+app.config['VIDEO_OFFLOAD_PREFIX'] = '/protected/users/' # internal location прокси для X-Accel-Redirect
+app.config['VIDEO_MAX_AGE'] = 86400 # кэширование видео клиентом, секунд
+app.config['JOB_WORKERS'] = 2 # потоков обработки загруженных видео
+app.config['JOB_MAX_ATTEMPTS'] = 3 # попыток выполнить задачу до статуса failed
+app.config['JOB_RETRY_DELAY'] = 5 # пауза перед повтором, секунд (растёт с каждой попыткой)
+app.config['JOB_RETENTION'] = 7 * 24 * 3600 # сколько хранить выполненные и упавшие задачи, секунд
+app.config['SYNC_INTERVAL'] = 1 # как часто подтягивать изменения других процессов в фоне, секунд
+app.config['CHANGES_RETENTION'] = 3600 # сколько хранить журнал изменений для других процессов, секунд
+app.config['WRITE_BEHIND_INTERVAL'] = 2 # как часто сбрасывать отложенные записи (голоса, подписки), секунд
+app.config['WRITE_BEHIND_MAX_PENDING'] = 500 # сбросить раньше, если накопилось столько записей
+app.config['UPLOAD_EXPIRY'] = 24 * 3600 # незавершённая загрузка удаляется после стольких секунд без новых частей
+app.config['PAGE_CACHE_MAX_BYTES'] = 64 * 1024 * 1024 # память под кэш готовых страниц, 0 - отключить
+app.config['PAGE_CACHE_TTL'] = 60 # страница живёт в кэше не дольше, секунд (в ней "5 минут назад")
+app.config['VIEW_DEDUPE_WINDOW'] = 30 * 60 # повторный просмотр тем же зрителем не считается столько секунд
+app.config['VIEW_FLUSH_INTERVAL'] = 10 # как часто сбрасывать накопленные просмотры в хранилище, секунд
+app.config['VIEW_HOURLY_RETENTION'] = 48 # сколько часов хранить почасовую статистику просмотров
+app.config['VIEW_DAILY_RETENTION'] = 90 # сколько дней хранить посуточную статистику просмотров
+app.config['IMAGE_MAX_AGE'] = 365 * 24 * 3600 # кэширование картинок с хэшем в имени клиентом и CDN, секунд
+app.config['VIDEO_TRANSCODE'] = True # нарезать загруженные видео в HLS (нужен ffmpeg), иначе отдаётся только mp4
+app.config['FFMPEG_BINARY'] = 'ffmpeg'
+app.config['FFPROBE_BINARY'] = 'ffprobe'
+app.config['TRANSCODE_TIMEOUT'] = 6 * 3600 # предел на один запуск ffmpeg, секунд
+app.config['HLS_SEGMENT_DURATION'] = 6 # длина сегмента HLS, секунд
+app.config['HLS_JS_URL'] = None # адрес hls.js для браузеров без встроенного HLS; None - свой static/js/hls.min.js (без него играет mp4)
+app.config['SITE_URL'] = 'http://localhost:5000' # адрес сайта для sitemap.xml и robots.txt, без / в конце
+app.config['SITEMAP_REBUILD_DELAY'] = 30 # изменения копятся столько секунд перед пересборкой sitemap
+app.config['RELATED_UPDATE_DELAY'] = 10 # новые видео и голоса копятся столько секунд перед пересчётом похожих
+app.config['RELATED_REBUILD_INTERVAL'] = 6 * 3600 # полная пересборка похожих видео, секунд
+app.config['LOG_LEVEL'] = 'INFO' # уровень журнала app.logger: 'DEBUG', 'INFO', 'WARNING', 'ERROR'
+app.config['METRICS_ALLOWED_IPS'] = ['127.0.0.1', '::1'] # кому доступен /metrics (Prometheus), None - всем
+app.config['PROFILE_SAMPLE_RATE'] = 0.0 # доля запросов под cProfile (0.01 - каждый сотый), 0 - отключено
+app.config['PROFILE_HEADER'] = None # например 'X-Profile': запрос с этим заголовком профилируется, None - отключено
+app.config['PROFILE_FOLDER'] = 'profiles' # куда сохранять .prof файлы (snakeviz, flameprof)
+app.logger.setLevel(app.config['LOG_LEVEL'])
 
 # Пути к файлам данных
 VIDEO_DATA_FILE = 'video_data.json'
@@ -25,35 +76,1447 @@ COMMENTS_DATA_FILE = 'comments.json'
 LIKES_DISLIKES_FILE = 'likes_dislakes.json'
 COMMENT_LIKES_DISLIKES_FILE = 'comment_likes_dislakes.json'
 CHANNEL_DATA_FILE = 'channels.json'
+JOBS_DATA_FILE = 'jobs.json'
+UPLOADS_DATA_FILE = 'uploads.json'
+SEQUENCES_DATA_FILE = 'sequences.json'
+VIEWS_DATA_FILE = 'views.json'
+INBOXES_DATA_FILE = 'inboxes.json'
+RELATED_FILE = 'related.npy' # похожие видео: матрица (видео x RELATED_COUNT), читается через mmap
+RELATED_IDS_FILE = 'related_ids.json' # id видео по строкам RELATED_FILE
+DATABASE_FILE = 'freshtube.db'
+JOURNAL_FOLDER = 'data' # снимки и журналы хранилища 'journal'
+SITEMAP_FOLDER = 'sitemaps'
 geoip2_db_path = 'static/ui/GeoLite2-Country.mmdb'
 
-# Блокировки
-blocked_ips = ['']
-blocked_countries = ['']
-blocked_accs = ['']
+# Блокировки (дополняются файлом BLOCKLIST_FILE, который перечитывается без перезапуска)
+BLOCKLIST_FILE = 'blocklist.json' # {"ips": ["1.2.3.4", "10.0.0.0/8"], "countries": ["XX"], "accounts": ["42"]}
+BLOCKLIST_CHECK_INTERVAL = 5 # как часто проверять изменение файла, секунд
+IP_DECISION_CACHE_SIZE = 100_000
+IP_DECISION_TTL = 600 # секунд
+blocked_ips = set() # адреса и подсети в нотации CIDR
+blocked_countries = set()
+blocked_accs = set()
 
 # ======================
-# Вспомогательные функции
+# Журнал
 # ======================
-def load_data(file):
-    """Загрузка данных из JSON файла"""
-    if os.path.exists(file):
+class ExtraFieldsFormatter(logging.Formatter):
+    """Формат Flask по умолчанию и поля из extra= в виде key=value после сообщения (до traceback)"""
+
+    standard = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime'}
+
+    def formatMessage(self, record):
+        message = super().formatMessage(record)
+        fields = [(key, value) for key, value in vars(record).items() if key not in self.standard]
+        if not fields:
+            return message
+        format_value = lambda value: value if isinstance(value, (int, float)) else json.dumps(str(value), ensure_ascii=False)
+        return message + ' ' + ' '.join(f"{key}={format_value(value)}" for key, value in fields)
+
+default_handler.setFormatter(ExtraFieldsFormatter('[%(asctime)s] %(levelname)s in %(module)s: %(message)s'))
+
+# ======================
+# Метрики и профилирование
+# ======================
+# Границы корзин гистограмм длительности, секунд
+METRIC_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+def metric_labels(labels, extra=()):
+    """Метки в формате Prometheus: {name="value",...}"""
+    pairs = [*labels, *extra]
+    if not pairs:
+        return ''
+    escape = lambda value: str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in pairs) + '}'
+
+class Counter:
+    """Счётчик Prometheus с метками; значения живут в памяти процесса"""
+
+    kind = 'counter'
+
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            return [f"{self.name}{metric_labels(key)} {value}" for key, value in sorted(self.values.items())]
+
+class Histogram:
+    """Гистограмма Prometheus с метками (корзины METRIC_BUCKETS, сумма и количество)"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, buckets=METRIC_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = buckets
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            entry = self.values.get(key)
+            if entry is None:
+                entry = self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+            i = bisect.bisect_left(self.buckets, value)
+            if i < len(self.buckets):
+                entry[0][i] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def time(self, **labels):
+        """Контекстный менеджер: длительность блока попадает в гистограмму"""
+        return MetricTimer(self, labels)
+
+    def samples(self):
+        lines = []
+        with self.lock:
+            for key, (counts, total, count) in sorted(self.values.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    lines.append(f"{self.name}_bucket{metric_labels(key, [('le', bound)])} {cumulative}")
+                lines.append(f"{self.name}_bucket{metric_labels(key, [('le', '+Inf')])} {count}")
+                lines.append(f"{self.name}_sum{metric_labels(key)} {total}")
+                lines.append(f"{self.name}_count{metric_labels(key)} {count}")
+        return lines
+
+class MetricTimer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+        return False
+
+class Metrics:
+    """Реестр метрик процесса и их выдача в текстовом формате Prometheus 0.0.4
+
+    При нескольких процессах (gunicorn -w) каждый отдаёт свои значения,
+    Prometheus различает их по метке instance или по адресу процесса.
+    """
+
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, documentation):
+        metric = Counter(name, documentation)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, documentation, buckets=METRIC_BUCKETS):
+        metric = Histogram(name, documentation, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+REQUEST_SECONDS = metrics.histogram('freshtube_request_duration_seconds', 'Request latency by endpoint, method and status')
+STORAGE_SECONDS = metrics.histogram('freshtube_storage_operation_seconds', 'Storage operation latency; _count is the number of reads/writes')
+STORAGE_WRITTEN_BYTES = metrics.counter('freshtube_storage_written_bytes_total', 'Serialized bytes written to storage')
+STORAGE_ERRORS = metrics.counter('freshtube_storage_errors_total', 'Failed storage operations')
+CACHE_REQUESTS = metrics.counter('freshtube_cache_requests_total', 'Cache lookups by cache and result (hit/miss)')
+GEOIP_SECONDS = metrics.histogram('freshtube_geoip_lookup_seconds', 'GeoIP country lookup latency')
+IMAGE_SECONDS = metrics.histogram('freshtube_image_processing_seconds', 'Pillow derivative generation latency by image kind')
+PASSWORD_HASH_SECONDS = metrics.histogram('freshtube_password_hash_seconds', 'Password hashing/verification time including queue wait')
+LOGIN_REJECTED = metrics.counter('freshtube_login_rejected_total', 'Login/registration attempts refused by the rate limiter or a full hashing queue')
+JOB_SECONDS = metrics.histogram('freshtube_job_duration_seconds', 'Background job run time by type and outcome',
+                                buckets=(0.01, 0.1, 0.5, 1.0, 5.0, 15.0, 60.0, 300.0, 900.0, 3600.0))
+
+def storage_metric(op, false_is_error=True):
+    """Замер операции хранилища: длительность по бэкенду, операции и коллекции, ошибки"""
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, file, *args, **kwargs):
+            labels = {'backend': self.backend, 'op': op, 'collection': os.path.basename(file)}
+            start = time.perf_counter()
+            try:
+                result = method(self, file, *args, **kwargs)
+            except Exception:
+                STORAGE_ERRORS.inc(**labels)
+                raise
+            finally:
+                STORAGE_SECONDS.observe(time.perf_counter() - start, **labels)
+            if result is False and false_is_error:
+                STORAGE_ERRORS.inc(**labels)
+            return result
+        return wrapper
+    return decorator
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+    header = app.config['PROFILE_HEADER']
+    rate = app.config['PROFILE_SAMPLE_RATE']
+    if (header and request.headers.get(header)) or (rate and random.random() < rate):
+        g.profiler = cProfile.Profile()
+        g.profiler.enable()
+
+@app.after_request
+def record_request_metrics(response):
+    # Зарегистрирован первым, поэтому выполняется после остальных after_request
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        profiler.disable()
+        os.makedirs(app.config['PROFILE_FOLDER'], exist_ok=True)
+        name = f"{datetime.now().strftime('%Y%m%d-%H%M%S-%f')}_{request.endpoint or 'unknown'}.prof"
+        profiler.dump_stats(os.path.join(app.config['PROFILE_FOLDER'], name))
+        response.headers['X-Profile-File'] = name
+        app.logger.info("Profiled %s %s to %s", request.method, request.path, name,
+                        extra={'method': request.method, 'path': request.path, 'profile': name})
+    if 'request_start' in g:
+        REQUEST_SECONDS.observe(time.perf_counter() - g.request_start, endpoint=request.endpoint or 'unknown',
+                                method=request.method, status=response.status_code)
+    return response
+
+# ======================
+# Хранилище данных
+# ======================
+# Ключевое поле каждой коллекции (по нему SQLite обновляет отдельные строки)
+COLLECTION_KEYS = {
+    VIDEO_DATA_FILE: 'id',
+    USER_DATA_FILE: 'id',
+    COMMENTS_DATA_FILE: 'id',
+    LIKES_DISLIKES_FILE: 'video_id',
+    COMMENT_LIKES_DISLIKES_FILE: 'comment_id',
+    CHANNEL_DATA_FILE: 'id',
+    JOBS_DATA_FILE: 'id',
+    UPLOADS_DATA_FILE: 'id',
+}
+
+def process_id():
+    """Идентификатор текущего процесса (хост:pid), вычисляется заново после fork"""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+def process_alive(owner):
+    """Жив ли процесс owner (на других хостах считается живым)"""
+    host, _, pid = owner.rpartition(':')
+    if host != socket.gethostname():
+        return True
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except (PermissionError, ValueError, OSError):
+        return True
+    return True
+
+def json_default(value):
+    """Сериализация множеств (голоса, подписчики) в JSON как отсортированных списков"""
+    if isinstance(value, (set, frozenset)):
+        return sorted(value)
+    if isinstance(value, Record):
+        return value.to_dict()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+def apply_deltas(record, deltas):
+    """Изменения полей записи: {элемент: добавлен ли} - для множеств, [записи] - дописываются в список (по id)"""
+    for field, change in deltas.items():
+        if isinstance(change, list):
+            items = list(record.get(field) or [])
+            known = {item['id'] for item in items}
+            items.extend(item for item in change if item['id'] not in known)
+            items.sort(key=lambda item: item['id'])
+            record[field] = items
+        else:
+            values = set(record.get(field) or ())
+            for member, added in change.items():
+                if added:
+                    values.add(member)
+                else:
+                    values.discard(member)
+            record[field] = values
+
+def fsync_directory(file):
+    """fsync каталога, чтобы переименование файла пережило сбой питания"""
+    if hasattr(os, 'O_DIRECTORY'):
+        fd = os.open(os.path.dirname(os.path.abspath(file)), os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+@contextlib.contextmanager
+def atomic_write(path):
+    """Уникальный временный файл рядом с path; после успешной записи он атомарно заменяет path"""
+    fd, tmp_path = tempfile.mkstemp(prefix=f"{os.path.basename(path)}.", suffix='.tmp', dir=os.path.dirname(path) or '.')
+    os.close(fd)
+    try:
+        yield tmp_path
+        os.replace(tmp_path, path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(tmp_path)
+        raise
+
+@contextlib.contextmanager
+def process_lock(path, blocking=True):
+    """Блокировка между процессами (flock на файле path); без blocking отдаёт False, если её держит другой процесс"""
+    if fcntl is None:
+        yield True
+        return
+    with open(path, 'a') as f:
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+class StorageError(Exception):
+    """Данные хранилища повреждены или не читаются: запуск останавливается, а не продолжается с пустыми коллекциями"""
+
+class JsonStorage:
+    """Хранение коллекций целиком в JSON файлах (старый формат, только один процесс)"""
+
+    shared = False
+    backend = 'json'
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Блокировки файлов: один файл одновременно пишет один поток
+        self.file_locks = {}
+        self.file_locks_guard = threading.Lock()
+        # Сессии только в памяти: процесс один, после перезапуска нужно войти заново
+        self.sessions = {}
+
+    @storage_metric('load')
+    def load(self, file):
+        if not os.path.exists(file):
+            return []
+        # Пустой список вместо испорченного файла при следующем сохранении затёр бы данные
         try:
             with open(file, 'r') as f:
                 return json.load(f)
-        except json.JSONDecodeError as e:
-            print(f"Error decoding JSON from {file}: {e}")
+        except (json.JSONDecodeError, UnicodeDecodeError) as e:
+            raise StorageError(f"{file} is corrupted: {e}") from e
+        except OSError as e:
+            raise StorageError(f"Cannot read {file}: {e}") from e
+
+    def file_lock(self, file):
+        with self.file_locks_guard:
+            return self.file_locks.setdefault(file, threading.Lock())
+
+    @storage_metric('save')
+    def save(self, file, data):
+        """Атомарная запись: уникальный временный файл, fsync, переименование поверх старого"""
+        try:
+            with self.file_lock(file), atomic_write(file) as tmp_file:
+                with open(tmp_file, 'w') as f:
+                    json.dump(data, f, indent=4, default=json_default)
+                    f.flush()
+                    os.fsync(f.fileno())
+                    STORAGE_WRITTEN_BYTES.inc(f.tell(), backend=self.backend, collection=os.path.basename(file))
+            fsync_directory(file)
+            return True
         except Exception as e:
-            print(f"Error reading {file}: {e}")
-    return []
+            app.logger.error("Error saving to %s: %s", file, e, extra={'backend': self.backend, 'collection': os.path.basename(file)})
+            return False
 
-def save_data(file, data):
-    """Сохранение данных в JSON файл"""
+    def upsert(self, file, data, record):
+        # В JSON нельзя обновить одну запись - файл переписывается целиком
+        return self.save(file, data)
+
+    def upsert_many(self, file, data, records):
+        return self.save(file, data)
+
+    def compare_and_set(self, file, data, expected, record):
+        # Процесс один, сравнивать не с кем
+        return self.save(file, data)
+
+    def merge_fields(self, file, data, changes):
+        # Процесс один: в памяти уже итоговые значения
+        return self.upsert_many(file, data, [record for record, _ in changes])
+
+    def delete(self, file, data, record):
+        return self.save(file, data)
+
+    def next_id(self, name, floor=0):
+        """Следующий id последовательности name (не меньше floor + 1), хранится в sequences.json"""
+        with self.lock:
+            sequences = self.load(SEQUENCES_DATA_FILE) or {}
+            value = max(sequences.get(name, 0), floor) + 1
+            sequences[name] = value
+            if not self.save(SEQUENCES_DATA_FILE, sequences):
+                raise OSError(f"Cannot save {SEQUENCES_DATA_FILE}")
+            return value
+
+    def add_views(self, deltas):
+        """Прибавление просмотров: deltas - {(scope, id, bucket): число}"""
+        with self.lock:
+            rows = {(row[0], row[1], row[2]): row for row in self.load(VIEWS_DATA_FILE)}
+            now = time.time()
+            for key, count in deltas.items():
+                views = rows[key][3] if key in rows else 0
+                rows[key] = [*key, views + count, now]
+            return self.save(VIEWS_DATA_FILE, list(rows.values()))
+
+    def load_views(self, since=0):
+        """Счётчики просмотров, изменённые после since: [(scope, id, bucket, views)]"""
+        with self.lock:
+            return [tuple(row[:4]) for row in self.load(VIEWS_DATA_FILE) if row[4] > since]
+
+    def prune_views(self, prefix, before):
+        """Удаление счётчиков корзин prefix (h: или d:) старше before"""
+        with self.lock:
+            rows = self.load(VIEWS_DATA_FILE)
+            kept = [row for row in rows if not (row[2].startswith(prefix) and row[2] < before)]
+            if len(kept) != len(rows):
+                self.save(VIEWS_DATA_FILE, kept)
+
+    def add_to_inboxes(self, rows, limit):
+        """Добавление видео во входящие: rows - [(user_id, upload_date, video_id, channel_id)], у каждого не больше limit"""
+        with self.lock:
+            inboxes = self.load(INBOXES_DATA_FILE) or {}
+            changed = set()
+            for user_id, upload_date, video_id, channel_id in rows:
+                inbox = inboxes.setdefault(str(user_id), [])
+                if not any(entry[1] == video_id for entry in inbox):
+                    inbox.append([upload_date, video_id, channel_id])
+                    changed.add(str(user_id))
+            for user_id in changed:
+                inboxes[user_id] = sorted(inboxes[user_id], reverse=True)[:limit]
+            return self.save(INBOXES_DATA_FILE, inboxes) if changed else True
+
+    def inbox_page(self, user_id, before=None, limit=24):
+        """Входящие пользователя от новых к старым после позиции before: [(upload_date, video_id)]"""
+        with self.lock:
+            inbox = (self.load(INBOXES_DATA_FILE) or {}).get(str(user_id), [])
+        keys = [(upload_date, video_id) for upload_date, video_id, _ in inbox]
+        return [key for key in keys if before is None or key < before][:limit]
+
+    def remove_from_inbox(self, user_id, channel_id):
+        """Удаление из входящих пользователя видео канала (после отписки)"""
+        with self.lock:
+            inboxes = self.load(INBOXES_DATA_FILE) or {}
+            inbox = inboxes.get(str(user_id), [])
+            kept = [entry for entry in inbox if entry[2] != channel_id]
+            if len(kept) != len(inbox):
+                inboxes[str(user_id)] = kept
+                self.save(INBOXES_DATA_FILE, inboxes)
+
+    def replace_inboxes(self, rows):
+        """Полная замена всех входящих (пересборка)"""
+        inboxes = {}
+        for user_id, upload_date, video_id, channel_id in rows:
+            inboxes.setdefault(str(user_id), []).append([upload_date, video_id, channel_id])
+        with self.lock:
+            return self.save(INBOXES_DATA_FILE, {user_id: sorted(inbox, reverse=True) for user_id, inbox in inboxes.items()})
+
+    def load_session(self, sid):
+        """Данные сессии sid и время её истечения или None"""
+        return self.sessions.get(sid)
+
+    def save_session(self, sid, data, expires):
+        self.sessions[sid] = (data, expires)
+
+    def delete_session(self, sid):
+        self.sessions.pop(sid, None)
+
+    def prune_sessions(self, now):
+        """Удаление просроченных сессий, возвращает их количество"""
+        expired = [sid for sid, (_, expires) in list(self.sessions.items()) if expires < now]
+        for sid in expired:
+            self.sessions.pop(sid, None)
+        return len(expired)
+
+    def reset_connections(self):
+        # Блокировку мог держать поток родителя, которого в дочернем процессе нет
+        self.file_locks = {}
+        self.file_locks_guard = threading.Lock()
+
+class SqliteStorage:
+    """Хранение коллекций в SQLite (WAL): одна строка на запись
+
+    Каждое изменение пишется в журнал changes в той же транзакции, по нему
+    другие процессы подтягивают чужие изменения (см. ChangeSync).
+    """
+
+    shared = True
+    backend = 'sqlite'
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    def connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+            conn.execute('CREATE TABLE IF NOT EXISTS changes (seq INTEGER PRIMARY KEY AUTOINCREMENT, '
+                         'tbl TEXT NOT NULL, key TEXT NOT NULL, origin TEXT NOT NULL, created REAL NOT NULL)')
+            for file in COLLECTION_KEYS:
+                conn.execute(f'CREATE TABLE IF NOT EXISTS "{self.table(file)}" (key TEXT PRIMARY KEY, data TEXT NOT NULL)')
+            conn.execute('CREATE TABLE IF NOT EXISTS view_stats (scope TEXT NOT NULL, id TEXT NOT NULL, bucket TEXT NOT NULL, '
+                         'views INTEGER NOT NULL, updated REAL NOT NULL, PRIMARY KEY (scope, id, bucket))')
+            conn.execute('CREATE INDEX IF NOT EXISTS view_stats_updated ON view_stats (updated)')
+            conn.execute('CREATE TABLE IF NOT EXISTS inbox (user_id TEXT NOT NULL, upload_date TEXT NOT NULL, video_id TEXT NOT NULL, '
+                         'channel_id TEXT NOT NULL, PRIMARY KEY (user_id, upload_date, video_id)) WITHOUT ROWID')
+            conn.execute('CREATE TABLE IF NOT EXISTS sessions (sid TEXT PRIMARY KEY, data TEXT NOT NULL, expires REAL NOT NULL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS sessions_expires ON sessions (expires)')
+            conn.commit()
+            self._local.conn = conn
+        return conn
+
+    def reset_connections(self):
+        """Новые соединения после fork: соединения SQLite нельзя делить между процессами"""
+        self._local = threading.local()
+
+    @staticmethod
+    def table(file):
+        return os.path.splitext(os.path.basename(file))[0]
+
+    @staticmethod
+    def row(file, record):
+        return str(record[COLLECTION_KEYS[file]]), json.dumps(record, ensure_ascii=False, default=json_default)
+
+    def log_changes(self, conn, file, keys):
+        now = time.time()
+        conn.executemany('INSERT INTO changes (tbl, key, origin, created) VALUES (?, ?, ?, ?)',
+                         [(file, json.dumps(key), process_id(), now) for key in keys])
+
+    @storage_metric('load')
+    def load(self, file):
+        try:
+            cursor = self.connection().execute(f'SELECT data FROM "{self.table(file)}" ORDER BY rowid')
+            return [json.loads(data) for (data,) in cursor]
+        except (sqlite3.Error, json.JSONDecodeError) as e:
+            raise StorageError(f"Cannot read {file} from {self.path}: {e}") from e
+
+    @storage_metric('fetch')
+    def fetch(self, file, key):
+        """Текущая версия одной записи (JSON строка) или None, если её удалили"""
+        row = self.connection().execute(f'SELECT data FROM "{self.table(file)}" WHERE key = ?', (str(key),)).fetchone()
+        return row[0] if row else None
+
+    def count_written(self, file, rows):
+        STORAGE_WRITTEN_BYTES.inc(sum(len(data) for _, data in rows), backend=self.backend, collection=os.path.basename(file))
+
+    @storage_metric('save')
+    def save(self, file, data):
+        try:
+            rows = [self.row(file, record) for record in data]
+            conn = self.connection()
+            with conn:
+                conn.execute(f'DELETE FROM "{self.table(file)}"')
+                conn.executemany(f'INSERT INTO "{self.table(file)}" (key, data) VALUES (?, ?)', rows)
+                conn.execute('INSERT INTO changes (tbl, key, origin, created) VALUES (?, ?, ?, ?)',
+                             (file, '*', process_id(), time.time()))
+            self.count_written(file, rows)
+            return True
+        except Exception as e:
+            app.logger.error("Error saving %s to %s: %s", file, self.path, e, extra={'backend': self.backend, 'collection': os.path.basename(file)})
+            return False
+
+    def upsert(self, file, data, record):
+        return self.upsert_many(file, data, [record])
+
+    @storage_metric('upsert')
+    def upsert_many(self, file, data, records):
+        try:
+            rows = [self.row(file, record) for record in records]
+            conn = self.connection()
+            with conn:
+                conn.executemany(f'INSERT INTO "{self.table(file)}" (key, data) VALUES (?, ?) '
+                                 'ON CONFLICT(key) DO UPDATE SET data = excluded.data', rows)
+                self.log_changes(conn, file, [record[COLLECTION_KEYS[file]] for record in records])
+            self.count_written(file, rows)
+            return True
+        except Exception as e:
+            app.logger.error("Error saving records to %s in %s: %s", file, self.path, e, extra={'backend': self.backend, 'collection': os.path.basename(file)})
+            return False
+
+    @storage_metric('compare_and_set', false_is_error=False)
+    def compare_and_set(self, file, data, expected, record):
+        """Запись record, только если в базе всё ещё версия expected (захват задачи одним процессом)"""
+        key, data = self.row(file, record)
+        conn = self.connection()
+        with conn:
+            cursor = conn.execute(f'UPDATE "{self.table(file)}" SET data = ? WHERE key = ? AND data = ?',
+                                  (data, key, self.row(file, expected)[1]))
+            if cursor.rowcount == 1:
+                self.log_changes(conn, file, [record[COLLECTION_KEYS[file]]])
+        if cursor.rowcount == 1:
+            self.count_written(file, [(key, data)])
+        return cursor.rowcount == 1
+
+    @storage_metric('merge')
+    def merge_fields(self, file, data, changes):
+        """Слияние изменений полей с записями в базе: changes - [(запись, изменения для apply_deltas)]
+
+        Строка читается и переписывается в одной транзакции BEGIN IMMEDIATE, так что
+        голоса, подписки и ответы, одновременно записанные другими процессами, не
+        теряются, а остальные поля строки остаются такими, какие они в базе.
+        """
+        table = self.table(file)
+        key_field = COLLECTION_KEYS[file]
+        conn = self.connection()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                rows = []
+                for record, deltas in changes:
+                    key = str(record[key_field])
+                    row = conn.execute(f'SELECT data FROM "{table}" WHERE key = ?', (key,)).fetchone()
+                    merged = json.loads(row[0]) if row else json.loads(self.row(file, record)[1])
+                    apply_deltas(merged, deltas)
+                    rows.append(self.row(file, merged))
+                conn.executemany(f'INSERT INTO "{table}" (key, data) VALUES (?, ?) '
+                                 'ON CONFLICT(key) DO UPDATE SET data = excluded.data', rows)
+                self.log_changes(conn, file, [record[key_field] for record, _ in changes])
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+            self.count_written(file, rows)
+            return True
+        except Exception as e:
+            app.logger.error("Error merging records into %s in %s: %s", file, self.path, e, extra={'backend': self.backend, 'collection': os.path.basename(file)})
+            return False
+
+    @storage_metric('delete')
+    def delete(self, file, data, record):
+        try:
+            conn = self.connection()
+            with conn:
+                conn.execute(f'DELETE FROM "{self.table(file)}" WHERE key = ?', (str(record[COLLECTION_KEYS[file]]),))
+                self.log_changes(conn, file, [record[COLLECTION_KEYS[file]]])
+            return True
+        except Exception as e:
+            app.logger.error("Error deleting record from %s in %s: %s", file, self.path, e, extra={'backend': self.backend, 'collection': os.path.basename(file)})
+            return False
+
+    def last_change(self):
+        return self.connection().execute('SELECT COALESCE(MAX(seq), 0) FROM changes').fetchone()[0]
+
+    def changes_since(self, seq):
+        """Изменения других процессов после seq и номер последнего изменения"""
+        rows = self.connection().execute('SELECT seq, tbl, key, origin FROM changes WHERE seq > ? ORDER BY seq', (seq,)).fetchall()
+        if not rows:
+            return [], seq
+        own = process_id()
+        return [(tbl, key) for _, tbl, key, origin in rows if origin != own], rows[-1][0]
+
+    def first_change(self):
+        return self.connection().execute('SELECT COALESCE(MIN(seq), 0) FROM changes').fetchone()[0]
+
+    def prune_changes(self, before):
+        conn = self.connection()
+        with conn:
+            conn.execute('DELETE FROM changes WHERE created < ?', (before,))
+
+    def add_views(self, deltas):
+        """Прибавление просмотров: deltas - {(scope, id, bucket): число}; сложение в базе, без потерь между процессами"""
+        conn = self.connection()
+        now = time.time()
+        try:
+            with conn:
+                conn.executemany('INSERT INTO view_stats (scope, id, bucket, views, updated) VALUES (?, ?, ?, ?, ?) '
+                                 'ON CONFLICT(scope, id, bucket) DO UPDATE SET views = views + excluded.views, updated = excluded.updated',
+                                 ((scope, str(key), bucket, count, now) for (scope, key, bucket), count in deltas.items()))
+            return True
+        except sqlite3.Error as e:
+            app.logger.error("Error saving views to %s: %s", self.path, e)
+            return False
+
+    def load_views(self, since=0):
+        """Счётчики просмотров, изменённые после since: [(scope, id, bucket, views)]"""
+        return self.connection().execute('SELECT scope, id, bucket, views FROM view_stats WHERE updated > ?', (since,)).fetchall()
+
+    def prune_views(self, prefix, before):
+        """Удаление счётчиков корзин prefix (h: или d:) старше before"""
+        conn = self.connection()
+        with conn:
+            conn.execute('DELETE FROM view_stats WHERE bucket >= ? AND bucket < ?', (prefix, before))
+
+    def next_id(self, name, floor=0):
+        """Следующий id последовательности name (не меньше floor + 1), атомарно для всех процессов"""
+        conn = self.connection()
+        with conn:
+            conn.execute('INSERT INTO meta (key, value) VALUES (?, ?) '
+                         'ON CONFLICT(key) DO UPDATE SET value = MAX(CAST(value AS INTEGER), ?) + 1',
+                         (f'seq:{name}', floor + 1, floor))
+            return int(conn.execute('SELECT value FROM meta WHERE key = ?', (f'seq:{name}',)).fetchone()[0])
+
+    def add_to_inboxes(self, rows, limit):
+        """Добавление видео во входящие: rows - [(user_id, upload_date, video_id, channel_id)], у каждого не больше limit"""
+        rows = [(str(user_id), upload_date, video_id, channel_id) for user_id, upload_date, video_id, channel_id in rows]
+        conn = self.connection()
+        try:
+            with conn:
+                conn.executemany('INSERT OR IGNORE INTO inbox (user_id, upload_date, video_id, channel_id) VALUES (?, ?, ?, ?)', rows)
+                # Старое сверх limit выпадает из входящих
+                conn.executemany('DELETE FROM inbox WHERE user_id = ? AND upload_date < '
+                                 '(SELECT upload_date FROM inbox WHERE user_id = ? ORDER BY upload_date DESC, video_id DESC LIMIT 1 OFFSET ?)',
+                                 [(user_id, user_id, limit - 1) for user_id in {row[0] for row in rows}])
+            return True
+        except sqlite3.Error as e:
+            app.logger.error("Error saving inboxes to %s: %s", self.path, e)
+            return False
+
+    def inbox_page(self, user_id, before=None, limit=24):
+        """Входящие пользователя от новых к старым после позиции before: [(upload_date, video_id)]"""
+        if before is None:
+            return self.connection().execute('SELECT upload_date, video_id FROM inbox WHERE user_id = ? '
+                                             'ORDER BY upload_date DESC, video_id DESC LIMIT ?', (str(user_id), limit)).fetchall()
+        return self.connection().execute('SELECT upload_date, video_id FROM inbox WHERE user_id = ? AND (upload_date, video_id) < (?, ?) '
+                                         'ORDER BY upload_date DESC, video_id DESC LIMIT ?', (str(user_id), *before, limit)).fetchall()
+
+    def remove_from_inbox(self, user_id, channel_id):
+        """Удаление из входящих пользователя видео канала (после отписки)"""
+        conn = self.connection()
+        with conn:
+            conn.execute('DELETE FROM inbox WHERE user_id = ? AND channel_id = ?', (str(user_id), channel_id))
+
+    def replace_inboxes(self, rows):
+        """Полная замена всех входящих (пересборка)"""
+        conn = self.connection()
+        with conn:
+            conn.execute('DELETE FROM inbox')
+            conn.executemany('INSERT OR IGNORE INTO inbox (user_id, upload_date, video_id, channel_id) VALUES (?, ?, ?, ?)',
+                             ((str(user_id), upload_date, video_id, channel_id) for user_id, upload_date, video_id, channel_id in rows))
+        return True
+
+    def load_session(self, sid):
+        """Данные сессии sid и время её истечения или None"""
+        return self.connection().execute('SELECT data, expires FROM sessions WHERE sid = ?', (sid,)).fetchone()
+
+    def save_session(self, sid, data, expires):
+        conn = self.connection()
+        with conn:
+            conn.execute('INSERT INTO sessions (sid, data, expires) VALUES (?, ?, ?) '
+                         'ON CONFLICT(sid) DO UPDATE SET data = excluded.data, expires = excluded.expires', (sid, data, expires))
+
+    def delete_session(self, sid):
+        conn = self.connection()
+        with conn:
+            conn.execute('DELETE FROM sessions WHERE sid = ?', (sid,))
+
+    def prune_sessions(self, now):
+        """Удаление просроченных сессий, возвращает их количество"""
+        conn = self.connection()
+        with conn:
+            return conn.execute('DELETE FROM sessions WHERE expires < ?', (now,)).rowcount
+
+    def get_meta(self, key):
+        row = self.connection().execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key, value):
+        conn = self.connection()
+        with conn:
+            conn.execute('INSERT INTO meta (key, value) VALUES (?, ?) '
+                         'ON CONFLICT(key) DO UPDATE SET value = excluded.value', (key, value))
+
+class JournalStorage(JsonStorage):
+    """Коллекции в снимке и журнале дозаписи (только один процесс)
+
+    <коллекция>.snapshot - все записи на момент последнего сжатия,
+    <коллекция>.<поколение>.journal - изменения после него, по строке на
+    запись или удаление. Каждая строка несёт CRC32. При запуске снимок читается
+    построчно и дочитывается журнал; оборванная сбоем последняя строка журнала
+    отбрасывается, любое другое повреждение останавливает запуск. Когда журнал
+    вырастает до JOURNAL_COMPACT_BYTES, коллекция пишется в новый снимок,
+    который атомарно заменяет старый. Остальные файлы (последовательности,
+    просмотры, входящие) хранятся как в JsonStorage.
+    """
+
+    backend = 'journal'
+
+    def __init__(self, folder):
+        super().__init__()
+        self.folder = folder
+        # file -> {'generation', 'handle', 'size'}
+        self.journals = {}
+        self.journal_lock = threading.RLock()
+        os.makedirs(folder, exist_ok=True)
+
+    def snapshot_path(self, file):
+        return os.path.join(self.folder, f"{os.path.splitext(os.path.basename(file))[0]}.snapshot")
+
+    def journal_path(self, file, generation):
+        return os.path.join(self.folder, f"{os.path.splitext(os.path.basename(file))[0]}.{generation}.journal")
+
+    @staticmethod
+    def encode(kind, value):
+        """Строка файла: CRC32, вид (H - заголовок, R - запись снимка, E - конец снимка, P - запись, D - удаление) и JSON"""
+        payload = kind + json.dumps(value, ensure_ascii=False, separators=(',', ':'), default=json_default)
+        return f"{zlib.crc32(payload.encode()):08x} {payload}\n"
+
+    @staticmethod
+    def decode(line):
+        """(вид, значение) или None, если строка повреждена или оборвана"""
+        if not line.endswith('\n'):
+            return None
+        checksum, _, payload = line[:-1].partition(' ')
+        try:
+            if not payload or int(checksum, 16) != zlib.crc32(payload.encode()):
+                return None
+            return payload[0], json.loads(payload[1:])
+        except ValueError:
+            return None
+
+    def load(self, file):
+        if file not in COLLECTION_KEYS:
+            return super().load(file)
+        return self.load_collection(file)
+
+    @storage_metric('load')
+    def load_collection(self, file):
+        with self.journal_lock:
+            records, generation = self.read_snapshot(file)
+            if records is None:
+                # Первый запуск: перенос старого JSON файла (повреждённый остановит запуск, а не станет пустым)
+                data = JsonStorage.load(self, file)
+                self.write_snapshot(file, data, 1)
+                if data:
+                    app.logger.info("Imported %s records from %s to %s", len(data), file, self.snapshot_path(file))
+                records = {record[COLLECTION_KEYS[file]]: record for record in data}
+                generation = 1
+            self.replay(file, generation, records)
+            return list(records.values())
+
+    def read_snapshot(self, file):
+        """Записи снимка {ключ: запись} и его поколение; (None, 0), если снимка нет"""
+        path = self.snapshot_path(file)
+        try:
+            f = open(path, 'r', encoding='utf-8', newline='\n')
+        except FileNotFoundError:
+            return None, 0
+        key = COLLECTION_KEYS[file]
+        records = {}
+        header = end = None
+        with f:
+            for number, line in enumerate(f, 1):
+                entry = self.decode(line)
+                if entry is None or end is not None or (header is None) != (entry[0] == 'H'):
+                    raise StorageError(f"{path} is corrupted at line {number}")
+                kind, value = entry
+                if kind == 'H':
+                    header = value
+                elif kind == 'R':
+                    records[value[key]] = value
+                elif kind == 'E':
+                    end = value
+                else:
+                    raise StorageError(f"{path} is corrupted at line {number}")
+        if end is None or end['count'] != len(records):
+            raise StorageError(f"{path} is incomplete")
+        return records, header['generation']
+
+    def replay(self, file, generation, records):
+        """Применение журнала поколения generation к records и открытие его на дозапись"""
+        key = COLLECTION_KEYS[file]
+        path = self.journal_path(file, generation)
+        previous = self.journals.pop(file, None)
+        if previous is not None:
+            previous['handle'].close()
+        handle = open(path, 'ab+')
+        handle.seek(0)
+        size = 0
+        for raw in iter(handle.readline, b''):
+            try:
+                entry = self.decode(raw.decode('utf-8'))
+            except UnicodeDecodeError:
+                entry = None
+            if entry is None:
+                if handle.read().strip():
+                    handle.close()
+                    raise StorageError(f"{path} is corrupted at byte {size}")
+                # Запись, оборванная сбоем, так и не была подтверждена - отбрасываем
+                app.logger.warning("Discarding torn record at the end of %s", path)
+                handle.truncate(size)
+                break
+            kind, value = entry
+            if kind == 'P':
+                records[value[key]] = value
+            elif kind == 'D':
+                records.pop(value, None)
+            size += len(raw)
+        handle.seek(0, os.SEEK_END)
+        self.journals[file] = {'generation': generation, 'handle': handle, 'size': size}
+        # Журналы прежних поколений остаются, если сбой случился посреди сжатия
+        prefix = f"{os.path.splitext(os.path.basename(file))[0]}."
+        for name in os.listdir(self.folder):
+            if name.startswith(prefix) and name.endswith('.journal') and os.path.join(self.folder, name) != path:
+                os.remove(os.path.join(self.folder, name))
+
+    def write_snapshot(self, file, data, generation):
+        """Атомарная запись снимка: временный файл, fsync, переименование поверх старого"""
+        path = self.snapshot_path(file)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8', newline='\n') as f:
+            f.write(self.encode('H', {'generation': generation, 'file': os.path.basename(file), 'created': datetime.now().isoformat()}))
+            count = 0
+            for record in data:
+                f.write(self.encode('R', record))
+                count += 1
+            f.write(self.encode('E', {'count': count}))
+            f.flush()
+            os.fsync(f.fileno())
+            STORAGE_WRITTEN_BYTES.inc(f.tell(), backend=self.backend, collection=os.path.basename(file))
+        os.replace(tmp_path, path)
+        fsync_directory(path)
+
+    def compact(self, file, data):
+        """Новый снимок из data и пустой журнал следующего поколения"""
+        with self.journal_lock:
+            journal = self.journals.get(file)
+            generation = journal['generation'] + 1 if journal else 1
+            self.write_snapshot(file, data, generation)
+            self.replay(file, generation, {})
+
+    def save(self, file, data):
+        if file not in COLLECTION_KEYS:
+            return super().save(file, data)
+        return self.save_collection(file, data)
+
+    @storage_metric('save')
+    def save_collection(self, file, data):
+        try:
+            self.compact(file, data)
+            return True
+        except Exception as e:
+            app.logger.error("Error saving snapshot of %s: %s", file, e, extra={'backend': self.backend, 'collection': os.path.basename(file)})
+            return False
+
+    def append(self, file, data, lines):
+        """Дозапись строк в журнал с fsync; сжатие, если журнал вырос"""
+        payload = ''.join(lines).encode()
+        with self.journal_lock:
+            if file not in self.journals:
+                self.load(file)
+            journal = self.journals[file]
+            try:
+                journal['handle'].write(payload)
+                journal['handle'].flush()
+                os.fsync(journal['handle'].fileno())
+            except Exception:
+                # Недописанная строка посреди журнала остановила бы следующий запуск
+                with contextlib.suppress(Exception):
+                    journal['handle'].truncate(journal['size'])
+                    journal['handle'].seek(0, os.SEEK_END)
+                raise
+            journal['size'] += len(payload)
+            STORAGE_WRITTEN_BYTES.inc(len(payload), backend=self.backend, collection=os.path.basename(file))
+            if journal['size'] > app.config['JOURNAL_COMPACT_BYTES']:
+                self.compact(file, data)
+
+    def upsert(self, file, data, record):
+        return self.upsert_many(file, data, [record])
+
+    @storage_metric('upsert')
+    def upsert_many(self, file, data, records):
+        if file not in COLLECTION_KEYS:
+            return super().save(file, data)
+        try:
+            self.append(file, data, [self.encode('P', record) for record in records])
+            return True
+        except Exception as e:
+            app.logger.error("Error appending to journal of %s: %s", file, e, extra={'backend': self.backend, 'collection': os.path.basename(file)})
+            return False
+
+    def compare_and_set(self, file, data, expected, record):
+        # Процесс один, сравнивать не с кем
+        return self.upsert_many(file, data, [record])
+
+    @storage_metric('delete')
+    def delete(self, file, data, record):
+        try:
+            self.append(file, data, [self.encode('D', record[COLLECTION_KEYS[file]])])
+            return True
+        except Exception as e:
+            app.logger.error("Error appending to journal of %s: %s", file, e, extra={'backend': self.backend, 'collection': os.path.basename(file)})
+            return False
+
+    def import_json(self):
+        """Повторный перенос старых JSON файлов (заменяет снимки)"""
+        for file in COLLECTION_KEYS:
+            if os.path.exists(file):
+                data = JsonStorage.load(self, file)
+                self.compact(file, data)
+                app.logger.info("Imported %s records from %s to %s", len(data), file, self.snapshot_path(file))
+
+def migrate_json_to_sqlite(target, force=False):
+    """Однократный перенос данных из JSON файлов в SQLite
+
+    Выполняется в одной транзакции BEGIN IMMEDIATE, поэтому при одновременном
+    старте нескольких процессов перенос сделает только один из них.
+    """
+    conn = target.connection()
+    conn.execute('BEGIN IMMEDIATE')
     try:
-        with open(file, 'w') as f:
-            json.dump(data, f, indent=4)
-    except Exception as e:
-        print(f"Error saving to {file}: {e}")
+        if conn.execute("SELECT value FROM meta WHERE key = 'migrated_from_json'").fetchone() and not force:
+            conn.rollback()
+            return False
+        source = JsonStorage()
+        for file in COLLECTION_KEYS:
+            if os.path.exists(file):
+                data = source.load(file)
+                conn.execute(f'DELETE FROM "{target.table(file)}"')
+                conn.executemany(f'INSERT INTO "{target.table(file)}" (key, data) VALUES (?, ?)',
+                                 (target.row(file, record) for record in data))
+                conn.execute('INSERT INTO changes (tbl, key, origin, created) VALUES (?, ?, ?, ?)',
+                             (file, '*', process_id(), time.time()))
+                app.logger.info("Migrated %s records from %s to %s", len(data), file, target.path)
+        conn.execute("INSERT INTO meta (key, value) VALUES ('migrated_from_json', ?) "
+                     "ON CONFLICT(key) DO UPDATE SET value = excluded.value", (datetime.now().isoformat(),))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return True
+
+def create_storage(backend):
+    """Создание хранилища по имени бэкенда"""
+    if backend == 'json':
+        return JsonStorage()
+    if backend == 'sqlite':
+        storage = SqliteStorage(DATABASE_FILE)
+        migrate_json_to_sqlite(storage)
+        return storage
+    if backend == 'journal':
+        return JournalStorage(JOURNAL_FOLDER)
+    raise ValueError(f"Unknown storage backend: {backend}")
+
+storage = create_storage(app.config['STORAGE_BACKEND'])
+
+class WriteBehind:
+    """Отложенная запись: изменённые записи копятся и сбрасываются пачкой
+
+    Повторные изменения одной записи до сброса схлопываются в одну запись.
+    Для голосов и подписок копятся и изменения полей (deltas, см. apply_deltas):
+    при сбросе они сливаются с тем, что в хранилище, а не затирают изменения
+    других процессов.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = {}
+        # file -> {ключ: {поле: изменения для apply_deltas}}
+        self.deltas = {}
+        self.collections = {}
+        self.count = 0
+        self.wakeup = threading.Event()
+        self.thread = None
+
+    def mark(self, file, data, record, deltas=None):
+        with self.lock:
+            records = self.pending.setdefault(file, {})
+            key = record[COLLECTION_KEYS[file]]
+            if key not in records:
+                self.count += 1
+            records[key] = record
+            if deltas:
+                self.merge_deltas(self.deltas.setdefault(file, {}).setdefault(key, {}), deltas)
+            self.collections[file] = data
+            if self.count >= app.config['WRITE_BEHIND_MAX_PENDING']:
+                self.wakeup.set()
+        if self.thread is None:
+            self.start()
+
+    @staticmethod
+    def merge_deltas(target, deltas):
+        """Добавление изменений deltas к target (более поздние поверх)"""
+        for field, change in deltas.items():
+            if isinstance(change, list):
+                target.setdefault(field, []).extend(change)
+            else:
+                target.setdefault(field, {}).update(change)
+
+    def pending_deltas(self, file, key):
+        """Ещё не записанные изменения записи: None - записи нет в очереди, {} - ждёт записи целиком"""
+        with self.lock:
+            if key not in self.pending.get(file, ()):
+                return None
+            deltas = {}
+            self.merge_deltas(deltas, self.deltas.get(file, {}).get(key, {}))
+            return deltas
+
+    def discard(self, file, record):
+        """Отмена отложенной записи (перед удалением записи)"""
+        key = record[COLLECTION_KEYS[file]]
+        with self.lock:
+            self.deltas.get(file, {}).pop(key, None)
+            if self.pending.get(file, {}).pop(key, None) is not None:
+                self.count -= 1
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending, self.count = self.pending, {}, 0
+            deltas, self.deltas = self.deltas, {}
+        for file, records in pending.items():
+            file_deltas = deltas.get(file, {})
+            try:
+                self.flush_file(file, records, file_deltas)
+            except Exception as e:
+                # Пачка остаётся в очереди: повторная запись и слияние множеств ничего не задвоят
+                app.logger.exception("Error flushing deferred writes to %s: %s", file, e, extra={'collection': os.path.basename(file)})
+                self.requeue(file, records, file_deltas)
+
+    def flush_file(self, file, records, deltas):
+        data = self.collections[file]
+        # Записи и их множества меняют обработчики запросов: пишется копия, снятая под state_lock
+        with state_lock:
+            copies = {key: copy.deepcopy(dict(record)) for key, record in records.items()}
+        plain = [key for key in records if key not in deltas]
+        merged = [key for key in records if key in deltas]
+        # JSON и журнал при записи могут сериализовать всю коллекцию - тоже только под state_lock
+        with contextlib.nullcontext() if storage.shared else state_lock:
+            plain_ok = not plain or storage.upsert_many(file, data, [copies[key] for key in plain])
+            merged_ok = not merged or storage.merge_fields(file, data, [(copies[key], deltas[key]) for key in merged])
+        if not plain_ok:
+            self.requeue(file, {key: records[key] for key in plain}, {})
+        if merged:
+            if not merged_ok:
+                self.requeue(file, {key: records[key] for key in merged}, deltas)
+            elif storage.shared:
+                # В памяти - итог слияния с изменениями других процессов, счётчики пересчитывают хуки синхронизации
+                with state_lock:
+                    for key in merged:
+                        change_sync.apply(data, key)
+
+    def requeue(self, file, records, deltas):
+        """Возврат незаписанного в очередь, не затирая более свежие изменения"""
+        with self.lock:
+            current = self.pending.setdefault(file, {})
+            current_deltas = self.deltas.setdefault(file, {})
+            for key, record in records.items():
+                if key not in current:
+                    current[key] = record
+                    self.count += 1
+                if key in deltas:
+                    newer = current_deltas.get(key, {})
+                    current_deltas[key] = {}
+                    self.merge_deltas(current_deltas[key], deltas[key])
+                    self.merge_deltas(current_deltas[key], newer)
+
+    def start(self):
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.thread = threading.Thread(target=self._run, name='write-behind', daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            self.wakeup.wait(app.config['WRITE_BEHIND_INTERVAL'])
+            self.wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                app.logger.exception("Error in write-behind flush: %s", e)
+
+    def reset_after_fork(self):
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.deltas = {}
+        self.count = 0
+        self.wakeup = threading.Event()
+        self.thread = None
+
+write_behind = WriteBehind()
+atexit.register(write_behind.flush)
+
+def exit_on_sigterm(signum, frame):
+    """По SIGTERM (остановка сервиса) выходим штатно, чтобы atexit успел сбросить записи"""
+    raise SystemExit(0)
+
+if threading.current_thread() is threading.main_thread() and signal.getsignal(signal.SIGTERM) == signal.SIG_DFL:
+    signal.signal(signal.SIGTERM, exit_on_sigterm)
+
+@app.cli.command('migrate-json')
+def migrate_json_command():
+    """Повторный перенос JSON файлов в SQLite или в снимки хранилища 'journal' (перезаписывает данные)"""
+    if isinstance(storage, JournalStorage):
+        storage.import_json()
+    else:
+        migrate_json_to_sqlite(SqliteStorage(DATABASE_FILE), force=True)
+
+@app.cli.command('compact-storage')
+def compact_storage_command():
+    """Сжатие журналов хранилища 'journal' в новые снимки"""
+    if not isinstance(storage, JournalStorage):
+        click.echo("Only the 'journal' storage backend has journals to compact", err=True)
+        return
+    for file in COLLECTION_KEYS:
+        data = storage.load(file)
+        storage.save(file, data)
+        click.echo(f"Compacted {file}: {len(data)} records")
+
+class Record(MutableMapping):
+    """Запись каталога с полями в __slots__ вместо словаря
+
+    Ведёт себя как dict (record['title'], get, update, dict(record)), но известные
+    поля хранятся в слотах, а строковые id интернируются - на сотнях тысяч
+    записей это заметно меньше памяти. Незнакомые поля (из более новых версий)
+    попадают в extra и сохраняются как есть. Поля для страниц (относительное
+    время и т.п.) в запись не кладутся - для них есть view().
+    """
+
+    __slots__ = ('_extra',)
+    FIELDS = ()
+    # Поля страниц, которые раньше по ошибке сохранялись; при загрузке отбрасываются
+    VIEW_FIELDS = ()
+    INTERNED = ('id', 'video_id', 'channel_id')
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.FIELD_SET = frozenset(cls.FIELDS)
+
+    def __init__(self, data=(), **fields):
+        self._extra = None
+        for source in (data, fields):
+            for key, value in (source.items() if hasattr(source, 'items') else source):
+                if key not in self.VIEW_FIELDS:
+                    self[key] = value
+
+    def __getitem__(self, key):
+        if key in self.FIELD_SET:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key) from None
+        if self._extra is not None and key in self._extra:
+            return self._extra[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key in self.FIELD_SET:
+            if key in self.INTERNED and type(value) is str:
+                value = sys.intern(value)
+            setattr(self, key, value)
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+
+    def __delitem__(self, key):
+        if key in self.FIELD_SET:
+            try:
+                delattr(self, key)
+            except AttributeError:
+                raise KeyError(key) from None
+        elif self._extra is not None and key in self._extra:
+            del self._extra[key]
+        else:
+            raise KeyError(key)
+
+    def __iter__(self):
+        for field in self.FIELDS:
+            if hasattr(self, field):
+                yield field
+        if self._extra is not None:
+            yield from self._extra
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __contains__(self, key):
+        if key in self.FIELD_SET:
+            return hasattr(self, key)
+        return self._extra is not None and key in self._extra
+
+    def get(self, key, default=None):
+        if key in self.FIELD_SET:
+            return getattr(self, key, default)
+        return self._extra.get(key, default) if self._extra is not None else default
+
+    def clear(self):
+        for field in self.FIELDS:
+            if hasattr(self, field):
+                delattr(self, field)
+        self._extra = None
+
+    def to_dict(self):
+        """Сохраняемые поля в виде обычного словаря (для JSON)"""
+        data = {field: getattr(self, field) for field in self.FIELDS if hasattr(self, field)}
+        if self._extra:
+            data.update(self._extra)
+        return data
+
+    def view(self, **fields):
+        """Копия для шаблона или JSON ответа с дополнительными полями страницы"""
+        data = self.to_dict()
+        data.update(fields)
+        return data
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.to_dict()!r})"
+
+class Video(Record):
+    __slots__ = FIELDS = ('id', 'user_id', 'channel_id', 'title', 'description', 'filename', 'cover', 'covers',
+                          'likes', 'dislikes', 'views', 'upload_date', 'hls', 'renditions', 'width', 'height', 'duration')
+    VIEW_FIELDS = ('relative_time',)
+
+class Comment(Record):
+    __slots__ = FIELDS = ('id', 'video_id', 'user_id', 'channel_link_id', 'text', 'likes', 'dislikes', 'sub_comments')
+
+class User(Record):
+    __slots__ = FIELDS = ('id', 'nickname', 'email', 'password', 'avatar', 'avatars', 'group', 'theme')
+
+class Channel(Record):
+    __slots__ = FIELDS = ('id', 'user_id', 'description', 'subscribers')
+    VIEW_FIELDS = ('avatar', 'name')
+
+class Collection(list):
+    """Коллекция записей с индексом по ключу и вторичными индексами по полям"""
+
+    def __init__(self, file, records=(), indexes=(), prepare=None, record_type=None):
+        # record_type - класс записей (Video и т.п.), иначе записи остаются словарями
+        self.record_type = record_type
+        super().__init__(map(record_type, records) if record_type else records)
+        self.file = file
+        self.key = COLLECTION_KEYS[file]
+        self.by_key = {}
+        self.indexes = {field: {} for field in indexes}
+        # prepare приводит загруженную из хранилища запись к виду в памяти (например, списки в множества)
+        self.prepare = prepare
+        # Подписчики на изменения записей (сброс кэшей)
+        self.listeners = []
+        for record in self:
+            if prepare:
+                prepare(record)
+            self._index(record)
+
+    def _index(self, record):
+        self.by_key[record[self.key]] = record
+        for field, index in self.indexes.items():
+            index.setdefault(record.get(field), []).append(record)
+
+    def _unindex(self, record):
+        self.by_key.pop(record[self.key], None)
+        for field, index in self.indexes.items():
+            self._discard(index, record.get(field), record)
+
+    @staticmethod
+    def _discard(index, value, record):
+        bucket = index.get(value)
+        if bucket is None:
+            return
+        bucket[:] = [r for r in bucket if r is not record]
+        if not bucket:
+            del index[value]
+
+    def get(self, key):
+        """Запись по ключу"""
+        return self.by_key.get(key)
+
+    def find(self, field, value):
+        """Все записи с заданным значением поля"""
+        return list(self.indexes[field].get(value, ()))
+
+    def first(self, field, value):
+        """Первая запись с заданным значением поля"""
+        bucket = self.indexes[field].get(value)
+        return bucket[0] if bucket else None
+
+    def append(self, record):
+        super().append(record)
+        self._index(record)
+
+    def remove(self, record):
+        super().remove(record)
+        self._unindex(record)
+
+    def update(self, record, field, value):
+        """Изменение индексируемого поля записи"""
+        if field in self.indexes:
+            self._discard(self.indexes[field], record.get(field), record)
+            self.indexes[field].setdefault(value, []).append(record)
+        record[field] = value
+
+    def wrap(self, data):
+        """Запись из загруженного словаря"""
+        return self.record_type(data) if self.record_type else data
+
+    def replace(self, record, new):
+        """Замена содержимого записи на месте (ссылки на неё остаются верными)"""
+        for field in self.indexes:
+            self.update(record, field, new.get(field))
+        record.clear()
+        record.update(new)
+
+    def claim(self, record, **fields):
+        """Изменение записи, только если её не успел изменить другой процесс"""
+        expected = dict(record)
+        record.update(fields)
+        if storage.compare_and_set(self.file, self, expected, record):
+            return True
+        record.clear()
+        record.update(expected)
+        return False
+
+    def notify(self, record):
+        """Оповещение подписчиков об изменении записи"""
+        for listener in self.listeners:
+            listener(record)
+
+    def save(self, record, defer=False, deltas=None):
+        """Сохранение одной записи в хранилище (defer - отложенно, пачкой; deltas - изменения множеств для слияния)"""
+        save_record(self.file, self, record, defer, deltas)
+        self.notify(record)
+
+    def delete(self, record):
+        """Удаление записи из коллекции и хранилища"""
+        self.remove(record)
+        delete_record(self.file, self, record)
+        self.notify(record)
+
+# ======================
+# Вспомогательные функции
+# ======================
+def load_data(file):
+    """Загрузка коллекции из хранилища"""
+    return storage.load(file)
+
+def save_data(file, data):
+    """Сохранение коллекции целиком"""
+    storage.save(file, data)
+
+def save_record(file, data, record, defer=False, deltas=None):
+    """Сохранение одной записи коллекции (в SQLite - одна строка)"""
+    if defer:
+        write_behind.mark(file, data, record, deltas)
+    elif deltas:
+        if storage.merge_fields(file, data, [(record, deltas)]) and storage.shared:
+            # В памяти - итог слияния с изменениями других процессов
+            with state_lock:
+                change_sync.apply(data, record[COLLECTION_KEYS[file]])
+    else:
+        storage.upsert(file, data, record)
+
+def delete_record(file, data, record):
+    """Удаление одной записи коллекции"""
+    write_behind.discard(file, record)
+    storage.delete(file, data, record)
 
 def format_comment_text(text):
     """Форматирование текста комментария"""
@@ -101,170 +1564,2131 @@ def format_subscriber_count(count):
     else:
         return str(count)
 
+class TTLCache:
+    """Ограниченный по размеру LRU кэш, записи которого устаревают через ttl секунд"""
+
+    def __init__(self, maxsize, ttl, name=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.name = name # имя в метрике freshtube_cache_requests_total, None - не считать
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.data.get(key)
+            if entry is not None and entry[1] < time.monotonic():
+                del self.data[key]
+                entry = None
+            if entry is not None:
+                self.data.move_to_end(key)
+        if self.name:
+            CACHE_REQUESTS.inc(cache=self.name, result='miss' if entry is None else 'hit')
+        return default if entry is None else entry[0]
+
+    def set(self, key, value):
+        with self.lock:
+            self.data[key] = (value, time.monotonic() + self.ttl)
+            self.data.move_to_end(key)
+            if len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+geoip_reader = None
+geoip_lock = threading.Lock()
+
+def get_geoip_reader():
+    """Общий на процесс читатель GeoIP базы (mmap, открывается один раз)"""
+    global geoip_reader
+    if geoip_reader is None and os.path.exists(geoip2_db_path):
+        with geoip_lock:
+            if geoip_reader is None:
+                try:
+                    geoip_reader = geoip2.database.Reader(geoip2_db_path, mode=geoip2.database.MODE_MMAP)
+                except Exception as e:
+                    app.logger.error("Error opening %s: %s", geoip2_db_path, e)
+    return geoip_reader
+
 def get_country_by_ip(ip):
     """Определение страны по IP"""
+    reader = get_geoip_reader()
+    if reader is None:
+        return None
     try:
-        with geoip2.database.Reader(geoip2_db_path) as reader:
-            response = reader.country(ip)
-            return response.country.iso_code
+        with GEOIP_SECONDS.time():
+            return reader.country(ip).country.iso_code
     except geoip2.errors.AddressNotFoundError:
         return None
-    except Exception as e:
+    except Exception:
         return None
 
-def generate_video_id(length=11):
-    """Генерация ID для видео"""
-    characters = string.ascii_letters + string.digits
-    return ''.join(random.choice(characters) for _ in range(length))
+class Blocklist:
+    """Заблокированные адреса, подсети, страны и аккаунты с перечитыванием файла на лету"""
+
+    def __init__(self, path):
+        self.path = path
+        self.mtime = None
+        self.checked_at = 0.0
+        self.decisions = TTLCache(IP_DECISION_CACHE_SIZE, IP_DECISION_TTL, name='ip_decisions')
+        self.apply({})
+
+    def apply(self, data):
+        entries = blocked_ips | set(data.get('ips', []))
+        self.ips = set()
+        self.networks = []
+        for entry in entries:
+            try:
+                if '/' in entry:
+                    self.networks.append(ipaddress.ip_network(entry, strict=False))
+                else:
+                    self.ips.add(str(ipaddress.ip_address(entry)))
+            except ValueError:
+                app.logger.warning("Invalid blocked address: %s", entry)
+        self.countries = blocked_countries | set(data.get('countries', []))
+        self.accounts = blocked_accs | {str(acc) for acc in data.get('accounts', [])}
+        self.decisions.clear()
+
+    def reload_if_changed(self):
+        now = time.monotonic()
+        if now - self.checked_at < BLOCKLIST_CHECK_INTERVAL:
+            return
+        self.checked_at = now
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            mtime = None
+        if mtime == self.mtime:
+            return
+        data = {}
+        if mtime is not None:
+            try:
+                with open(self.path, 'r') as f:
+                    data = json.load(f)
+            except Exception as e:
+                app.logger.error("Error reading %s: %s", self.path, e)
+                return
+        self.mtime = mtime
+        self.apply(data)
+
+    def is_ip_blocked(self, ip):
+        """Решение по IP (адрес, подсеть или страна), кэшируется"""
+        self.reload_if_changed()
+        blocked = self.decisions.get(ip)
+        if blocked is None:
+            blocked = self._check_ip(ip)
+            self.decisions.set(ip, blocked)
+        return blocked
+
+    def _check_ip(self, ip):
+        if ip in self.ips:
+            return True
+        try:
+            address = ipaddress.ip_address(ip)
+        except ValueError:
+            return False
+        if any(address in network for network in self.networks):
+            return True
+        if self.countries:
+            country_code = get_country_by_ip(ip)
+            return bool(country_code and country_code in self.countries)
+        return False
+
+    def is_account_blocked(self, user_id):
+        self.reload_if_changed()
+        return str(user_id) in self.accounts
+
+blocklist = Blocklist(BLOCKLIST_FILE)
+
+class IdSequence:
+    """Монотонные числовые id, которые не повторяются после удаления записей и перезапуска"""
+
+    def __init__(self, name, existing=()):
+        self.name = name
+        # Уже выданные id из данных, созданных до появления последовательности
+        self.floor = max(existing, default=0)
+
+    def next(self):
+        return storage.next_id(self.name, self.floor)
+
+def generate_video_id(length=11):
+    """Генерация ID для видео"""
+    characters = string.ascii_letters + string.digits
+    return ''.join(random.choice(characters) for _ in range(length))
+
+def generate_nickname():
+    """Генерация случайного никнейма"""
+    length = random.randint(1, 50)
+    return ''.join(random.choices(string.ascii_letters + string.digits, k=length))
+
+def generate_channel_id():
+    """Генерация ID для канала"""
+    length = random.randint(3, 30)
+    return ''.join(random.choices(string.ascii_letters + string.digits, k=length))
+
+# ======================
+# Сессии
+# ======================
+class StoredSession(SecureCookieSession):
+    """Сессия; у вошедшего пользователя sid - ключ её данных в хранилище"""
+
+    def __init__(self, initial=None, sid=None, expires=0.0):
+        super().__init__(initial)
+        self.sid = sid
+        self.expires = expires
+        # Под каким пользователем создан sid: при смене пользователя выдаётся новый
+        self.owner = self.get('user_id')
+
+class HybridSessionInterface(SecureCookieSessionInterface):
+    """Сессии гостей целиком в подписанной cookie, вошедших - в хранилище (в cookie только sid)
+
+    Гости ничего не пишут на сервер. Сессия вошедшего записывается только при
+    изменении или когда прошла половина её срока (продление), просроченные
+    удаляются фоновым потоком раз в SESSION_SWEEP_INTERVAL.
+    """
+
+    session_class = StoredSession
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.thread = None
+
+    def open_session(self, app, request):
+        session = super().open_session(app, request)
+        if session is None or '_sid' not in session:
+            return session
+        row = self.storage.load_session(session['_sid'])
+        if row is None or row[1] < time.time():
+            # Сессия истекла или из неё вышли - пользователь становится гостем
+            return self.session_class()
+        return self.session_class(self.serializer.loads(row[0]), sid=session['_sid'], expires=row[1])
+
+    def save_session(self, app, session, response):
+        if 'user_id' not in session:
+            if session.sid is not None:
+                self.storage.delete_session(session.sid)
+                session.sid = None
+                session.modified = True
+            return super().save_session(app, session, response)
+        if session.accessed:
+            response.vary.add('Cookie')
+        now = time.time()
+        lifetime = app.permanent_session_lifetime.total_seconds()
+        if session.sid is None or session.owner != session['user_id']:
+            # Новый sid при входе: прежний мог быть известен кому-то ещё (фиксация сессии)
+            if session.sid is not None:
+                self.storage.delete_session(session.sid)
+            session.sid = secrets.token_urlsafe(32)
+            session.owner = session['user_id']
+        elif not session.modified and session.expires - now > lifetime / 2:
+            return
+        session.expires = now + lifetime
+        self.storage.save_session(session.sid, self.serializer.dumps(dict(session)), session.expires)
+        response.set_cookie(
+            self.get_cookie_name(app),
+            self.get_signing_serializer(app).dumps({'_sid': session.sid}),
+            expires=self.get_expiration_time(app, session),
+            httponly=self.get_cookie_httponly(app),
+            domain=self.get_cookie_domain(app),
+            path=self.get_cookie_path(app),
+            secure=self.get_cookie_secure(app),
+            samesite=self.get_cookie_samesite(app),
+        )
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name='session-sweep', daemon=True)
+            self.thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(app.config['SESSION_SWEEP_INTERVAL'])
+            try:
+                removed = self.storage.prune_sessions(time.time())
+                if removed:
+                    app.logger.info("Removed %s expired sessions", removed)
+            except Exception as e:
+                app.logger.exception("Error sweeping sessions: %s", e)
+
+    def reset_after_fork(self):
+        self.thread = None
+
+app.session_interface = HybridSessionInterface(storage)
+
+# ======================
+# Middleware и фильтры
+# ======================
+@app.before_request
+def load_current_user():
+    """Вошедший пользователь, один раз на запрос: g.current_user (None для гостя)"""
+    g.current_user = users.get(session['user_id']) if 'user_id' in session else None
+
+@app.before_request
+def check_ip():
+    """Проверка IP на блокировку"""
+    client_ip = request.remote_addr
+    if request.path.startswith('/static'):
+        return None
+    if client_ip and blocklist.is_ip_blocked(client_ip):
+        return render_template('ip_not_allowed.html')
+    return None
+
+@app.before_request
+def check_ban_acc():
+    """Проверка блокировки аккаунта"""
+    user_id = session.get('user_id')
+    if request.path.startswith('/static'):
+        return None
+    if request.path.startswith('/logout'):
+        return None
+    if user_id and blocklist.is_account_blocked(user_id):
+        return render_template('you_are_banned.html', user_id=user_id, user=g.current_user)
+
+@app.template_filter('format_number')
+def format_number(number):
+    """Фильтр для форматирования чисел"""
+    if number >= 1_000_000_000:
+        return f"{number / 1_000_000_000:.1f} млрд."
+    elif number >= 1_000_000:
+        return f"{number / 1_000_000:.1f} млн."
+    elif number >= 1_000:
+        return f"{number / 1_000:.1f} тыс."
+    else:
+        return str(number)
+
+# ======================
+# Лента видео
+# ======================
+FEED_PAGE_SIZE = 24
+
+class RankedFeed:
+    """Лента видео, отсортированная по рейтингу (лайки - дизлайки) и обновляемая на месте"""
+
+    def __init__(self, records=()):
+        self.lock = threading.Lock()
+        self.keys = []
+        self.videos = {}
+        for video in records:
+            self.add(video)
+
+    @staticmethod
+    def rank_key(video):
+        # При равном рейтинге выше видео с большим числом просмотров, затем более ранние загрузки
+        return (video['dislikes'] - video['likes'], -video.get('views', 0), video['upload_date'], video['id'])
+
+    def add(self, video):
+        key = self.rank_key(video)
+        with self.lock:
+            bisect.insort(self.keys, key)
+            self.videos[video['id']] = (key, video)
+
+    def remove(self, video):
+        with self.lock:
+            entry = self.videos.pop(video['id'], None)
+            if entry is not None:
+                i = bisect.bisect_left(self.keys, entry[0])
+                del self.keys[i]
+
+    def update(self, video):
+        """Перемещение видео после изменения лайков/дизлайков"""
+        self.remove(video)
+        self.add(video)
+
+    def page(self, cursor=None, limit=FEED_PAGE_SIZE):
+        """Страница ленты после курсора и курсор следующей страницы"""
+        with self.lock:
+            start = bisect.bisect_right(self.keys, decode_cursor(cursor)) if cursor else 0
+            keys = self.keys[start:start + limit]
+            page = [self.videos[key[-1]][1] for key in keys]
+            more = start + limit < len(self.keys)
+        return page, encode_cursor(keys[-1]) if keys and more else None
+
+    def page_at(self, offset, limit=FEED_PAGE_SIZE):
+        """Страница ленты по смещению (для старых клиентов)"""
+        with self.lock:
+            keys = self.keys[offset:offset + limit]
+            page = [self.videos[key[-1]][1] for key in keys]
+            more = offset + limit < len(self.keys)
+        return page, encode_cursor(keys[-1]) if keys and more else None
+
+def encode_cursor(key):
+    """Курсор страницы - позиция последнего показанного видео"""
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode().rstrip('=')
+
+def decode_cursor(cursor):
+    raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+    return tuple(json.loads(raw))
+
+def with_relative_time(page):
+    """Копии видео страницы с относительным временем загрузки"""
+    return [video.view(relative_time=time_ago(datetime.fromisoformat(video['upload_date']))) for video in page]
+
+# ======================
+# Лента подписок
+# ======================
+INBOX_SIZE = 1000 # видео во входящих одного пользователя, старые выпадают
+INBOX_BACKFILL = 50 # последних видео канала попадают во входящие при подписке
+FANOUT_MAX_SUBSCRIBERS = 10_000 # каналы крупнее не рассылают видео, их видео подмешиваются при чтении
+
+class SubscriptionFeed:
+    """Лента подписок на входящих пользователей (fan-out on write)
+
+    Опубликованное видео сразу дописывается во входящие всех подписчиков
+    канала, и страница ленты - это один запрос по индексу (user_id, дата).
+    Каналы, у которых подписчиков больше FANOUT_MAX_SUBSCRIBERS, видео не
+    рассылают: их свежие видео подмешиваются при чтении (гибридная схема).
+    """
+
+    def __init__(self, storage, channels):
+        self.storage = storage
+        self.lock = threading.Lock()
+        self.large_channels = set()
+        for channel in channels:
+            self.channel_changed(channel)
+
+    @staticmethod
+    def entry(video):
+        return (video['upload_date'], video['id'])
+
+    def channel_changed(self, channel):
+        """Учёт крупных каналов после изменения числа подписчиков"""
+        with self.lock:
+            if len(channel.get('subscribers', ())) > FANOUT_MAX_SUBSCRIBERS:
+                self.large_channels.add(channel['id'])
+            else:
+                self.large_channels.discard(channel['id'])
+
+    def channel_videos(self, channel_id, before=None, limit=INBOX_BACKFILL):
+        """Последние видео канала (до позиции before), от новых к старым"""
+        keys = sorted((self.entry(video) for video in videos.find('channel_id', channel_id)), reverse=True)
+        return [key for key in keys if before is None or key < before][:limit]
+
+    def publish(self, video):
+        """Рассылка нового видео подписчикам канала (повторная ничего не задваивает)"""
+        with state_lock:
+            channel = channels.get(video['channel_id'])
+            if channel is None or channel['id'] in self.large_channels:
+                return
+            # Копия: множество подписчиков меняют обработчики запросов
+            subscribers = list(channel['subscribers'])
+        self.storage.add_to_inboxes([(user_id, video['upload_date'], video['id'], channel['id'])
+                                     for user_id in subscribers], INBOX_SIZE)
+
+    def follow(self, user_id, channel):
+        """Последние видео канала во входящие нового подписчика"""
+        self.storage.add_to_inboxes([(user_id, upload_date, video_id, channel['id'])
+                                     for upload_date, video_id in self.channel_videos(channel['id'])], INBOX_SIZE)
+
+    def unfollow(self, user_id, channel):
+        self.storage.remove_from_inbox(user_id, channel['id'])
+
+    def page(self, user_id, cursor=None, limit=FEED_PAGE_SIZE):
+        """Страница ленты подписок после курсора и курсор следующей страницы"""
+        before = decode_cursor(cursor) if cursor else None
+        # Курсор приходит от клиента: в запрос к базе попадает только пара (дата, id)
+        if before is not None and (len(before) != 2 or not all(isinstance(part, str) for part in before)):
+            raise ValueError(f"Invalid cursor: {cursor}")
+        keys = set(map(tuple, self.storage.inbox_page(user_id, before, limit + 1)))
+        with self.lock:
+            large = [channels.get(channel_id) for channel_id in self.large_channels]
+        for channel in large:
+            if channel is not None and user_id in channel['subscribers']:
+                keys.update(self.channel_videos(channel['id'], before, limit + 1))
+        keys = sorted(keys, reverse=True)
+        # Видео, которое ещё не подтянулось из другого процесса или уже удалено, пропускается
+        page = [video for video in (videos.get(video_id) for _, video_id in keys[:limit]) if video is not None]
+        return page, encode_cursor(keys[limit - 1]) if len(keys) > limit else None
+
+    def rebuild(self):
+        """Пересборка всех входящих по подпискам каналов и их видео"""
+        inboxes = {}
+        with state_lock:
+            for channel in channels:
+                if channel['id'] in self.large_channels or not channel.get('subscribers'):
+                    continue
+                recent = self.channel_videos(channel['id'], limit=INBOX_SIZE)
+                for user_id in channel['subscribers']:
+                    inboxes.setdefault(user_id, []).extend((upload_date, video_id, channel['id']) for upload_date, video_id in recent)
+        rows = [(user_id, *entry) for user_id, entries in inboxes.items() for entry in sorted(entries, reverse=True)[:INBOX_SIZE]]
+        self.storage.replace_inboxes(rows)
+        return len(inboxes), len(rows)
+
+@app.cli.command('rebuild-inboxes')
+def rebuild_inboxes_command():
+    """Пересборка входящих ленты подписок из channels.json и видео"""
+    users_count, rows = subscription_feed.rebuild()
+    click.echo(f"Rebuilt inboxes of {users_count} users ({rows} entries)")
+
+# ======================
+# Поиск
+# ======================
+SEARCH_FIELD_WEIGHTS = {'title': 2.0, 'description': 1.0}
+SEARCH_CACHE_SIZE = 256
+SEARCH_PREFIX_LIMIT = 50
+
+# Окончания для простого стемминга (от длинных к коротким)
+RU_SUFFIXES = sorted([
+    'иями', 'ями', 'ами', 'ией', 'ий', 'ый', 'ой', 'ая', 'яя', 'ое', 'ее', 'ие', 'ые', 'ого', 'его', 'ому', 'ему',
+    'ым', 'им', 'ых', 'их', 'ую', 'юю', 'ов', 'ев', 'ей', 'ам', 'ям', 'ах', 'ях', 'ом', 'ем', 'ия', 'ья', 'ью',
+    'ать', 'ять', 'ить', 'еть', 'ешь', 'ет', 'ют', 'ут', 'ит', 'ат', 'ят', 'ла', 'ло', 'ли',
+    'а', 'я', 'о', 'е', 'и', 'ы', 'у', 'ю', 'ь', 'й',
+], key=len, reverse=True)
+EN_SUFFIXES = ['ingly', 'edly', 'ing', 'ies', 'ied', 'es', 'ed', 'ly', 's']
+TAG_RE = re.compile(r'<[^>]+>')
+WORD_RE = re.compile(r'\w+')
+CYRILLIC_RE = re.compile('[а-я]')
+
+def normalize_text(text):
+    """Приведение текста к нижнему регистру, ё -> е, без HTML разметки"""
+    return html.unescape(TAG_RE.sub(' ', text)).lower().replace('ё', 'е')
+
+def stem(word):
+    """Простой стемминг: отбрасывание окончания с сохранением основы от 3 символов"""
+    suffixes = RU_SUFFIXES if CYRILLIC_RE.search(word) else EN_SUFFIXES
+    for suffix in suffixes:
+        if word.endswith(suffix) and len(word) - len(suffix) >= 3:
+            return word[:-len(suffix)]
+    return word
+
+def tokenize(text):
+    return [stem(word) for word in WORD_RE.findall(normalize_text(text))]
+
+class SearchIndex:
+    """Инвертированный индекс по названию и описанию видео с ранжированием BM25"""
+
+    k1 = 1.2
+    b = 0.75
+
+    def __init__(self, records=()):
+        self.lock = threading.Lock()
+        self.postings = {}
+        self.terms = []
+        self.doc_terms = {}
+        self.doc_len = {}
+        self.total_len = 0.0
+        self.order = {}
+        self.cache = OrderedDict()
+        for video in records:
+            self.add(video)
+
+    def add(self, video):
+        weights = {}
+        for field, weight in SEARCH_FIELD_WEIGHTS.items():
+            for term in tokenize(video.get(field, '')):
+                weights[term] = weights.get(term, 0.0) + weight
+        with self.lock:
+            self._remove(video['id'])
+            for term, tf in weights.items():
+                if term not in self.postings:
+                    self.postings[term] = {}
+                    bisect.insort(self.terms, term)
+                self.postings[term][video['id']] = tf
+            self.doc_terms[video['id']] = list(weights)
+            self.doc_len[video['id']] = sum(weights.values())
+            self.total_len += self.doc_len[video['id']]
+            self.order.setdefault(video['id'], len(self.order))
+            self.cache.clear()
+
+    def remove(self, video):
+        with self.lock:
+            self._remove(video['id'])
+            self.order.pop(video['id'], None)
+            self.cache.clear()
+
+    def _remove(self, video_id):
+        for term in self.doc_terms.pop(video_id, ()):
+            postings = self.postings[term]
+            postings.pop(video_id, None)
+            if not postings:
+                del self.postings[term]
+                del self.terms[bisect.bisect_left(self.terms, term)]
+        self.total_len -= self.doc_len.pop(video_id, 0.0)
+
+    def _expand(self, word, prefix):
+        terms = {stem(word)}
+        if prefix:
+            i = bisect.bisect_left(self.terms, word)
+            while i < len(self.terms) and self.terms[i].startswith(word) and len(terms) <= SEARCH_PREFIX_LIMIT:
+                terms.add(self.terms[i])
+                i += 1
+        return [term for term in terms if term in self.postings]
+
+    def search(self, query):
+        """Идентификаторы видео по запросу, от самых релевантных"""
+        words = WORD_RE.findall(normalize_text(query))
+        if not words:
+            return []
+        # Последнее слово дополняется по префиксу, пока его набирают
+        prefix = not query[-1:].isspace()
+        cache_key = (' '.join(words), prefix)
+        with self.lock:
+            if cache_key in self.cache:
+                CACHE_REQUESTS.inc(cache='search', result='hit')
+                self.cache.move_to_end(cache_key)
+                return self.cache[cache_key]
+            CACHE_REQUESTS.inc(cache='search', result='miss')
+            count = len(self.doc_len)
+            avg_len = self.total_len / count if count else 0.0
+            scores = {}
+            for i, word in enumerate(words):
+                best = {}
+                for term in self._expand(word, prefix and i == len(words) - 1):
+                    postings = self.postings[term]
+                    idf = math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+                    for video_id, tf in postings.items():
+                        norm = tf * (self.k1 + 1) / (tf + self.k1 * (1 - self.b + self.b * self.doc_len[video_id] / avg_len))
+                        best[video_id] = max(best.get(video_id, 0.0), idf * norm)
+                for video_id, score in best.items():
+                    scores[video_id] = scores.get(video_id, 0.0) + score
+            result = sorted(scores, key=lambda video_id: (-scores[video_id], self.order[video_id]))
+            self.cache[cache_key] = result
+            if len(self.cache) > SEARCH_CACHE_SIZE:
+                self.cache.popitem(last=False)
+            return result
+
+# ======================
+# Похожие видео
+# ======================
+RELATED_COUNT = 12 # похожих видео на одно видео
+RELATED_TEXT_WEIGHT = 1.0 # вклад сходства названий и описаний (TF-IDF, косинус)
+RELATED_COLIKE_WEIGHT = 0.5 # вклад общих лайков (косинус по множествам лайкнувших)
+RELATED_CHANNEL_WEIGHT = 0.2 # надбавка за тот же канал
+RELATED_MAX_POSTINGS = 5000 # слова и пользователи, встречающиеся чаще, не учитываются (почти не различают видео)
+RELATED_CHECK_INTERVAL = 30 # как часто проверять, не пересобрал ли RELATED_FILE другой процесс, секунд
+RELATED_LOCK_FILE = f"{RELATED_FILE}.lock" # держит процесс, который сейчас пересобирает RELATED_FILE
+RELATED_DTYPE = np.dtype([('index', '<i4'), ('score', '<f4')])
+
+class RelatedModel:
+    """Разреженные векторы видео (слова, лайкнувшие) для подсчёта сходства с остальными
+
+    Строится целиком при пересборке, дальше меняется по строкам (refresh): у
+    пересчитанных видео IDF берётся по текущим частотам слов, у остальных
+    остаётся прежним до следующей полной пересборки.
+    """
+
+    def __init__(self, video_records, vote_records):
+        self.ids = []
+        self.position = {}
+        # По строкам: веса слов до IDF, нормированный вектор TF-IDF, канал, лайкнувшие
+        self.terms = []
+        self.vectors = []
+        self.channels = []
+        self.likers = []
+        self.like_norms = []
+        self.df = {}
+        # слово -> {строка: вес}, пользователь -> {строки}, канал -> {строки}
+        self.postings = {}
+        self.liked = {}
+        self.channel_rows = {}
+        # Массивы numpy для scores(), строятся по требованию и сбрасываются при изменении
+        self.arrays = {}
+        self.refresh({video['id']: video for video in video_records},
+                     {record['video_id']: record['likes'] for record in vote_records})
+
+    @staticmethod
+    def term_weights(video):
+        """Веса слов по тем же словам и весам полей, что и в поиске"""
+        terms = {}
+        for field, weight in SEARCH_FIELD_WEIGHTS.items():
+            for term in tokenize(video.get(field) or ''):
+                terms[term] = terms.get(term, 0.0) + weight
+        return terms
+
+    def refresh(self, changed, likers):
+        """Пересчёт строк видео: changed - {id: поля видео или None, если удалено}, likers - {id: лайкнувшие}"""
+        rows = []
+        for video_id, video in changed.items():
+            if video is None:
+                self.remove(video_id)
+                continue
+            i = self.row(video_id)
+            self.set_terms(i, self.term_weights(video))
+            self.set_channel(i, video['channel_id'])
+            rows.append((i, likers.get(video_id, ())))
+        # Векторы - после всех слов: IDF по уже обновлённым частотам
+        for i, row_likers in rows:
+            self.set_vector(i)
+            self.set_likers(i, row_likers)
+
+    def row(self, video_id):
+        i = self.position.get(video_id)
+        if i is None:
+            i = len(self.ids)
+            self.ids.append(video_id)
+            self.position[video_id] = i
+            self.terms.append({})
+            self.vectors.append({})
+            self.channels.append(None)
+            self.likers.append(())
+            self.like_norms.append(0.0)
+            self.arrays.pop('like_norm', None)
+        return i
+
+    def remove(self, video_id):
+        """Удалённое видео: строка остаётся пустой и ни с чем не схожей"""
+        i = self.position.pop(video_id, None)
+        if i is None:
+            return
+        self.set_terms(i, {})
+        self.set_vector(i)
+        self.set_channel(i, None)
+        self.set_likers(i, ())
+
+    def set_terms(self, i, terms):
+        for term in self.terms[i]:
+            self.df[term] -= 1
+            if not self.df[term]:
+                del self.df[term]
+        for term in terms:
+            self.df[term] = self.df.get(term, 0) + 1
+        self.terms[i] = terms
+
+    def set_vector(self, i):
+        for term in self.vectors[i]:
+            self.postings[term].pop(i, None)
+            self.arrays.pop(('term', term), None)
+        count = len(self.position)
+        vector = {term: tf * (math.log((1 + count) / (1 + self.df[term])) + 1) for term, tf in self.terms[i].items()
+                  if self.df[term] <= RELATED_MAX_POSTINGS}
+        norm = math.sqrt(sum(w * w for w in vector.values())) or 1.0
+        self.vectors[i] = {term: w / norm for term, w in vector.items()}
+        for term, w in self.vectors[i].items():
+            self.postings.setdefault(term, {})[i] = w
+            self.arrays.pop(('term', term), None)
+
+    def set_channel(self, i, channel_id):
+        previous = self.channels[i]
+        if previous is not None:
+            self.channel_rows[previous].discard(i)
+            self.arrays.pop(('channel', previous), None)
+        if channel_id is not None:
+            self.channel_rows.setdefault(channel_id, set()).add(i)
+            self.arrays.pop(('channel', channel_id), None)
+        self.channels[i] = channel_id
+
+    def set_likers(self, i, likers):
+        likers = tuple(likers)
+        old, new = set(self.likers[i]), set(likers)
+        for user_id in old - new:
+            self.liked[user_id].discard(i)
+            self.arrays.pop(('user', user_id), None)
+        for user_id in new - old:
+            self.liked.setdefault(user_id, set()).add(i)
+            self.arrays.pop(('user', user_id), None)
+        self.likers[i] = likers
+        self.like_norms[i] = 1 / math.sqrt(len(likers)) if likers else 0.0
+        self.arrays.pop('like_norm', None)
+
+    def array(self, kind, key):
+        """Строки (и веса для слов) из словарей в виде массивов numpy"""
+        cached = self.arrays.get((kind, key))
+        if cached is None:
+            if kind == 'term':
+                postings = self.postings[key]
+                cached = (np.fromiter(postings.keys(), dtype=np.int32, count=len(postings)),
+                          np.fromiter(postings.values(), dtype=np.float32, count=len(postings)))
+            else:
+                rows = self.liked[key] if kind == 'user' else self.channel_rows[key]
+                cached = np.fromiter(rows, dtype=np.int32, count=len(rows))
+            self.arrays[(kind, key)] = cached
+        return cached
+
+    def like_norm(self):
+        cached = self.arrays.get('like_norm')
+        if cached is None:
+            cached = self.arrays['like_norm'] = np.array(self.like_norms, dtype=np.float32)
+        return cached
+
+    def scores(self, i):
+        """Сходство видео i со всеми видео (с собой - 0)"""
+        scores = np.zeros(len(self.ids), dtype=np.float32)
+        for term, w in self.vectors[i].items():
+            rows, ws = self.array('term', term)
+            scores[rows] += w * ws
+        scores *= RELATED_TEXT_WEIGHT
+        if self.like_norms[i]:
+            colikes = np.zeros(len(self.ids), dtype=np.float32)
+            for user_id in self.likers[i]:
+                # Пользователи, лайкающие почти всё, не различают видео
+                if len(self.liked[user_id]) <= RELATED_MAX_POSTINGS:
+                    colikes[self.array('user', user_id)] += 1
+            like_norm = self.like_norm()
+            scores += RELATED_COLIKE_WEIGHT * like_norm[i] * colikes * like_norm
+        if self.channels[i] is not None:
+            scores[self.array('channel', self.channels[i])] += RELATED_CHANNEL_WEIGHT
+        scores[i] = 0
+        return scores
+
+    def top(self, i, k=RELATED_COUNT):
+        """k самых похожих на видео i: (строки, оценки) по убыванию оценки"""
+        scores = self.scores(i)
+        candidates = np.flatnonzero(scores > 0)
+        if len(candidates) > k:
+            candidates = candidates[np.argpartition(-scores[candidates], k - 1)[:k]]
+        order = candidates[np.argsort(-scores[candidates], kind='stable')]
+        return order, scores[order]
+
+class RelatedVideos:
+    """Похожие видео: матрица top-k в RELATED_FILE (mmap) и правки поверх неё
+
+    Целиком матрица пересобирается в фоне раз в RELATED_REBUILD_INTERVAL.
+    Новое видео или изменившиеся голоса пересчитываются пачкой почти сразу:
+    строка самого видео и строки соседей, в которые оно теперь попадает,
+    хранятся в patches до следующей пересборки.
+    """
+
+    def __init__(self, path, ids_path):
+        self.path = path
+        self.ids_path = ids_path
+        self.lock = threading.Lock()
+        self.ids = []
+        self.position = {}
+        self.matrix = None
+        self.built_at = 0.0
+        self.mtime = None
+        self.checked_at = 0.0
+        # video_id -> (время правки, [(id похожего, оценка)])
+        self.patches = {}
+        self.fingerprints = {}
+        self.dirty = set()
+        # Модель последней пересборки, дальше пересчитываемая по изменившимся видео
+        self.model = None
+        self.wakeup = threading.Event()
+        self.thread = None
+        self.reload_if_changed(force=True)
+
+    def reload_if_changed(self, force=False):
+        """Подхват файла, пересобранного этим или другим процессом"""
+        now = time.monotonic()
+        if not force and now - self.checked_at < RELATED_CHECK_INTERVAL:
+            return
+        self.checked_at = now
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+            if mtime == self.mtime:
+                return
+            with open(self.ids_path, 'r') as f:
+                meta = json.load(f)
+            matrix = np.load(self.path, mmap_mode='r')
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            app.logger.error("Error reading %s: %s", self.path, e)
+            return
+        if matrix.shape[0] != len(meta['ids']):
+            # Файлы от разных пересборок - второй ещё дописывается
+            return
+        with self.lock:
+            self.mtime = mtime
+            self.matrix = matrix
+            self.ids = meta['ids']
+            self.position = {video_id: i for i, video_id in enumerate(self.ids)}
+            self.built_at = meta['built_at']
+            # Правки, сделанные после снимка данных для пересборки, ещё нужны
+            self.patches = {video_id: patch for video_id, patch in self.patches.items() if patch[0] > self.built_at}
+
+    def _current(self, video_id):
+        patch = self.patches.get(video_id)
+        if patch is not None:
+            return patch[1]
+        row = self.position.get(video_id)
+        if row is None or self.matrix is None:
+            return []
+        return [(self.ids[i], float(score)) for i, score in self.matrix[row] if i >= 0]
+
+    def get(self, video_id, limit=RELATED_COUNT):
+        """Похожие на video_id видео, от самых похожих"""
+        self.reload_if_changed()
+        with self.lock:
+            related = self._current(video_id)[:limit]
+        return [video for video in (videos.get(related_id) for related_id, _ in related) if video is not None]
+
+    @staticmethod
+    def fingerprint(video):
+        return (video.get('title'), video.get('description'), video.get('channel_id'))
+
+    def load(self, records):
+        self.fingerprints = {video['id']: self.fingerprint(video) for video in records}
+
+    def video_changed(self, video):
+        """Новое видео или изменённые название/описание - в очередь на пересчёт"""
+        fingerprint = self.fingerprint(video) if videos.get(video['id']) is video else None
+        if self.fingerprints.get(video['id']) != fingerprint:
+            self.fingerprints[video['id']] = fingerprint
+            self.mark(video['id'])
+
+    def votes_changed(self, record):
+        self.mark(record['video_id'])
+
+    def mark(self, video_id):
+        with self.lock:
+            self.dirty.add(video_id)
+        self.wakeup.set()
+
+    @staticmethod
+    def model_fields(video):
+        """Поля видео, нужные модели (копия: запись меняют обработчики запросов)"""
+        return {'id': video['id'], 'channel_id': video['channel_id'], **{field: video.get(field) for field in SEARCH_FIELD_WEIGHTS}}
+
+    def snapshot(self):
+        """Модель по копии нужных полей: под state_lock только копирование, построение - без блокировки"""
+        with state_lock:
+            video_records = [self.model_fields(video) for video in videos]
+            vote_records = [{'video_id': record['video_id'], 'likes': tuple(record['likes'])}
+                            for record in likes_dislikes if record.get('likes')]
+        return RelatedModel(video_records, vote_records)
+
+    def refresh_model(self, dirty):
+        """Последняя модель с пересчитанными строками dirty (первый раз в процессе - построение целиком)"""
+        if self.model is None:
+            self.model = self.snapshot()
+            return self.model
+        changed = {}
+        likers = {}
+        with state_lock:
+            for video_id in dirty:
+                video = videos.get(video_id)
+                changed[video_id] = self.model_fields(video) if video is not None else None
+                record = likes_dislikes.get(video_id)
+                if record is not None:
+                    likers[video_id] = tuple(record['likes'])
+        self.model.refresh(changed, likers)
+        return self.model
+
+    def due(self):
+        return time.time() - self.built_at >= app.config['RELATED_REBUILD_INTERVAL']
+
+    def build(self, force=True):
+        """Полная пересборка RELATED_FILE по всем видео
+
+        Собирает один процесс за раз (flock на RELATED_LOCK_FILE); остальные
+        подхватывают готовый файл. Возвращает число видео или None, если
+        сборка идёт в другом процессе либо (без force) файл уже свежий.
+        """
+        with process_lock(RELATED_LOCK_FILE, blocking=force) as locked:
+            if not locked:
+                return None
+            # Пока ждали блокировку, файл мог пересобрать другой процесс
+            self.reload_if_changed(force=True)
+            if not force and not self.due():
+                return None
+            built_at = time.time()
+            with self.lock:
+                self.dirty.clear()
+            model = self.snapshot()
+            with atomic_write(self.path) as tmp_path:
+                matrix = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=RELATED_DTYPE, shape=(len(model.ids), RELATED_COUNT))
+                matrix['index'] = -1
+                matrix['score'] = 0
+                for i in range(len(model.ids)):
+                    rows, scores = model.top(i)
+                    matrix['index'][i, :len(rows)] = rows
+                    matrix['score'][i, :len(rows)] = scores
+                matrix.flush()
+                del matrix
+                with atomic_write(self.ids_path) as ids_tmp_path:
+                    with open(ids_tmp_path, 'w') as f:
+                        json.dump({'built_at': built_at, 'ids': model.ids}, f)
+        self.model = model
+        self.reload_if_changed(force=True)
+        return len(model.ids)
+
+    def update(self):
+        """Пересчёт видео из очереди и добавление их в списки соседей"""
+        with self.lock:
+            dirty = self.dirty
+            self.dirty = set()
+        if not dirty:
+            return
+        model = self.refresh_model(dirty)
+        now = time.time()
+        for video_id in dirty:
+            i = model.position.get(video_id)
+            if i is None:
+                continue
+            rows, scores = model.top(i)
+            related = [(model.ids[j], float(score)) for j, score in zip(rows, scores)]
+            with self.lock:
+                self.patches[video_id] = (now, related)
+                # Сходство симметрично: видео может вытеснить худшего соседа у тех, на кого похоже
+                for related_id, score in related:
+                    current = [entry for entry in self._current(related_id) if entry[0] != video_id]
+                    if len(current) < RELATED_COUNT or score > current[-1][1]:
+                        current.append((video_id, score))
+                        current.sort(key=lambda entry: -entry[1])
+                        self.patches[related_id] = (now, current[:RELATED_COUNT])
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name='related-videos', daemon=True)
+            self.thread.start()
+
+    def _run(self):
+        while True:
+            # Без файла или с устаревшим файлом - пересборка; если собирает другой процесс, проверяем снова позже
+            timeout = RELATED_CHECK_INTERVAL
+            try:
+                self.reload_if_changed()
+                if self.due():
+                    self.build(force=False)
+                else:
+                    self.update()
+                if not self.due():
+                    timeout = self.built_at + app.config['RELATED_REBUILD_INTERVAL'] - time.time()
+            except Exception as e:
+                app.logger.exception("Error updating related videos: %s", e)
+            self.wakeup.wait(max(0.0, timeout))
+            self.wakeup.clear()
+            # Пачка голосов или загрузок - один пересчёт
+            time.sleep(app.config['RELATED_UPDATE_DELAY'])
+
+    def reset_after_fork(self):
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = None
+
+@app.cli.command('build-related')
+def build_related_command():
+    """Пересборка похожих видео"""
+    count = related_videos.build()
+    click.echo(f"Related videos built for {count} videos")
+
+# ======================
+# Комментарии
+# ======================
+COMMENTS_PAGE_SIZE = 20
+REPLIES_PAGE_SIZE = 5
+COMMENT_ORDERS = ('top', 'newest')
+
+class CommentIndex:
+    """Комментарии каждого видео в двух порядках: лучшие и новые, с курсорной выдачей страниц"""
+
+    def __init__(self, comments):
+        self.comments = comments
+        self.lock = threading.Lock()
+        # video_id -> {порядок: отсортированный список ключей}
+        self.orders = {}
+        # comment_id -> (video_id, ключи в каждом порядке)
+        self.entries = {}
+        for comment in comments:
+            self.add(comment)
+
+    @staticmethod
+    def order_keys(comment):
+        """Ключи сортировки: лучшие - больше лайков, при равенстве раньше написанные; новые - больший id"""
+        return {'top': (-comment['likes'], comment['id']), 'newest': (-comment['id'],)}
+
+    def add(self, comment):
+        if 'user_id' not in comment:
+            return
+        keys = self.order_keys(comment)
+        with self.lock:
+            orders = self.orders.setdefault(comment['video_id'], {order: [] for order in COMMENT_ORDERS})
+            for order, key in keys.items():
+                bisect.insort(orders[order], key)
+            self.entries[comment['id']] = (comment['video_id'], keys)
+
+    def remove(self, comment_id):
+        with self.lock:
+            entry = self.entries.pop(comment_id, None)
+            if entry is None:
+                return
+            video_id, keys = entry
+            orders = self.orders[video_id]
+            for order, key in keys.items():
+                del orders[order][bisect.bisect_left(orders[order], key)]
+
+    def changed(self, comment):
+        """Переупорядочивание после сохранения комментария (лайки) или его удаления"""
+        self.remove(comment['id'])
+        if self.comments.get(comment['id']) is comment:
+            self.add(comment)
+
+    def count(self, video_id):
+        with self.lock:
+            orders = self.orders.get(video_id)
+            return len(orders['top']) if orders else 0
+
+    def page(self, video_id, order='top', cursor=None, limit=COMMENTS_PAGE_SIZE):
+        """Страница комментариев видео после курсора и курсор следующей страницы"""
+        if order not in COMMENT_ORDERS:
+            raise ValueError(order)
+        with self.lock:
+            keys = self.orders.get(video_id, {}).get(order, [])
+            start = bisect.bisect_right(keys, decode_cursor(cursor)) if cursor else 0
+            page = keys[start:start + limit]
+            has_more = start + limit < len(keys)
+        comment_ids = [key[-1] if order == 'top' else -key[0] for key in page]
+        next_cursor = encode_cursor(page[-1]) if page and has_more else None
+        return [self.comments.get(comment_id) for comment_id in comment_ids], next_cursor
+
+def reply_page(comment, cursor=None, limit=REPLIES_PAGE_SIZE):
+    """Страница ответов на комментарий (по возрастанию id) и курсор следующей страницы"""
+    replies = comment.get('sub_comments', [])
+    start = bisect.bisect_right(replies, int(cursor), key=lambda reply: reply['id']) if cursor else 0
+    page = replies[start:start + limit]
+    next_cursor = str(page[-1]['id']) if page and start + limit < len(replies) else None
+    return page, next_cursor
+
+# ======================
+# Голоса
+# ======================
+class VoteStore:
+    """Голоса за видео или комментарии: множества проголосовавших и счётчики из их размеров"""
+
+    def __init__(self, records, targets, key):
+        self.records = records
+        self.targets = targets
+        self.key = key
+        # Счётчики в видео/комментариях всегда равны размерам множеств
+        for target in targets:
+            self.update_counts(target)
+
+    def update_counts(self, target):
+        record = self.records.get(target['id'])
+        target['likes'] = len(record['likes']) if record else 0
+        target['dislikes'] = len(record['dislikes']) if record else 0
+
+    def vote(self, target, user_id, action):
+        """Лайк/дизлайк: повторный голос снимает его, противоположный - заменяет
+
+        Возвращает запись голосов и изменения множеств для слияния при сохранении.
+        """
+        record = self.records.get(target['id'])
+        if record is None:
+            record = {self.key: target['id'], 'likes': set(), 'dislikes': set()}
+            self.records.append(record)
+        chosen, opposite = ('likes', 'dislikes') if action == 'like' else ('dislikes', 'likes')
+        record[opposite].discard(user_id)
+        if user_id in record[chosen]:
+            record[chosen].discard(user_id)
+        else:
+            record[chosen].add(user_id)
+        self.update_counts(target)
+        return record, {chosen: {user_id: user_id in record[chosen]}, opposite: {user_id: False}}
+
+    def synced(self, record, deleted):
+        """Пересчёт счётчиков после изменения голосов другим процессом"""
+        target = self.targets.get(record[self.key])
+        if target is not None:
+            self.update_counts(target)
+
+def prepare_votes(record):
+    record['likes'] = set(record.get('likes', []))
+    record['dislikes'] = set(record.get('dislikes', []))
+
+def prepare_channel(record):
+    record['subscribers'] = set(record.get('subscribers', []))
+
+# ======================
+# Просмотры
+# ======================
+VIEW_COUNTER_SHARDS = 16
+VIEW_DEDUPE_SIZE = 100000
+
+def view_buckets(moment):
+    """Корзины статистики для момента просмотра: за всё время, час и сутки"""
+    return ('total', moment.strftime('h:%Y-%m-%dT%H'), moment.strftime('d:%Y-%m-%d'))
+
+class ViewCounter:
+    """Подсчёт просмотров: отсев повторов, шардированные счётчики в памяти, периодический сброс
+
+    Просмотры копятся в памяти и раз в VIEW_FLUSH_INTERVAL прибавляются в хранилище
+    к счётчикам видео и канала за всё время, по часам и по суткам. После сброса
+    подтягиваются счётчики, изменённые другими процессами.
+    """
+
+    def __init__(self, videos):
+        self.videos = videos
+        self.shards = [(threading.Lock(), {}) for _ in range(VIEW_COUNTER_SHARDS)]
+        self.seen = TTLCache(VIEW_DEDUPE_SIZE, app.config['VIEW_DEDUPE_WINDOW'], name='view_dedupe')
+        # (scope, id, bucket) -> просмотры; scope - 'video' или 'channel'
+        self.stats = {}
+        self.stats_lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.loaded_at = 0.0
+        self.last_prune = 0.0
+        self.thread = None
+
+    def record(self, video_id, viewer):
+        """Учёт просмотра; False - этот зритель уже смотрел видео недавно"""
+        if self.seen.get((viewer, video_id)):
+            return False
+        self.seen.set((viewer, video_id), True)
+        lock, counts = self.shards[hash(video_id) % VIEW_COUNTER_SHARDS]
+        with lock:
+            counts[video_id] = counts.get(video_id, 0) + 1
+        return True
+
+    def drain(self):
+        pending = {}
+        for lock, counts in self.shards:
+            with lock:
+                for video_id, count in counts.items():
+                    pending[video_id] = pending.get(video_id, 0) + count
+                counts.clear()
+        return pending
+
+    def flush(self):
+        with self.flush_lock:
+            pending = self.drain()
+            if pending:
+                buckets = view_buckets(datetime.now())
+                deltas = {}
+                for video_id, count in pending.items():
+                    video = self.videos.get(video_id)
+                    if video is None:
+                        continue
+                    for bucket in buckets:
+                        deltas[('video', video_id, bucket)] = count
+                        channel_key = ('channel', video['channel_id'], bucket)
+                        deltas[channel_key] = deltas.get(channel_key, 0) + count
+                if deltas and not storage.add_views(deltas):
+                    # Вернём просмотры в счётчики до следующего сброса
+                    for video_id, count in pending.items():
+                        lock, counts = self.shards[hash(video_id) % VIEW_COUNTER_SHARDS]
+                        with lock:
+                            counts[video_id] = counts.get(video_id, 0) + count
+                    return
+            with state_lock:
+                for video in self.load():
+                    feed.update(video)
+            if time.monotonic() - self.last_prune > 3600:
+                self.last_prune = time.monotonic()
+                self.prune()
+
+    def load(self):
+        """Подтягивание изменённых счётчиков (в том числе чужих); возвращает видео с изменившимися просмотрами"""
+        # Небольшой запас на расхождение часов процессов
+        since = self.loaded_at - 60 if self.loaded_at else 0
+        self.loaded_at = time.time()
+        rows = storage.load_views(since)
+        changed = []
+        with self.stats_lock:
+            for scope, key, bucket, views in rows:
+                self.stats[(scope, key, bucket)] = views
+                if scope == 'video' and bucket == 'total':
+                    changed.append((key, views))
+        updated = []
+        for video_id, views in changed:
+            video = self.videos.get(video_id)
+            if video is not None and video.get('views') != views:
+                video['views'] = views
+                updated.append(video)
+        return updated
+
+    def prune(self):
+        now = datetime.now()
+        hourly_before = (now - timedelta(hours=app.config['VIEW_HOURLY_RETENTION'])).strftime('h:%Y-%m-%dT%H')
+        daily_before = (now - timedelta(days=app.config['VIEW_DAILY_RETENTION'])).strftime('d:%Y-%m-%d')
+        storage.prune_views('h:', hourly_before)
+        storage.prune_views('d:', daily_before)
+        with self.stats_lock:
+            for key in [key for key in self.stats
+                        if key[2].startswith('h:') and key[2] < hourly_before or key[2].startswith('d:') and key[2] < daily_before]:
+                del self.stats[key]
+
+    def total(self, scope, key):
+        with self.stats_lock:
+            return self.stats.get((scope, key, 'total'), 0)
+
+    def hourly(self, scope, key, hours=24):
+        """Просмотры по часам за последние hours часов, от старых к новым: [(час, просмотры)]"""
+        now = datetime.now()
+        with self.stats_lock:
+            return [(bucket[2:], self.stats.get((scope, key, bucket), 0))
+                    for bucket in ((now - timedelta(hours=i)).strftime('h:%Y-%m-%dT%H') for i in reversed(range(hours)))]
+
+    def daily(self, scope, key, days=30):
+        """Просмотры по суткам за последние days дней, от старых к новым: [(дата, просмотры)]"""
+        now = datetime.now()
+        with self.stats_lock:
+            return [(bucket[2:], self.stats.get((scope, key, bucket), 0))
+                    for bucket in ((now - timedelta(days=i)).strftime('d:%Y-%m-%d') for i in reversed(range(days)))]
+
+    def recent(self, scope, key, hours=24):
+        return sum(views for _, views in self.hourly(scope, key, hours))
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name='view-counter', daemon=True)
+            self.thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(app.config['VIEW_FLUSH_INTERVAL'])
+            try:
+                self.flush()
+            except Exception as e:
+                app.logger.exception("Error flushing views: %s", e)
+
+    def reset_after_fork(self):
+        self.shards = [(threading.Lock(), {}) for _ in range(VIEW_COUNTER_SHARDS)]
+        self.stats_lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.thread = None
+
+# ======================
+# Фоновые задачи
+# ======================
+JOB_PRUNE_INTERVAL = 3600 # как часто удалять старые задачи, секунд
+
+class JobQueue:
+    """Очередь фоновых задач с пулом потоков, повторами и статусом в хранилище"""
+
+    def __init__(self, jobs):
+        self.jobs = jobs
+        self.handlers = {}
+        self.failure_handlers = {}
+        self.queue = queue.Queue()
+        self.workers = []
+        self.pruner = None
+
+    def handler(self, job_type):
+        """Регистрация обработчика задач типа job_type"""
+        def decorator(func):
+            self.handlers[job_type] = func
+            return func
+        return decorator
+
+    def on_failure(self, job_type):
+        """Регистрация уборки после последней неудачной попытки задачи типа job_type"""
+        def decorator(func):
+            self.failure_handlers[job_type] = func
+            return func
+        return decorator
+
+    def enqueue(self, job_type, payload):
+        now = datetime.now().isoformat()
+        job = {
+            'id': generate_video_id(16),
+            'type': job_type,
+            'payload': payload,
+            'status': 'queued',
+            'owner': process_id(),
+            'attempts': 0,
+            'error': None,
+            'result': None,
+            'created_at': now,
+            'updated_at': now
+        }
+        self.jobs.append(job)
+        self.jobs.save(job)
+        self.queue.put(job['id'])
+        return job
+
+    def start(self):
+        """Запуск потоков и возврат в очередь задач, прерванных перезапуском"""
+        if self.workers:
+            return
+        me = process_id()
+        for job in self.jobs.find('status', 'queued') + self.jobs.find('status', 'running'):
+            # Задачи живых процессов не трогаем; осиротевшие забирает тот, кто успел первым
+            owner = job.get('owner')
+            if owner and owner != me and process_alive(owner):
+                continue
+            if self.jobs.claim(job, owner=me):
+                self.queue.put(job['id'])
+        for i in range(app.config['JOB_WORKERS']):
+            worker = threading.Thread(target=self._work, name=f'job-worker-{i}', daemon=True)
+            worker.start()
+            self.workers.append(worker)
+        self.pruner = threading.Thread(target=self._prune_loop, name='job-pruner', daemon=True)
+        self.pruner.start()
+
+    def prune(self):
+        """Удаление выполненных и упавших задач старше JOB_RETENTION"""
+        cutoff = (datetime.now() - timedelta(seconds=app.config['JOB_RETENTION'])).isoformat()
+        with state_lock:
+            old = [job for status in ('done', 'failed') for job in self.jobs.find('status', status) if job['updated_at'] < cutoff]
+            for job in old:
+                self.jobs.delete(job)
+        return len(old)
+
+    def _prune_loop(self):
+        while True:
+            try:
+                removed = self.prune()
+                if removed:
+                    app.logger.info("Removed %s old jobs", removed)
+            except Exception as e:
+                app.logger.exception("Error removing old jobs: %s", e)
+            time.sleep(JOB_PRUNE_INTERVAL)
+
+    def _fail(self, job, error):
+        """Последняя попытка не удалась: статус failed и уборка за задачей"""
+        self._set_status(job, 'failed', error=error)
+        cleanup = self.failure_handlers.get(job['type'])
+        if cleanup is None:
+            return
+        try:
+            cleanup(job['payload'])
+        except Exception as e:
+            app.logger.exception("Error cleaning up after job %s (%s): %s", job['id'], job['type'], e,
+                                 extra={'job_id': job['id'], 'job_type': job['type']})
+
+    def _set_status(self, job, status, **fields):
+        # Индекс статусов и сохранение - под state_lock, как у остальных изменений коллекций (prune, синхронизация)
+        with state_lock:
+            job.update(fields, updated_at=datetime.now().isoformat())
+            self.jobs.update(job, 'status', status)
+            self.jobs.save(job)
+
+    def _work(self):
+        while True:
+            job = self.jobs.get(self.queue.get())
+            if job is None or job['status'] not in ('queued', 'running'):
+                continue
+            self._set_status(job, 'running', attempts=job['attempts'] + 1)
+            start = time.perf_counter()
+            try:
+                result = self.handlers[job['type']](job['payload'])
+            except Exception as e:
+                JOB_SECONDS.observe(time.perf_counter() - start, type=job['type'], status='error')
+                app.logger.exception("Job %s (%s) failed: %s", job['id'], job['type'], e,
+                                     extra={'job_id': job['id'], 'job_type': job['type'], 'attempt': job['attempts']})
+                if job['attempts'] < app.config['JOB_MAX_ATTEMPTS']:
+                    self._set_status(job, 'queued', error=str(e))
+                    delay = app.config['JOB_RETRY_DELAY'] * job['attempts']
+                    timer = threading.Timer(delay, self.queue.put, args=(job['id'],))
+                    timer.daemon = True
+                    timer.start()
+                else:
+                    self._fail(job, str(e))
+            else:
+                JOB_SECONDS.observe(time.perf_counter() - start, type=job['type'], status='done')
+                self._set_status(job, 'done', error=None, result=result)
+
+    def reset_after_fork(self):
+        self.queue = queue.Queue()
+        self.workers = []
+        self.pruner = None
+
+# ======================
+# Несколько процессов
+# ======================
+# Общая блокировка изменений коллекций в памяти (потоки одного процесса)
+state_lock = threading.RLock()
+
+def synchronized(func):
+    """Выполнение обработчика под state_lock: проверка и изменение данных без гонок между потоками"""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with state_lock:
+            return func(*args, **kwargs)
+    return wrapper
+
+class ChangeSync:
+    """Подтягивание в память изменений, которые другие процессы записали в SQLite"""
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.collections = {}
+        self.hooks = {}
+        self.lock = threading.Lock()
+        self.thread = None
+        self.last_prune = 0.0
+        # Номер берётся до загрузки коллекций: изменения, сделанные во время загрузки, применятся повторно
+        self.last_seq = storage.last_change() if storage.shared else 0
+
+    def watch(self, collection, hook=None):
+        """Отслеживание коллекции; hook(record, deleted) вызывается после применения изменения"""
+        self.collections[collection.file] = collection
+        if hook:
+            self.hooks[collection.file] = hook
+
+    def sync(self):
+        if not self.storage.shared or not self.lock.acquire(blocking=False):
+            return
+        try:
+            changes, last_seq = self.storage.changes_since(self.last_seq)
+            with state_lock:
+                for file, key in dict.fromkeys(changes):
+                    collection = self.collections.get(file)
+                    if collection is None:
+                        continue
+                    if key == '*':
+                        self.reload(collection)
+                    else:
+                        self.apply(collection, json.loads(key))
+            self.last_seq = last_seq
+        except Exception as e:
+            app.logger.exception("Error syncing changes: %s", e)
+        finally:
+            self.lock.release()
+
+    def apply(self, collection, key, data=None):
+        deltas = write_behind.pending_deltas(collection.file, key)
+        # Ещё не записанная целиком запись новее той, что в базе
+        if deltas == {}:
+            return
+        if data is None:
+            data = self.storage.fetch(collection.file, key)
+        record = collection.get(key)
+        hook = self.hooks.get(collection.file)
+        if data is None:
+            if record is not None:
+                collection.remove(record)
+                collection.notify(record)
+                if hook:
+                    hook(record, True)
+            return
+        new = collection.wrap(json.loads(data))
+        if collection.prepare:
+            collection.prepare(new)
+        if deltas:
+            # Строка из базы плюс свои изменения, которые ещё сольются с ней при сбросе
+            apply_deltas(new, deltas)
+        if record is None:
+            collection.append(new)
+            record = new
+        else:
+            collection.replace(record, new)
+        collection.notify(record)
+        if hook:
+            hook(record, False)
+
+    def reload(self, collection):
+        """Полная сверка коллекции с базой (после пересохранения целиком или пропуска журнала)"""
+        rows = {record[collection.key]: json.dumps(record) for record in self.storage.load(collection.file)}
+        for key in [key for key in collection.by_key if key not in rows]:
+            self.apply(collection, key)
+        for key, data in rows.items():
+            self.apply(collection, key, data)
+
+    def start(self):
+        if self.storage.shared and self.thread is None:
+            self.thread = threading.Thread(target=self._run, name='change-sync', daemon=True)
+            self.thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(app.config['SYNC_INTERVAL'])
+            try:
+                # Журнал уже почищен дальше, чем мы успели прочитать - сверяем всё целиком
+                if self.last_seq and self.storage.first_change() > self.last_seq + 1:
+                    with self.lock, state_lock:
+                        for collection in self.collections.values():
+                            self.reload(collection)
+                        self.last_seq = self.storage.last_change()
+                self.sync()
+                if time.monotonic() - self.last_prune > 60:
+                    self.last_prune = time.monotonic()
+                    self.storage.prune_changes(time.time() - app.config['CHANGES_RETENTION'])
+            except Exception as e:
+                app.logger.exception("Error in change sync: %s", e)
+
+    def reset_after_fork(self):
+        self.lock = threading.Lock()
+        self.thread = None
+
+# ======================
+# Загрузка данных
+# ======================
+change_sync = ChangeSync(storage)
+videos = Collection(VIDEO_DATA_FILE, load_data(VIDEO_DATA_FILE), indexes=('channel_id',), record_type=Video)
+users = Collection(USER_DATA_FILE, load_data(USER_DATA_FILE), indexes=('email', 'nickname'), record_type=User)
+comments = Collection(COMMENTS_DATA_FILE, load_data(COMMENTS_DATA_FILE), indexes=('video_id',), record_type=Comment)
+likes_dislikes = Collection(LIKES_DISLIKES_FILE, load_data(LIKES_DISLIKES_FILE), prepare=prepare_votes)
+comment_likes_dislikes_data = Collection(COMMENT_LIKES_DISLIKES_FILE, load_data(COMMENT_LIKES_DISLIKES_FILE), prepare=prepare_votes)
+channels = Collection(CHANNEL_DATA_FILE, load_data(CHANNEL_DATA_FILE), indexes=('user_id',), prepare=prepare_channel, record_type=Channel)
+subscription_feed = SubscriptionFeed(storage, channels)
+channels.listeners.append(subscription_feed.channel_changed)
+video_votes = VoteStore(likes_dislikes, videos, 'video_id')
+comment_votes = VoteStore(comment_likes_dislikes_data, comments, 'comment_id')
+view_counter = ViewCounter(videos)
+view_counter.load()
+feed = RankedFeed(videos)
+search_index = SearchIndex(videos)
+related_videos = RelatedVideos(RELATED_FILE, RELATED_IDS_FILE)
+related_videos.load(videos)
+videos.listeners.append(related_videos.video_changed)
+likes_dislikes.listeners.append(related_videos.votes_changed)
+comment_index = CommentIndex(comments)
+comments.listeners.append(comment_index.changed)
+jobs = Collection(JOBS_DATA_FILE, load_data(JOBS_DATA_FILE), indexes=('status',))
+job_queue = JobQueue(jobs)
+uploads = Collection(UPLOADS_DATA_FILE, load_data(UPLOADS_DATA_FILE))
+user_ids = IdSequence('users', (user['id'] for user in users))
+comment_ids = IdSequence('comments', (comment['id'] for comment in comments))
+reply_ids = IdSequence('sub_comments', (reply['id'] for comment in comments for reply in comment.get('sub_comments', [])))
+
+def video_synced(video, deleted):
+    """Обновление ленты и поиска после изменения видео другим процессом"""
+    if deleted:
+        feed.remove(video)
+        search_index.remove(video)
+    else:
+        # Просмотры и голоса в записи могут отставать от счётчиков и множеств
+        video['views'] = view_counter.total('video', video['id']) or video.get('views', 0)
+        video_votes.update_counts(video)
+        feed.update(video)
+        search_index.add(video)
+
+change_sync.watch(videos, video_synced)
+atexit.register(view_counter.flush)
+def comment_synced(comment, deleted):
+    """Счётчики голосов комментария из множеств, а не из записи другого процесса"""
+    if not deleted:
+        comment_votes.update_counts(comment)
+
+change_sync.watch(users)
+change_sync.watch(comments, comment_synced)
+change_sync.watch(likes_dislikes, video_votes.synced)
+change_sync.watch(comment_likes_dislikes_data, comment_votes.synced)
+change_sync.watch(channels)
+change_sync.watch(jobs)
+change_sync.watch(uploads)
+
+background_started = False
+
+def start_background_threads():
+    """Ленивый запуск фоновых потоков в том процессе, который реально обслуживает запросы"""
+    global background_started
+    with state_lock:
+        if background_started:
+            return
+        background_started = True
+        job_queue.start()
+        change_sync.start()
+        view_counter.start()
+        sitemap.start()
+        related_videos.start()
+        app.session_interface.start()
+        threading.Thread(target=upload_cleanup_loop, name='upload-cleanup', daemon=True).start()
+
+def reset_after_fork():
+    """В дочернем процессе (воркер gunicorn) потоков и соединений родителя нет"""
+    global state_lock, background_started
+    state_lock = threading.RLock()
+    background_started = False
+    storage.reset_connections()
+    write_behind.reset_after_fork()
+    job_queue.reset_after_fork()
+    change_sync.reset_after_fork()
+    view_counter.reset_after_fork()
+    sitemap.reset_after_fork()
+    related_videos.reset_after_fork()
+    app.session_interface.reset_after_fork()
+    password_hasher.reset_after_fork()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=reset_after_fork)
+
+@app.before_request
+def sync_shared_state():
+    start_background_threads()
+    if not request.path.startswith(('/static/', '/stream/')):
+        change_sync.sync()
+
+# ======================
+# Изображения
+# ======================
+# Размеры производных картинок: сетка миниатюр, страница видео, превью для соцсетей
+IMAGE_SIZES = {
+    'cover': {'thumb': (320, 180), 'watch': (640, 360), 'og': (1280, 720)},
+    'avatar': {'small': (48, 48), 'medium': (128, 128), 'large': (256, 256)}
+}
+IMAGE_FORMATS = (
+    ('webp', 'WEBP', {'quality': 80, 'method': 6}),
+    ('jpg', 'JPEG', {'quality': 85, 'optimize': True, 'progressive': True})
+)
+# Файлы с хэшем содержимого в имени никогда не меняются
+HASHED_IMAGE_RE = re.compile(r'_[0-9a-f]{16}\.(webp|jpg)$')
+
+def flatten_image(img):
+    """Поворот по EXIF и приведение к RGB (прозрачность - на белом фоне)"""
+    img = ImageOps.exif_transpose(img)
+    if img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info):
+        img = img.convert('RGBA')
+        background = Image.new('RGB', img.size, (255, 255, 255))
+        background.paste(img, mask=img.getchannel('A'))
+        return background
+    return img.convert('RGB')
+
+def build_derivatives(source, kind, folder, prefix):
+    """Все размеры и форматы картинки kind в папке folder: {размер: {формат: имя файла}}"""
+    with IMAGE_SECONDS.time(kind=kind), Image.open(source) as img:
+        img = flatten_image(img)
+        result = {}
+        for size_name, size in IMAGE_SIZES[kind].items():
+            # Обрезка по центру с сохранением пропорций вместо растягивания
+            fitted = ImageOps.fit(img, size, Image.LANCZOS)
+            result[size_name] = {}
+            for ext, image_format, options in IMAGE_FORMATS:
+                buffer = io.BytesIO()
+                fitted.save(buffer, format=image_format, **options)
+                data = buffer.getvalue()
+                name = f"{prefix}_{size_name}_{hashlib.sha256(data).hexdigest()[:16]}.{ext}"
+                path = os.path.join(folder, name)
+                if not os.path.exists(path):
+                    tmp_path = f"{path}.tmp"
+                    with open(tmp_path, 'wb') as f:
+                        f.write(data)
+                    os.replace(tmp_path, path)
+                result[size_name][ext] = name
+    return result
+
+def remove_derivatives(folder, derivatives, keep=None):
+    """Удаление файлов производных картинок, кроме тех, что есть в keep"""
+    keep_names = {name for formats in (keep or {}).values() for name in formats.values()}
+    for formats in (derivatives or {}).values():
+        for name in formats.values():
+            if name not in keep_names:
+                try:
+                    os.remove(os.path.join(folder, name))
+                except FileNotFoundError:
+                    pass
+
+def image_path(record, size, fmt='webp'):
+    """Путь картинки видео или аватара пользователя относительно static нужного размера и формата"""
+    if not record:
+        return 'ui/user.png'
+    if record.get('covers'):
+        return 'users/' + record['covers'][size][fmt]
+    if record.get('cover'):
+        return 'users/' + record['cover']
+    if record.get('avatars'):
+        return 'imgs/' + record['avatars'][size][fmt]
+    return 'imgs/' + record.get('avatar', 'user.png')
+
+app.jinja_env.globals['image_path'] = image_path
+
+@app.context_processor
+def inject_session_user():
+    """Вошедший пользователь для шапки страниц (аватар)"""
+    return {'session_user': g.get('current_user')}
 
-def generate_nickname():
-    """Генерация случайного никнейма"""
-    length = random.randint(1, 50)
-    return ''.join(random.choices(string.ascii_letters + string.digits, k=length))
+def avatar_upload_path(user_id):
+    return os.path.join(app.config['UPLOAD_FOLDER_IMG'], f"avatar_{user_id}.upload")
 
-def generate_channel_id():
-    """Генерация ID для канала"""
-    length = random.randint(3, 30)
-    return ''.join(random.choices(string.ascii_letters + string.digits, k=length))
+def queue_avatar_processing(user_id, file):
+    """Сохранение загруженного аватара как есть и постановка его обработки в очередь"""
+    os.makedirs(app.config['UPLOAD_FOLDER_IMG'], exist_ok=True)
+    file.save(avatar_upload_path(user_id))
+    return job_queue.enqueue('process_avatar', {'user_id': user_id})
+
+@job_queue.handler('process_avatar')
+def process_avatar(payload):
+    """Нарезка аватара на размеры и форматы"""
+    user_id = payload['user_id']
+    source = avatar_upload_path(user_id)
+    if not os.path.exists(source):
+        # Повтор после успешной обработки
+        return {'user_id': user_id}
+    folder = app.config['UPLOAD_FOLDER_IMG']
+    avatars = build_derivatives(source, 'avatar', folder, f"avatar_{user_id}")
+    with state_lock:
+        user = users.get(user_id)
+        if user is None:
+            remove_derivatives(folder, avatars)
+        else:
+            previous = user.get('avatars')
+            user['avatars'] = avatars
+            user['avatar'] = avatars['medium']['jpg']
+            users.save(user)
+            remove_derivatives(folder, previous, keep=avatars)
+    os.remove(source)
+    return {'user_id': user_id}
+
+@job_queue.on_failure('process_avatar')
+def discard_failed_avatar(payload):
+    """Удаление исходного аватара, который так и не удалось обработать"""
+    try:
+        os.remove(avatar_upload_path(payload['user_id']))
+    except OSError:
+        pass
 
 # ======================
-# Middleware и фильтры
+# Карта сайта
 # ======================
-@app.before_request
-def check_ip():
-    """Проверка IP на блокировку"""
-    client_ip = request.remote_addr
-    if request.path.startswith('/static'):
-        return None
-    if client_ip in blocked_ips:
-        return render_template('ip_not_allowed.html')
-    country_code = get_country_by_ip(client_ip)
-    if country_code and country_code in blocked_countries:
-        return render_template('ip_not_allowed.html')
-    return None
+SITEMAP_SHARD_SIZE = 50000
+SITEMAP_SHARD_RE = re.compile(r'^((videos|channels)-\d+|pages)\.xml\.gz$')
+SITEMAP_LOCK_FILE = '.build.lock' # в SITEMAP_FOLDER, держит процесс, который сейчас собирает sitemap
+SITEMAP_DESCRIPTION_LIMIT = 2048
 
-@app.before_request
-def check_ban_acc():
-    """Проверка блокировки аккаунта"""
-    user_id = session.get('user_id')
-    if request.path.startswith('/static'):
-        return None
-    if request.path.startswith('/logout'):
+class Sitemap:
+    """sitemap.xml: индекс и сжатые части до 50 000 адресов, которые пересобираются по отдельности
+
+    Видео и каналы упорядочены по времени появления, поэтому новое видео или
+    канал почти всегда меняет только последнюю часть. Части лежат на диске
+    готовыми .xml.gz и отдаются как есть.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.lock = threading.Lock()
+        # Отсортированные ключи (порядок, id) и отпечатки полей, попадающих в sitemap
+        self.keys = {'videos': [], 'channels': []}
+        self.entries = {'videos': {}, 'channels': {}}
+        self.dirty = set()
+        self.wakeup = threading.Event()
+        self.thread = None
+
+    @staticmethod
+    def order_key(kind, record):
+        if kind == 'videos':
+            return (record['upload_date'], record['id'])
+        return (record['user_id'], record['id'])
+
+    @staticmethod
+    def fingerprint(kind, record):
+        if kind == 'videos':
+            return (record.get('title'), record.get('description'), image_path(record, 'thumb', 'jpg'), record.get('filename'))
         return None
-    if user_id and str(user_id) in blocked_accs:
-        user = next((u for u in users if u['id'] == user_id), None)
-        return render_template('you_are_banned.html', user_id=user_id, user=user)
 
-@app.template_filter('format_number')
-def format_number(number):
-    """Фильтр для форматирования чисел"""
-    if number >= 1_000_000_000:
-        return f"{number / 1_000_000_000:.1f} млрд."
-    elif number >= 1_000_000:
-        return f"{number / 1_000_000:.1f} млн."
-    elif number >= 1_000:
-        return f"{number / 1_000:.1f} тыс."
-    else:
-        return str(number)
+    def load(self, kind, records):
+        with self.lock:
+            for record in records:
+                key = self.order_key(kind, record)
+                self.entries[kind][record['id']] = (key, self.fingerprint(kind, record))
+            self.keys[kind] = sorted(key for key, _ in self.entries[kind].values())
+
+    def _mark_from(self, kind, position):
+        # Вставка или удаление сдвигает все следующие части
+        last = max(len(self.keys[kind]) - 1, position) // SITEMAP_SHARD_SIZE
+        self.dirty.update((kind, shard) for shard in range(position // SITEMAP_SHARD_SIZE, last + 1))
+
+    def changed(self, kind, collection, record):
+        """Учёт добавления, изменения или удаления видео/канала"""
+        present = collection.get(record['id']) is record
+        with self.lock:
+            old = self.entries[kind].get(record['id'])
+            new = (self.order_key(kind, record), self.fingerprint(kind, record)) if present else None
+            if old == new:
+                return
+            keys = self.keys[kind]
+            if old is not None and (new is None or old[0] != new[0]):
+                position = bisect.bisect_left(keys, old[0])
+                del keys[position]
+                self._mark_from(kind, position)
+            if new is not None and (old is None or old[0] != new[0]):
+                position = bisect.bisect_left(keys, new[0])
+                keys.insert(position, new[0])
+                self._mark_from(kind, position)
+            elif new is not None:
+                self.dirty.add((kind, bisect.bisect_left(keys, new[0]) // SITEMAP_SHARD_SIZE))
+            if new is None:
+                del self.entries[kind][record['id']]
+            else:
+                self.entries[kind][record['id']] = new
+        self.wakeup.set()
+
+    def url(self, path):
+        return app.config['SITE_URL'] + path
+
+    def video_entry(self, video):
+        description = html.unescape(re.sub(r'<[^>]+>', ' ', video.get('description') or ''))[:SITEMAP_DESCRIPTION_LIMIT]
+        published = datetime.fromisoformat(video['upload_date']).astimezone()
+        return (
+            f"<url><loc>{html.escape(self.url('/watch?si=' + video['id']))}</loc>"
+            f"<lastmod>{published.date().isoformat()}</lastmod>"
+            f"<video:video>"
+            f"<video:thumbnail_loc>{html.escape(self.url('/static/' + image_path(video, 'thumb', 'jpg')))}</video:thumbnail_loc>"
+            f"<video:title>{html.escape(video.get('title') or '')}</video:title>"
+            f"<video:description>{html.escape(description.strip() or video.get('title') or '')}</video:description>"
+            f"<video:content_loc>{html.escape(self.url('/stream/' + video['filename']))}</video:content_loc>"
+            f"<video:publication_date>{published.isoformat(timespec='seconds')}</video:publication_date>"
+            f"</video:video></url>"
+        )
+
+    def channel_entry(self, channel):
+        return f"<url><loc>{html.escape(self.url('/channel?id=' + channel['id']))}</loc></url>"
+
+    def write(self, name, entries):
+        """Атомарная запись части sitemap в gzip"""
+        with atomic_write(os.path.join(self.folder, name)) as tmp_path:
+            with gzip.open(tmp_path, 'wt', encoding='utf-8') as f:
+                f.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                        '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9" '
+                        'xmlns:video="http://www.google.com/schemas/sitemap-video/1.1">\n')
+                for entry in entries:
+                    f.write(entry)
+                    f.write('\n')
+                f.write('</urlset>\n')
+
+    def build(self, full=False, blocking=False):
+        """Пересборка изменившихся частей (full - всех) и индекса
+
+        Собирает один процесс за раз (flock на SITEMAP_LOCK_FILE). Если сборка уже
+        идёт в другом процессе, части остаются в очереди и возвращается False.
+        """
+        os.makedirs(self.folder, exist_ok=True)
+        with process_lock(os.path.join(self.folder, SITEMAP_LOCK_FILE), blocking) as locked:
+            if not locked:
+                return False
+            self._build(full)
+            return True
+
+    def _build(self, full):
+        with self.lock:
+            if full:
+                for kind, keys in self.keys.items():
+                    self._mark_from(kind, 0)
+            dirty = sorted(self.dirty)
+            self.dirty.clear()
+            slices = [(kind, shard, [key[-1] for key in self.keys[kind][shard * SITEMAP_SHARD_SIZE:(shard + 1) * SITEMAP_SHARD_SIZE]])
+                      for kind, shard in dirty]
+            counts = {kind: -(-len(keys) // SITEMAP_SHARD_SIZE) for kind, keys in self.keys.items()}
+        for kind, shard, ids in slices:
+            if shard >= counts[kind]:
+                continue
+            if kind == 'videos':
+                entries = (self.video_entry(video) for video in map(videos.get, ids) if video is not None)
+            else:
+                entries = (self.channel_entry(channel) for channel in map(channels.get, ids) if channel is not None)
+            self.write(f"{kind}-{shard}.xml.gz", entries)
+        if full or not os.path.exists(os.path.join(self.folder, 'pages.xml.gz')):
+            self.write('pages.xml.gz', [f"<url><loc>{html.escape(self.url('/'))}</loc><changefreq>hourly</changefreq></url>"])
+        # Части, ставшие лишними после удалений
+        names = ['pages.xml.gz'] + [f"{kind}-{shard}.xml.gz" for kind, count in counts.items() for shard in range(count)]
+        for name in os.listdir(self.folder):
+            if SITEMAP_SHARD_RE.match(name) and name not in names:
+                os.remove(os.path.join(self.folder, name))
+        with atomic_write(os.path.join(self.folder, 'sitemap.xml')) as tmp_path:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write('<?xml version="1.0" encoding="UTF-8"?>\n<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n')
+                for name in names:
+                    modified = datetime.fromtimestamp(os.path.getmtime(os.path.join(self.folder, name)), timezone.utc)
+                    f.write(f"<sitemap><loc>{html.escape(self.url('/sitemaps/' + name))}</loc>"
+                            f"<lastmod>{modified.isoformat(timespec='seconds')}</lastmod></sitemap>\n")
+                f.write('</sitemapindex>\n')
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name='sitemap', daemon=True)
+            self.thread.start()
+
+    def _run(self):
+        # Первый запуск: собираем всё, дальше только изменившиеся части
+        full = not os.path.exists(os.path.join(self.folder, 'sitemap.xml'))
+        while True:
+            try:
+                if full or self.dirty:
+                    if self.build(full):
+                        full = False
+                    else:
+                        # Собирает другой процесс - повтор после паузы
+                        self.wakeup.set()
+            except Exception as e:
+                app.logger.exception("Error building sitemap: %s", e)
+            self.wakeup.wait()
+            self.wakeup.clear()
+            # Пачка изменений (например, массовая регистрация) - одна пересборка
+            time.sleep(app.config['SITEMAP_REBUILD_DELAY'])
+
+    def reset_after_fork(self):
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = None
+
+sitemap = Sitemap(SITEMAP_FOLDER)
+sitemap.load('videos', videos)
+sitemap.load('channels', channels)
+videos.listeners.append(lambda video: sitemap.changed('videos', videos, video))
+channels.listeners.append(lambda channel: sitemap.changed('channels', channels, channel))
+
+@app.cli.command('build-sitemap')
+def build_sitemap_command():
+    """Полная пересборка sitemap (например, после смены SITE_URL)"""
+    sitemap.build(full=True, blocking=True)
+    click.echo(f"Sitemap written to {os.path.join(SITEMAP_FOLDER, 'sitemap.xml')}")
 
 # ======================
-# Загрузка данных
+# Кэш страниц
 # ======================
-videos = load_data(VIDEO_DATA_FILE)
-users = load_data(USER_DATA_FILE)
-comments = load_data(COMMENTS_DATA_FILE)
-likes_dislikes = load_data(LIKES_DISLIKES_FILE)
-comment_likes_dislikes_data = load_data(COMMENT_LIKES_DISLIKES_FILE)
-channels = load_data(CHANNEL_DATA_FILE)
+class PageCache:
+    """LRU кэш готовых страниц в пределах бюджета памяти со сбросом по тегам
+
+    Тег - строка вида 'video:<id>', 'channel:<id>', 'user:<id>' или 'feed'.
+    Страница помечается тегами всех данных, из которых собрана, и удаляется
+    из кэша при изменении любого из них.
+    """
+
+    def __init__(self, max_bytes, ttl):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size = 0
+        self.entries = OrderedDict()
+        self.tags = {}
+        # Растёт при каждом сбросе: страницу, собранную до сброса, класть в кэш нельзя
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry['expires'] < time.monotonic():
+                self._drop(key)
+                return None
+            self.entries.move_to_end(key)
+            return entry
+
+    def set(self, key, body, mimetype, tags, generation):
+        size = len(body) + 512
+        with self.lock:
+            if generation != self.generation or size > self.max_bytes:
+                return
+            if key in self.entries:
+                self._drop(key)
+            self.entries[key] = {'body': body, 'mimetype': mimetype, 'tags': tags, 'size': size,
+                                 'expires': time.monotonic() + self.ttl}
+            self.size += size
+            for tag in tags:
+                self.tags.setdefault(tag, set()).add(key)
+            while self.size > self.max_bytes:
+                self._drop(next(iter(self.entries)))
+
+    def _drop(self, key):
+        entry = self.entries.pop(key)
+        self.size -= entry['size']
+        for tag in entry['tags']:
+            keys = self.tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.tags[tag]
+
+    def invalidate(self, *tags):
+        with self.lock:
+            self.generation += 1
+            for tag in tags:
+                for key in list(self.tags.get(tag, ())):
+                    self._drop(key)
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.entries.clear()
+            self.tags.clear()
+            self.size = 0
+
+page_cache = PageCache(app.config['PAGE_CACHE_MAX_BYTES'], app.config['PAGE_CACHE_TTL'])
+
+def cache_tags(*tags):
+    """Пометка текущей страницы тегами данных, из которых она собрана"""
+    if 'cache_tags' in g:
+        g.cache_tags.update(tags)
+
+def cached_page(view):
+    """Отдача страницы из page_cache; ключ - маршрут, аргументы, тема и вошедший пользователь"""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if not page_cache.max_bytes or request.method != 'GET':
+            return view(*args, **kwargs)
+        key = (request.endpoint, tuple(sorted(request.args.items(multi=True))),
+               session.get('theme', 'black'), session.get('user_id'), session.get('channel_id'))
+        entry = page_cache.get(key)
+        CACHE_REQUESTS.inc(cache='page', result='miss' if entry is None else 'hit')
+        if entry is not None:
+            return Response(entry['body'], mimetype=entry['mimetype'])
+        generation = page_cache.generation
+        g.cache_tags = set()
+        response = app.make_response(view(*args, **kwargs))
+        if response.status_code == 200 and g.cache_tags and not response.direct_passthrough:
+            page_cache.set(key, response.get_data(), response.mimetype, frozenset(g.cache_tags), generation)
+        return response
+    return wrapper
+
+def video_changed(video):
+    page_cache.invalidate(f"video:{video['id']}", f"channel:{video.get('channel_id')}", 'feed')
+
+def comment_changed(comment):
+    page_cache.invalidate(f"video:{comment.get('video_id')}")
+
+videos.listeners.append(video_changed)
+comments.listeners.append(comment_changed)
+channels.listeners.append(lambda channel: page_cache.invalidate(f"channel:{channel['id']}"))
+users.listeners.append(lambda user: page_cache.invalidate(f"user:{user['id']}"))
 
 # ======================
 # Основные маршруты
 # ======================
 @app.route('/')
+@cached_page
 def index():
     """Главная страница"""
-    sorted_videos = sorted(videos, key=lambda v: v['likes'] - v['dislikes'], reverse=True)
-    for video in sorted_videos:
-        video['relative_time'] = time_ago(datetime.fromisoformat(video['upload_date']))
+    page, next_cursor = feed.page()
     
     user_id = session.get('user_id')
-    user = next((u for u in users if u['id'] == user_id), None) if user_id else None
+    user = g.current_user
     user_theme = session.get('theme', 'black')
+    cache_tags('feed', f"user:{user_id}")
     
-    return render_template('index.html', videos=sorted_videos, user=user, user_id=user_id, user_theme=user_theme)
+    return render_template('index.html', videos=with_relative_time(page), next_cursor=next_cursor, user=user, user_id=user_id, user_theme=user_theme)
 
 @app.route('/search')
 def search():
     """Поиск видео"""
-    query = request.args.get('q', '').strip().lower()
-    
-    if query:
-        filtered_videos = [
-            video for video in videos if query in video['title'].lower() or query in video['description'].lower()
-        ]
-    else:
-        filtered_videos = []
+    query = request.args.get('q', '').strip()
+    # Индекс может отставать от коллекции: удалённые видео пропускаются
+    filtered_videos = [video for video in map(videos.get, search_index.search(query)[:FEED_PAGE_SIZE]) if video is not None]
     user_id = session.get('user_id')
-    user = next((u for u in users if u['id'] == user_id), None)
-    return render_template('search.html', query=query, videos=filtered_videos, user=user, user_id=user_id)
+    user = g.current_user
+    return render_template('search.html', query=query, videos=with_relative_time(filtered_videos), user=user, user_id=user_id)
+
+@app.before_request
+def count_video_view():
+    """Учёт просмотра до отдачи страницы видео (в том числе из кэша страниц)"""
+    if request.endpoint == 'video' and request.method == 'GET':
+        video_id = request.args.get('si', type=str)
+        if videos.get(video_id) is not None:
+            user_id = session.get('user_id')
+            view_counter.record(video_id, f"user:{user_id}" if user_id else f"ip:{request.remote_addr}")
 
 @app.route('/watch')
+@cached_page
 def video():
     """Страница просмотра видео"""
     video_id = request.args.get('si', type=str)
-    video = next((v for v in videos if v['id'] == video_id), None)
+    video = videos.get(video_id)
     if video is None:
         return "Видео не найдено.", 404
-    video['relative_time'] = time_ago(datetime.fromisoformat(video['upload_date']))
-    video_comments = [
-        {
-            **c,
-            'user': next((u for u in users if u['id'] == c['user_id']), None)
-        }
-        for c in comments if c['video_id'] == video_id and 'user_id' in c
-    ]
-    video_comments.sort(key=lambda c: c['likes'], reverse=True)
-    for comment in video_comments:
-        comment['sub_comments'] = [
-            {
-                **sub_comment,
-                'user': next((u for u in users if u['id'] == sub_comment['user_id']), None)
-            }
-            for sub_comment in comment.get('sub_comments', [])
-        ]
-    channel = next((ch for ch in channels if ch['id'] == video['channel_id']), None)
+    video = video.view(relative_time=time_ago(datetime.fromisoformat(video['upload_date'])))
+    page, comments_cursor = comment_index.page(video_id)
+    video_comments = [comment_view(comment) for comment in page]
+    channel = channels.get(video['channel_id'])
     user_id = session.get('user_id')
-    user = next((u for u in users if u['id'] == user_id), None)
-    video_user = next((u for u in users if u['id'] == video['user_id']), None)
+    user = g.current_user
+    video_user = users.get(video['user_id'])
+    cache_tags(f"video:{video_id}", f"channel:{video['channel_id']}", f"user:{user_id}", f"user:{video['user_id']}",
+               *(f"user:{c['user_id']}" for c in video_comments),
+               *(f"user:{reply['user_id']}" for c in video_comments for reply in c['sub_comments']))
     subscribers = len(channel.get('subscribers', []))
     formatted_subscribers = format_subscriber_count(subscribers)
-    return render_template('watch.html', formatted_subscribers=formatted_subscribers, video=video, comments=video_comments, channel=channel, video_user=video_user, user=user)
+    related = with_relative_time(related_videos.get(video_id))
+    return render_template('watch.html', formatted_subscribers=formatted_subscribers, video=video, comments=video_comments,
+                           comments_cursor=comments_cursor, comment_count=comment_index.count(video_id), channel=channel, video_user=video_user, user=user,
+                           related_videos=related)
 
 @app.route('/channel')
+@cached_page
 def channel():
     """Страница канала"""
     channel_id = request.args.get('id', type=str)
     if channel_id is None:
         return "Канал не найден", 404
-    channel = next((ch for ch in channels if ch['id'] == channel_id), None)
+    channel = channels.get(channel_id)
     if channel is None:
         return "Канал не найден", 404
     user_id = channel['user_id']
-    user = next((u for u in users if u['id'] == user_id), None)
-    if user:
-        channel['avatar'] = user.get('avatar', 'user.png')
-        channel['name'] = user.get('nickname', 'Неизвестный')
-    else:
-        channel['avatar'] = 'user.png'
-        channel['name'] = 'Неизвестный'
-    user_videos = [v for v in videos if v.get('channel_id') == channel['id']]
+    user = users.get(user_id)
+    # Имя и аватар владельца только для страницы, в запись канала не попадают
+    channel = channel.view(avatar=user.get('avatar', 'user.png') if user else 'user.png',
+                           name=user.get('nickname', 'Неизвестный') if user else 'Неизвестный')
+    user_videos = videos.find('channel_id', channel_id)
     user_videos.sort(key=lambda v: datetime.fromisoformat(v['upload_date']), reverse=True)
-    for video in user_videos:
-        video['relative_time'] = time_ago(datetime.fromisoformat(video['upload_date']))
+    user_videos = with_relative_time(user_videos)
     subscribers = len(channel.get('subscribers', []))
     formatted_subscribers = format_subscriber_count(subscribers)
     user_id_from_session = session.get('user_id')
-    return render_template('channel.html', formatted_subscribers=formatted_subscribers, user=user, channel=channel, videos=user_videos, user_id=user_id_from_session)
+    cache_tags(f"channel:{channel_id}", f"user:{user_id}", f"user:{user_id_from_session}")
+    return render_template('channel.html', formatted_subscribers=formatted_subscribers, user=user, channel=channel, videos=user_videos, user_id=user_id_from_session,
+                           channel_views=view_counter.total('channel', channel_id), channel_views_today=view_counter.recent('channel', channel_id))
 
 # ======================
 # AJAX и API маршруты
@@ -272,42 +3696,117 @@ def channel():
 @app.route('/search_videos')
 def search_videos():
     """AJAX поиск видео"""
-    query = request.args.get('query', '').strip().lower()
-    offset = int(request.args.get('offset', 0))
-    limit = 24
+    query = request.args.get('query', '')
+    offset = max(request.args.get('offset', 0, type=int), 0)
+    limit = FEED_PAGE_SIZE
 
-    if query:
-        filtered_videos = [
-            video for video in videos if query in video['title'].lower() or query in video['description'].lower()
-        ]
-    else:
-        filtered_videos = []
-
-    next_videos = filtered_videos[offset:offset + limit]
-    all_videos_loaded = len(next_videos) < limit
+    # Результаты запроса кэшируются в индексе, страницы берутся из готового списка
+    found = search_index.search(query)
+    next_videos = [video for video in map(videos.get, found[offset:offset + limit]) if video is not None]
+    all_videos_loaded = offset + limit >= len(found)
     base_static_url = url_for('static', filename='')
 
-    return jsonify({'videos': next_videos, 'static_url': base_static_url, 'all_videos_loaded': all_videos_loaded})
+    return jsonify({'videos': with_relative_time(next_videos), 'static_url': base_static_url, 'all_videos_loaded': all_videos_loaded})
 
 @app.route('/load_more_videos')
 def load_more_videos():
     """AJAX подгрузка видео"""
-    offset = int(request.args.get('offset', 0))
-    limit = 24
-    sorted_videos = sorted(videos, key=lambda v: v['likes'] - v['dislikes'], reverse=True)
-    for video in sorted_videos:
-        video['relative_time'] = time_ago(datetime.fromisoformat(video['upload_date']))
-    next_videos = sorted_videos[offset:offset + limit]
-    all_videos_loaded = len(next_videos) < limit
+    cursor = request.args.get('cursor')
+    try:
+        if cursor:
+            page, next_cursor = feed.page(cursor)
+        else:
+            page, next_cursor = feed.page_at(int(request.args.get('offset', 0)))
+    except (ValueError, TypeError):
+        return jsonify({'error': 'Неверный курсор'}), 400
     base_static_url = url_for('static', filename='')
-    return jsonify({'videos': next_videos, 'static_url': base_static_url, 'all_videos_loaded': all_videos_loaded})
+    return jsonify({'videos': with_relative_time(page), 'static_url': base_static_url, 'next_cursor': next_cursor, 'all_videos_loaded': next_cursor is None})
+
+def author_view(user_id):
+    user = users.get(user_id)
+    return {'id': user_id, 'nickname': user.get('nickname', 'Неизвестный') if user else 'Неизвестный', 'avatar': image_path(user, 'small')}
+
+def reply_view(reply):
+    """Ответ на комментарий для шаблона и JSON"""
+    return {
+        'id': reply['id'],
+        'user_id': reply['user_id'],
+        'user': author_view(reply['user_id']),
+        'channel_link_id': reply.get('channel_link_id'),
+        'text': format_comment_text(reply['text'])
+    }
+
+def comment_view(comment):
+    """Комментарий с автором и первой страницей ответов для шаблона и JSON"""
+    replies, replies_cursor = reply_page(comment)
+    return {
+        'id': comment['id'],
+        'user_id': comment['user_id'],
+        'user': author_view(comment['user_id']),
+        'channel_link_id': comment.get('channel_link_id'),
+        'text': comment['text'],
+        'likes': comment['likes'],
+        'dislikes': comment['dislikes'],
+        'reply_count': len(comment.get('sub_comments', [])),
+        'sub_comments': [reply_view(reply) for reply in replies],
+        'replies_cursor': replies_cursor
+    }
+
+@app.route('/video_stats')
+def video_stats():
+    """Статистика просмотров видео и его канала по часам и суткам"""
+    video = videos.get(request.args.get('video_id', type=str))
+    if video is None:
+        return jsonify({'error': 'Видео не найдено'}), 404
+    return jsonify({
+        'views': view_counter.total('video', video['id']),
+        'hourly': view_counter.hourly('video', video['id']),
+        'daily': view_counter.daily('video', video['id']),
+        'channel_views': view_counter.total('channel', video['channel_id']),
+        'channel_daily': view_counter.daily('channel', video['channel_id'])
+    })
+
+@app.route('/load_comments')
+def load_comments():
+    """AJAX подгрузка комментариев видео (order - top или newest)"""
+    video_id = request.args.get('video_id', type=str)
+    if videos.get(video_id) is None:
+        return jsonify({'error': 'Видео не найдено'}), 404
+    try:
+        page, next_cursor = comment_index.page(video_id, request.args.get('order', 'top'), request.args.get('cursor'))
+    except (ValueError, TypeError):
+        return jsonify({'error': 'Неверный курсор'}), 400
+    return jsonify({'comments': [comment_view(comment) for comment in page], 'next_cursor': next_cursor,
+                    'static_url': url_for('static', filename='')})
+
+@app.route('/load_replies')
+def load_replies():
+    """AJAX подгрузка ответов на комментарий"""
+    comment = comments.get(request.args.get('comment_id', type=int))
+    if comment is None:
+        return jsonify({'error': 'Комментарий не найден'}), 404
+    try:
+        page, next_cursor = reply_page(comment, request.args.get('cursor'))
+    except (ValueError, TypeError):
+        return jsonify({'error': 'Неверный курсор'}), 400
+    return jsonify({'replies': [reply_view(reply) for reply in page], 'next_cursor': next_cursor,
+                    'static_url': url_for('static', filename='')})
 
 # ======================
 # Действия с видео
 # ======================
+def user_media_folders(user_id):
+    """Папки видео и изображений пользователя (создаются при необходимости)"""
+    user_folder = os.path.join(app.config['UPLOAD_FOLDER'], f'user_{user_id}')
+    video_folder = os.path.join(user_folder, 'videos')
+    img_folder = os.path.join(user_folder, 'imgs')
+    os.makedirs(video_folder, exist_ok=True)
+    os.makedirs(img_folder, exist_ok=True)
+    return video_folder, img_folder
+
 @app.route('/upload', methods=['POST'])
 def upload():
-    """Загрузка видео"""
+    """Загрузка видео: сохраняет исходные файлы и ставит обработку в очередь"""
     if 'video' not in request.files or 'cover' not in request.files:
         return jsonify({'error': 'Файлы не загружены'}), 400
         
@@ -320,119 +3819,506 @@ def upload():
         return jsonify({'error': 'Требуется авторизация'}), 401
         
     user_id = session['user_id']
-    user = next((u for u in users if u['id'] == user_id), None)
+    user = g.current_user
     if not user:
         return jsonify({'error': 'Пользователь не найден'}), 404
         
     if video_file.filename == '' or cover_file.filename == '':
         return jsonify({'error': 'Не выбраны файлы'}), 400
         
-    formatted_description = format_comment_text(description)
-    channels_data = load_data(CHANNEL_DATA_FILE)
-    channel = next((c for c in channels_data if c['user_id'] == user_id), None)
+    channel = channels.first('user_id', user_id)
     
     if not channel:
         return jsonify({'error': 'Канал не найден'}), 404
         
-    channel_id = channel['id']
+    video_id = generate_video_id()
+    video_folder, img_folder = user_media_folders(user_id)
     
-    if video_file and cover_file:
-        video_id = generate_video_id()
-        video_filename = f"{video_id}.mp4"
-        cover_filename = f"{video_id}.webp"
-        user_folder = os.path.join(app.config['UPLOAD_FOLDER'], f'user_{user_id}')
-        
-        if not os.path.exists(user_folder):
-            os.makedirs(user_folder)
-            
-        video_folder = os.path.join(user_folder, 'videos')
-        img_folder = os.path.join(user_folder, 'imgs')
+    try:
+        video_file.save(os.path.join(video_folder, f"{video_id}.mp4"))
+        cover_file.save(os.path.join(img_folder, f"{video_id}.upload"))
+    except Exception as e:
+        return jsonify({'error': f'Ошибка при загрузке: {str(e)}'}), 500
         
-        if not os.path.exists(video_folder):
-            os.makedirs(video_folder)
-        if not os.path.exists(img_folder):
-            os.makedirs(img_folder)
-            
+    return queue_video_processing(video_id, user_id, channel['id'], title, description)
+
+def queue_video_processing(video_id, user_id, channel_id, title, description):
+    """Постановка обработки загруженного видео в очередь"""
+    job = job_queue.enqueue('process_upload', {
+        'video_id': video_id,
+        'user_id': user_id,
+        'channel_id': channel_id,
+        'title': title,
+        'description': format_comment_text(description)
+    })
+    return jsonify({'success': True, 'job_id': job['id'], 'status_url': url_for('upload_status', job=job['id'])})
+
+@job_queue.handler('process_upload')
+def process_upload(payload):
+    """Обработка загруженного видео: обложка и публикация"""
+    video_id = payload['video_id']
+    user_id = payload['user_id']
+    video_folder, img_folder = user_media_folders(user_id)
+    raw_cover_path = os.path.join(img_folder, f"{video_id}.upload")
+    
+    # Повтор после сбоя не публикует видео второй раз, но доделывает рассылку и уборку
+    new_video = videos.get(video_id)
+    if new_video is None:
+        derivatives = build_derivatives(raw_cover_path, 'cover', img_folder, video_id)
+        covers = {size: {ext: f"user_{user_id}/imgs/{name}" for ext, name in formats.items()} for size, formats in derivatives.items()}
+
+        with state_lock:
+            new_video = videos.get(video_id)
+            if new_video is None:
+                new_video = Video({
+                    'id': video_id,
+                    'user_id': user_id,
+                    'filename': f"user_{user_id}/videos/{video_id}.mp4",
+                    'cover': covers['watch']['webp'],
+                    'covers': covers,
+                    'title': payload['title'],
+                    'description': payload['description'],
+                    "channel_id": payload['channel_id'],
+                    'likes': 0,
+                    'dislikes': 0,
+                    'views': 0,
+                    'upload_date': datetime.now().isoformat()
+                })
+                videos.append(new_video)
+                videos.save(new_video)
+                feed.add(new_video)
+                search_index.add(new_video)
+    subscription_feed.publish(new_video)
+    # Исходная обложка удаляется последней: пока она есть, повтор знает, что уборка не закончена
+    if os.path.exists(raw_cover_path):
+        if app.config['VIDEO_TRANSCODE']:
+            job_queue.enqueue('package_video', {'video_id': video_id})
+        os.remove(raw_cover_path)
+    return {'video_id': video_id}
+
+@job_queue.on_failure('process_upload')
+def discard_failed_upload(payload):
+    """Удаление исходных файлов загрузки, которую так и не удалось обработать"""
+    video_id = payload['video_id']
+    video_folder, img_folder = user_media_folders(payload['user_id'])
+    paths = [os.path.join(img_folder, f"{video_id}.upload")]
+    # Уже опубликованное видео остаётся, даже если не удалась уборка после публикации
+    if videos.get(video_id) is None:
+        paths.append(os.path.join(video_folder, f"{video_id}.mp4"))
+    for path in paths:
         try:
-            video_path = os.path.join(video_folder, video_filename)
-            video_file.save(video_path)
-            
-            cover_path = os.path.join(img_folder, cover_filename)
-            with Image.open(cover_file) as img:
-                img = img.resize((640, 360))
-                img = img.convert("RGB")
-                img.save(cover_path, format='WebP')
-                
-            upload_date = datetime.now().isoformat()
-            new_video = {
-                'id': video_id,
-                'user_id': user_id,
-                'filename': f"user_{user_id}/videos/{video_filename}",
-                'cover': f"user_{user_id}/imgs/{cover_filename}",
-                'title': title,
-                'description': formatted_description,
-                "channel_id": channel_id,
-                'likes': 0,
-                'dislikes': 0,
-                'views': 0,
-                'upload_date': upload_date
-            }
-            videos.append(new_video)
-            save_data(VIDEO_DATA_FILE, videos)
-            
-            video_url = url_for('video', si=video_id, _external=False)
-            return jsonify({'success': True, 'redirect_url': video_url})
-            
+            os.remove(path)
+        except OSError:
+            pass
+
+# ======================
+# Перекодирование видео
+# ======================
+# Лестница качеств HLS: высота кадра, битрейт видео и звука (кбит/с)
+HLS_LADDER = (
+    (240, 400, 64),
+    (360, 800, 96),
+    (480, 1400, 128),
+    (720, 2800, 128),
+    (1080, 5000, 192)
+)
+HLS_PATH_RE = re.compile(r'^user_\d+/videos/[A-Za-z0-9_-]+_hls/(master\.m3u8|\d+p/(index\.m3u8|seg_\d+\.ts))$')
+
+def run_ffmpeg(args, binary='FFMPEG_BINARY'):
+    """Запуск ffmpeg/ffprobe; при ошибке - исключение с концом его вывода"""
+    result = subprocess.run([app.config[binary], *args], capture_output=True, text=True, timeout=app.config['TRANSCODE_TIMEOUT'])
+    if result.returncode != 0:
+        raise RuntimeError(f"{app.config[binary]} exited with {result.returncode}: {result.stderr.strip()[-1000:]}")
+    return result.stdout
+
+def probe_video(path):
+    """Размер кадра, длительность и наличие звука"""
+    info = json.loads(run_ffmpeg(['-v', 'error', '-print_format', 'json', '-show_streams', '-show_format', path], 'FFPROBE_BINARY'))
+    video_stream = next((stream for stream in info.get('streams', []) if stream.get('codec_type') == 'video'), None)
+    if video_stream is None:
+        raise ValueError(f"No video stream in {path}")
+    return {
+        'width': int(video_stream['width']),
+        'height': int(video_stream['height']),
+        'duration': float(info.get('format', {}).get('duration') or 0),
+        'audio': any(stream.get('codec_type') == 'audio' for stream in info['streams'])
+    }
+
+def iso_duration(seconds):
+    """Длительность в формате ISO 8601 (PT1M5S) для разметки schema.org"""
+    minutes, secs = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"PT{f'{hours}H' if hours else ''}{f'{minutes}M' if minutes else ''}{secs}S"
+
+def hls_ladder(width, height):
+    """Качества не выше исходного; для совсем маленьких видео - одно, в исходном размере"""
+    rungs = [rung for rung in HLS_LADDER if rung[0] <= height] or [(height - height % 2, HLS_LADDER[0][1], HLS_LADDER[0][2])]
+    # Ширина чётная, как требует libx264
+    return [(round(width * rung_height / height / 2) * 2, rung_height, video_rate, audio_rate)
+            for rung_height, video_rate, audio_rate in rungs]
+
+def package_hls(source, target, probe):
+    """Нарезка source в HLS: по плейлисту и сегментам на каждое качество и общий master.m3u8"""
+    segment = app.config['HLS_SEGMENT_DURATION']
+    variants = []
+    for width, height, video_rate, audio_rate in hls_ladder(probe['width'], probe['height']):
+        folder = os.path.join(target, f"{height}p")
+        os.makedirs(folder, exist_ok=True)
+        args = ['-y', '-v', 'error', '-i', source, '-map', '0:v:0']
+        if probe['audio']:
+            args += ['-map', '0:a:0', '-c:a', 'aac', '-b:a', f'{audio_rate}k', '-ac', '2']
+        args += [
+            '-vf', f'scale={width}:{height}', '-c:v', 'libx264', '-preset', 'veryfast', '-profile:v', 'main',
+            '-b:v', f'{video_rate}k', '-maxrate', f'{video_rate * 107 // 100}k', '-bufsize', f'{video_rate * 2}k',
+            # Ключевые кадры на границах сегментов во всех качествах - плеер переключается без рывков
+            '-force_key_frames', f'expr:gte(t,n_forced*{segment})', '-sc_threshold', '0',
+            '-f', 'hls', '-hls_time', str(segment), '-hls_playlist_type', 'vod',
+            '-hls_segment_filename', os.path.join(folder, 'seg_%05d.ts'), os.path.join(folder, 'index.m3u8')
+        ]
+        run_ffmpeg(args)
+        bandwidth = (video_rate + (audio_rate if probe['audio'] else 0)) * 1100
+        variants.append((bandwidth, width, height))
+    with open(os.path.join(target, 'master.m3u8'), 'w') as f:
+        f.write('#EXTM3U\n#EXT-X-VERSION:3\n')
+        for bandwidth, width, height in variants:
+            f.write(f'#EXT-X-STREAM-INF:BANDWIDTH={bandwidth},RESOLUTION={width}x{height}\n{height}p/index.m3u8\n')
+    return [height for _, _, height in variants]
+
+@job_queue.handler('package_video')
+def package_video(payload):
+    """Подготовка видео к отдаче: faststart mp4 и лестница качеств HLS"""
+    video = videos.get(payload['video_id'])
+    if video is None:
+        return {'skipped': 'video deleted'}
+    if shutil.which(app.config['FFMPEG_BINARY']) is None:
+        app.logger.warning("ffmpeg not found, video %s will be served as uploaded mp4", video['id'])
+        return {'skipped': 'ffmpeg not found'}
+    source = os.path.join(app.config['UPLOAD_FOLDER'], video['filename'])
+    probe = probe_video(source)
+
+    # moov в начало файла: воспроизведение начинается без загрузки всего mp4
+    faststart = f"{source}.faststart.tmp"
+    run_ffmpeg(['-y', '-v', 'error', '-i', source, '-map', '0', '-c', 'copy', '-movflags', '+faststart', '-f', 'mp4', faststart])
+    os.replace(faststart, source)
+
+    video_folder = os.path.dirname(source)
+    target = os.path.join(video_folder, f"{video['id']}_hls")
+    tmp_target = f"{target}.tmp"
+    shutil.rmtree(tmp_target, ignore_errors=True)
+    try:
+        renditions = package_hls(source, tmp_target, probe)
+    except Exception:
+        shutil.rmtree(tmp_target, ignore_errors=True)
+        raise
+    shutil.rmtree(target, ignore_errors=True)
+    os.replace(tmp_target, target)
+
+    with state_lock:
+        video = videos.get(payload['video_id'])
+        if video is None:
+            shutil.rmtree(target, ignore_errors=True)
+            return {'skipped': 'video deleted'}
+        video['hls'] = os.path.relpath(os.path.join(target, 'master.m3u8'), app.config['UPLOAD_FOLDER']).replace(os.sep, '/')
+        video['renditions'] = renditions
+        video['width'] = probe['width']
+        video['height'] = probe['height']
+        video['duration'] = iso_duration(probe['duration'])
+        videos.save(video)
+    return {'video_id': video['id'], 'renditions': renditions}
+
+@app.cli.command('package-videos')
+@click.argument('video_ids', nargs=-1)
+def package_videos_command(video_ids):
+    """Нарезка HLS для указанных видео или всех, у которых её ещё нет"""
+    for video_id in video_ids or [video['id'] for video in videos if not video.get('hls')]:
+        try:
+            click.echo(f"{video_id} {package_video({'video_id': video_id})}")
         except Exception as e:
-            return jsonify({'error': f'Ошибка при загрузке: {str(e)}'}), 500
-            
-    return jsonify({'error': 'Неизвестная ошибка'}), 500
+            click.echo(f"Error packaging {video_id}: {e}", err=True)
+
+@app.route('/hls/<path:filename>')
+def hls_file(filename):
+    """Отдача плейлистов и сегментов HLS"""
+    if not HLS_PATH_RE.match(filename):
+        return "Файл не найден", 404
+    path = os.path.abspath(os.path.join(app.config['UPLOAD_FOLDER'], filename))
+    if not os.path.isfile(path):
+        return "Файл не найден", 404
+    if filename.endswith('.m3u8'):
+        mimetype = 'application/vnd.apple.mpegurl'
+    else:
+        mimetype = 'video/mp2t'
+    response = send_file(path, mimetype=mimetype, conditional=True, max_age=app.config['VIDEO_MAX_AGE'])
+    response.cache_control.public = True
+    return response
+
+@app.route('/upload_status')
+def upload_status():
+    """Статус обработки загруженного видео"""
+    job = jobs.get(request.args.get('job', type=str))
+    if job is None or job['payload'].get('user_id') != session.get('user_id'):
+        return jsonify({'error': 'Задача не найдена'}), 404
+    response = {'status': job['status'], 'attempts': job['attempts'], 'error': job['error']}
+    if job['status'] == 'done':
+        response['redirect_url'] = url_for('video', si=job['result']['video_id'])
+    return jsonify(response)
+
+# ======================
+# Загрузка по частям (с возобновлением)
+# ======================
+UPLOAD_CHUNK_READ_SIZE = 1024 * 1024
+UPLOAD_CLEANUP_INTERVAL = 3600 # как часто удалять брошенные загрузки, секунд
+upload_locks = {}
+upload_locks_guard = threading.Lock()
+
+def upload_part_path(upload):
+    video_folder, _ = user_media_folders(upload['user_id'])
+    return os.path.join(video_folder, f"{upload['video_id']}.mp4.part")
+
+@contextlib.contextmanager
+def upload_lock(upload, blocking=True):
+    """Блокировка загрузки между потоками и процессами (flock на файле рядом с .part); без blocking - False, если занята"""
+    with upload_locks_guard:
+        lock = upload_locks.setdefault(upload['id'], threading.Lock())
+    if not lock.acquire(blocking):
+        yield False
+        return
+    try:
+        with process_lock(f"{upload_part_path(upload)}.lock", blocking) as locked:
+            yield locked
+    finally:
+        lock.release()
+
+def load_upload_offset(upload):
+    """Смещение по размеру .part (под upload_lock): запись загрузки в этом процессе может отставать от другого; False - файла уже нет"""
+    try:
+        upload['offset'] = os.path.getsize(upload_part_path(upload))
+    except OSError:
+        return False
+    return True
+
+def discard_upload(upload):
+    """Удаление незавершённой загрузки вместе с частично записанным файлом (под upload_lock)"""
+    if uploads.get(upload['id']) is not None:
+        uploads.delete(upload)
+    part_path = upload_part_path(upload)
+    for path in (part_path, f"{part_path}.lock"):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+    with upload_locks_guard:
+        upload_locks.pop(upload['id'], None)
+
+def cleanup_abandoned_uploads():
+    """Удаление загрузок, в которые давно не приходили части, и файлов .part без загрузки"""
+    deadline = time.time() - app.config['UPLOAD_EXPIRY']
+    removed = 0
+    for upload in [u for u in uploads if u['updated_at'] < deadline]:
+        # Загрузку, в которую сейчас пишут, не трогаем; последняя часть - по времени файла, запись могла отстать
+        with upload_lock(upload, blocking=False) as locked:
+            if not locked:
+                continue
+            part_path = upload_part_path(upload)
+            if not os.path.exists(part_path) or os.path.getmtime(part_path) < deadline:
+                discard_upload(upload)
+                removed += 1
+    known = {upload_part_path(upload) for upload in uploads}
+    upload_folder = app.config['UPLOAD_FOLDER']
+    for user_folder in os.listdir(upload_folder) if os.path.isdir(upload_folder) else []:
+        video_folder = os.path.join(upload_folder, user_folder, 'videos')
+        if not user_folder.startswith('user_') or not os.path.isdir(video_folder):
+            continue
+        for name in os.listdir(video_folder):
+            path = os.path.join(video_folder, name)
+            try:
+                # Запись о загрузке из другого процесса могла ещё не дойти: файл без неё удаляется, только если он старый
+                if name.endswith('.mp4.part') and path not in known and os.path.getmtime(path) < deadline:
+                    os.remove(path)
+                    removed += 1
+                elif name.endswith('.mp4.part.lock') and not os.path.exists(path[:-len('.lock')]):
+                    os.remove(path)
+            except OSError:
+                pass
+    return removed
+
+def upload_cleanup_loop():
+    while True:
+        try:
+            removed = cleanup_abandoned_uploads()
+            if removed:
+                app.logger.info("Removed %s abandoned uploads", removed)
+        except Exception as e:
+            app.logger.exception("Error removing abandoned uploads: %s", e)
+        time.sleep(UPLOAD_CLEANUP_INTERVAL)
+
+def current_upload(upload_id):
+    upload = uploads.get(upload_id)
+    if upload is None or upload['user_id'] != session.get('user_id'):
+        return None
+    return upload
+
+def upload_offset_response(upload, status=200):
+    response = jsonify({'upload_id': upload['id'], 'offset': upload['offset'], 'size': upload['size']})
+    response.status_code = status
+    response.headers['Upload-Offset'] = str(upload['offset'])
+    response.headers['Upload-Length'] = str(upload['size'])
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+@app.route('/uploads', methods=['POST'])
+def create_upload():
+    """Начало загрузки по частям: размер файла и (необязательно) его sha256"""
+    user_id = session.get('user_id')
+    if not user_id or g.current_user is None:
+        return jsonify({'error': 'Требуется авторизация'}), 401
+    size = request.form.get('size', type=int)
+    if size is None or size <= 0 or size > app.config['MAX_CONTENT_LENGTH']:
+        return jsonify({'error': 'Неверный размер файла'}), 400
+    checksum = (request.form.get('checksum') or '').lower() or None
+    if checksum and not re.fullmatch(r'[0-9a-f]{64}', checksum):
+        return jsonify({'error': 'Неверная контрольная сумма'}), 400
+    now = time.time()
+    upload = {
+        'id': generate_video_id(16),
+        'user_id': user_id,
+        'video_id': generate_video_id(),
+        'size': size,
+        'offset': 0,
+        'checksum': checksum,
+        'created_at': now,
+        'updated_at': now
+    }
+    open(upload_part_path(upload), 'wb').close()
+    uploads.append(upload)
+    uploads.save(upload)
+    response = upload_offset_response(upload, 201)
+    response.headers['Location'] = url_for('upload_chunk', upload_id=upload['id'])
+    return response
+
+@app.route('/uploads/<upload_id>', methods=['HEAD', 'GET'])
+def upload_offset(upload_id):
+    """Текущее смещение загрузки, с которого продолжать после обрыва"""
+    upload = current_upload(upload_id)
+    if upload is None:
+        return jsonify({'error': 'Загрузка не найдена'}), 404
+    with upload_lock(upload):
+        if not load_upload_offset(upload):
+            return jsonify({'error': 'Загрузка не найдена'}), 404
+        return upload_offset_response(upload)
+
+@app.route('/uploads/<upload_id>', methods=['PATCH'])
+def upload_chunk(upload_id):
+    """Приём части файла: тело запроса пишется сразу в файл на заданное смещение"""
+    upload = current_upload(upload_id)
+    if upload is None:
+        return jsonify({'error': 'Загрузка не найдена'}), 404
+    offset = request.headers.get('Upload-Offset', type=int)
+    length = request.content_length
+    expected = None
+    checksum_header = request.headers.get('Upload-Checksum')
+    if checksum_header:
+        algorithm, _, digest = checksum_header.partition(' ')
+        if algorithm != 'sha256':
+            return jsonify({'error': 'Поддерживается только sha256'}), 400
+        expected = digest.strip()
+    with upload_lock(upload):
+        # Другой процесс мог дописать часть или удалить загрузку, пока ждали блокировку
+        if not load_upload_offset(upload):
+            return jsonify({'error': 'Загрузка не найдена'}), 404
+        if offset != upload['offset']:
+            return upload_offset_response(upload, 409)
+        if length is None or offset + length > upload['size']:
+            return jsonify({'error': 'Часть выходит за пределы файла'}), 400
+        digest = hashlib.sha256()
+        written = 0
+        with open(upload_part_path(upload), 'r+b') as f:
+            f.seek(offset)
+            while written < length:
+                chunk = request.stream.read(min(UPLOAD_CHUNK_READ_SIZE, length - written))
+                if not chunk:
+                    break
+                digest.update(chunk)
+                f.write(chunk)
+                written += len(chunk)
+            # Оборванную или испорченную часть отбрасываем, клиент повторит её с того же смещения
+            if written != length or (expected and base64.b64encode(digest.digest()).decode() != expected):
+                f.truncate(offset)
+                return upload_offset_response(upload, 460 if written == length else 400)
+        upload['offset'] = offset + written
+        upload['updated_at'] = time.time()
+        uploads.save(upload)
+    return upload_offset_response(upload)
+
+@app.route('/uploads/<upload_id>', methods=['DELETE'])
+def cancel_upload(upload_id):
+    """Отмена загрузки"""
+    upload = current_upload(upload_id)
+    if upload is None:
+        return jsonify({'error': 'Загрузка не найдена'}), 404
+    with upload_lock(upload):
+        discard_upload(upload)
+    return '', 204
+
+@app.route('/uploads/<upload_id>/finish', methods=['POST'])
+def finish_upload(upload_id):
+    """Завершение загрузки: проверка файла, обложка и постановка обработки в очередь"""
+    upload = current_upload(upload_id)
+    if upload is None:
+        return jsonify({'error': 'Загрузка не найдена'}), 404
+    cover_file = request.files.get('cover')
+    if cover_file is None or cover_file.filename == '':
+        return jsonify({'error': 'Не выбрана обложка'}), 400
+    channel = channels.first('user_id', upload['user_id'])
+    if not channel:
+        return jsonify({'error': 'Канал не найден'}), 404
+    with upload_lock(upload):
+        if not load_upload_offset(upload):
+            return jsonify({'error': 'Загрузка не найдена'}), 404
+        if upload['offset'] != upload['size']:
+            return upload_offset_response(upload, 409)
+        part_path = upload_part_path(upload)
+        if upload['checksum']:
+            digest = hashlib.sha256()
+            with open(part_path, 'rb') as f:
+                for chunk in iter(lambda: f.read(UPLOAD_CHUNK_READ_SIZE), b''):
+                    digest.update(chunk)
+            if digest.hexdigest() != upload['checksum']:
+                discard_upload(upload)
+                return jsonify({'error': 'Контрольная сумма файла не совпадает, загрузите его заново'}), 460
+        video_folder, img_folder = user_media_folders(upload['user_id'])
+        cover_file.save(os.path.join(img_folder, f"{upload['video_id']}.upload"))
+        os.replace(part_path, os.path.join(video_folder, f"{upload['video_id']}.mp4"))
+        discard_upload(upload)
+    return queue_video_processing(upload['video_id'], upload['user_id'], channel['id'],
+                                  request.form.get('title', ''), request.form.get('description', ''))
 
 # ======================
 # Лайки/дизлайки
 # ======================
 @app.route('/like_dislike', methods=['POST'])
+@synchronized
 def like_dislike():
     """Обработка лайков/дизлайков видео"""
     video_id = str(request.form['video_id'])
     action = request.form['action']
     user_id = session.get('user_id')
-    if not user_id or not any(user['id'] == user_id for user in users):
+    if not user_id or g.current_user is None:
         return redirect(url_for('register'))
-    video = next((v for v in videos if v['id'] == video_id), None)
+    video = videos.get(video_id)
     if video is None:
         return "Video not found", 404
-    video_likes_dislikes = next((vd for vd in likes_dislikes if vd['video_id'] == video_id), None)
-    if video_likes_dislikes is None:
-        video_likes_dislikes = {'video_id': video_id, 'likes': [], 'dislikes': []}
-        likes_dislikes.append(video_likes_dislikes)
-    if action == 'like':
-        if user_id in video_likes_dislikes['dislikes']:
-            video_likes_dislikes['dislikes'].remove(user_id)
-            video['dislikes'] -= 1
-        if user_id in video_likes_dislikes['likes']:
-            video_likes_dislikes['likes'].remove(user_id)
-            video['likes'] -= 1
-        else:
-            video_likes_dislikes['likes'].append(user_id)
-            video['likes'] += 1
-    elif action == 'dislike':
-        if user_id in video_likes_dislikes['likes']:
-            video_likes_dislikes['likes'].remove(user_id)
-            video['likes'] -= 1
-        if user_id in video_likes_dislikes['dislikes']:
-            video_likes_dislikes['dislikes'].remove(user_id)
-            video['dislikes'] -= 1
-        else:
-            video_likes_dislikes['dislikes'].append(user_id)
-            video['dislikes'] += 1
-    else:
+    if action not in ('like', 'dislike'):
         return "Invalid action", 400
-    save_data(VIDEO_DATA_FILE, videos)
-    save_data(LIKES_DISLIKES_FILE, likes_dislikes)
+    video_likes_dislikes, deltas = video_votes.vote(video, user_id, action)
+    feed.update(video)
+    # Счётчики выводятся из множеств голосов: строку видео не переписываем, только оповещаем
+    videos.notify(video)
+    likes_dislikes.save(video_likes_dislikes, defer=True, deltas=deltas)
     return redirect(url_for('video', si=video_id))
 
 @app.route('/vote', methods=['POST'])
+@synchronized
 def vote():
     """Обработка лайков/дизлайков комментариев"""
     comment_id = int(request.form['comment_id'])
@@ -440,85 +4326,90 @@ def vote():
     user_id = session.get('user_id')
     if not user_id:
         return redirect(url_for('register'))
-    comment = next((c for c in comments if c['id'] == comment_id), None)
+    comment = comments.get(comment_id)
     if comment is None:
         return "Comment not found", 404
-    comment_likes_dislikes = next((cld for cld in comment_likes_dislikes_data if cld['comment_id'] == comment_id), None)
-    if comment_likes_dislikes is None:
-        comment_likes_dislikes = {'comment_id': comment_id, 'likes': [], 'dislikes': []}
-        comment_likes_dislikes_data.append(comment_likes_dislikes)
-    if action == 'like':
-        if user_id in comment_likes_dislikes['dislikes']:
-            comment_likes_dislikes['dislikes'].remove(user_id)
-            comment['dislikes'] = comment.get('dislikes', 0) - 1
-        if user_id in comment_likes_dislikes['likes']:
-            comment_likes_dislikes['likes'].remove(user_id)
-            comment['likes'] = comment.get('likes', 0) - 1
-        else:
-            comment_likes_dislikes['likes'].append(user_id)
-            comment['likes'] = comment.get('likes', 0) + 1
-    elif action == 'dislike':
-        if user_id in comment_likes_dislikes['likes']:
-            comment_likes_dislikes['likes'].remove(user_id)
-            comment['likes'] = comment.get('likes', 0) - 1
-        if user_id in comment_likes_dislikes['dislikes']:
-            comment_likes_dislikes['dislikes'].remove(user_id)
-            comment['dislikes'] = comment.get('dislikes', 0) - 1
-        else:
-            comment_likes_dislikes['dislikes'].append(user_id)
-            comment['dislikes'] = comment.get('dislikes', 0) + 1
-    else:
+    if action not in ('like', 'dislike'):
         return "Invalid action", 400
-    save_data(COMMENTS_DATA_FILE, comments)
-    save_data(COMMENT_LIKES_DISLIKES_FILE, comment_likes_dislikes_data)
+    comment_likes_dislikes, deltas = comment_votes.vote(comment, user_id, action)
+    comments.notify(comment)
+    comment_likes_dislikes_data.save(comment_likes_dislikes, defer=True, deltas=deltas)
     return redirect(url_for('video', si=comment.get('video_id')))
 
 # ======================
 # Подписки
 # ======================
 @app.route('/subscribe', methods=['POST'])
+@synchronized
 def subscribe():
     """Подписка на канал"""
     user_id = session.get('user_id')
     channel_id = str(request.form['channel_id'])
-    if not user_id or not any(user['id'] == user_id for user in users):
+    if not user_id or g.current_user is None:
         return redirect(url_for('register'))
-    channel = next((c for c in channels if c['id'] == channel_id), None)
+    channel = channels.get(channel_id)
     if channel is None:
         return "Channel not found", 404
     if user_id == channel['user_id']:
         return "You cannot subscribe to your own channel", 400
     if user_id not in channel['subscribers']:
-        channel['subscribers'].append(user_id)
-        save_data('channels.json', channels)
+        channel['subscribers'].add(user_id)
+        channels.save(channel, defer=True, deltas={'subscribers': {user_id: True}})
+        subscription_feed.follow(user_id, channel)
     return redirect(request.referrer or url_for('channel', id=channel_id))
 
 @app.route('/unsubscribe', methods=['POST'])
+@synchronized
 def unsubscribe():
     """Отписка от канала"""
     user_id = session.get('user_id')
     channel_id = str(request.form['channel_id'])
-    if not user_id or not any(user['id'] == user_id for user in users):
+    if not user_id or g.current_user is None:
         return redirect(url_for('register'))
-    channel = next((c for c in channels if c['id'] == channel_id), None)
+    channel = channels.get(channel_id)
     if channel is None:
         return "Channel not found", 404
     if user_id == channel['user_id']:
         return "You cannot unsubscribe from your own channel", 400
     if user_id in channel['subscribers']:
         channel['subscribers'].remove(user_id)
-        save_data('channels.json', channels)
+        channels.save(channel, defer=True, deltas={'subscribers': {user_id: False}})
+        subscription_feed.unfollow(user_id, channel)
     else:
         return "You are not subscribed to this channel", 400
     return redirect(request.referrer or url_for('channel', id=channel_id))
 
+@app.route('/feed/subscriptions')
+def subscriptions():
+    """Лента подписок: новые видео каналов, на которые подписан пользователь"""
+    user_id = session.get('user_id')
+    if not user_id or g.current_user is None:
+        return redirect(url_for('login'))
+    page, next_cursor = subscription_feed.page(user_id)
+    return render_template('index.html', videos=with_relative_time(page), next_cursor=next_cursor, user=g.current_user, user_id=user_id,
+                           user_theme=session.get('theme', 'black'), more_url=url_for('load_subscription_videos'),
+                           empty_message="Здесь появятся новые видео каналов, на которые вы подписаны.")
+
+@app.route('/load_subscription_videos')
+def load_subscription_videos():
+    """AJAX подгрузка ленты подписок"""
+    user_id = session.get('user_id')
+    if not user_id or g.current_user is None:
+        return jsonify({'error': 'Требуется авторизация'}), 401
+    try:
+        page, next_cursor = subscription_feed.page(user_id, request.args.get('cursor'))
+    except (ValueError, TypeError):
+        return jsonify({'error': 'Неверный курсор'}), 400
+    base_static_url = url_for('static', filename='')
+    return jsonify({'videos': with_relative_time(page), 'static_url': base_static_url, 'next_cursor': next_cursor, 'all_videos_loaded': next_cursor is None})
+
 # ======================
 # Комментарии
 # ======================
 @app.route('/add_comment', methods=['POST'])
+@synchronized
 def add_comment():
     """Добавление комментария"""
-    global comments
     if 'user_id' not in session:
         return redirect(url_for('register'))
     user_id = session['user_id']
@@ -526,17 +4417,13 @@ def add_comment():
     comment_text = request.form.get('comment')
     if not video_id or not comment_text:
         return "Недостаточно данных для добавления комментария.", 400
-    user = next((u for u in users if u['id'] == user_id), None)
-    channel_id = next((ch for ch in channels if ch['user_id'] == user['id']), None)
+    user = g.current_user
     if user is None:
         return "Пользователь не найден.", 404
-    def generate_comment_id():
-        if comments:
-            return max(comment['id'] for comment in comments) + 1
-        return 1
-    new_comment_id = generate_comment_id()
-    new_comment = {
-        'id': new_comment_id,
+    channel = channels.first('user_id', user_id)
+    channel_id = channel['id'] if channel else None
+    new_comment = Comment({
+        'id': comment_ids.next(),
         'video_id': video_id,
         'user_id': user_id,
         'channel_link_id': channel_id,
@@ -544,13 +4431,13 @@ def add_comment():
         'likes': 0,
         'dislikes': 0,
         'sub_comments': []
-    }
+    })
     comments.append(new_comment)
-    comments.sort(key=lambda c: c['likes'], reverse=True)
-    save_data(COMMENTS_DATA_FILE, comments)
+    comments.save(new_comment)
     return redirect(url_for('video', si=video_id))
 
 @app.route('/add_sub_comment', methods=['POST'])
+@synchronized
 def add_sub_comment():
     """Добавление ответа на комментарий"""
     if 'user_id' not in session:
@@ -558,48 +4445,144 @@ def add_sub_comment():
     user_id = session['user_id']
     parent_id = int(request.form['parent_id'])
     text = request.form['text']
-    user = next((u for u in users if u['id'] == user_id), None)
-    channel_id = next((ch for ch in channels if ch['user_id'] == user['id']), None)
+    user = g.current_user
     if user is None:
         return "Пользователь не найден.", 404
-    def generate_sub_comment_id(parent_comment):
-        if parent_comment['sub_comments']:
-            return max(sc['id'] for sc in parent_comment['sub_comments']) + 1
-        return 1
-    parent_comment = next((c for c in comments if c['id'] == parent_id), None)
+    channel = channels.first('user_id', user_id)
+    channel_id = channel['id'] if channel else None
+    parent_comment = comments.get(parent_id)
     if parent_comment:
-        new_sub_comment_id = generate_sub_comment_id(parent_comment)
         sub_comment = {
-            'id': new_sub_comment_id,
+            'id': reply_ids.next(),
             'user_id': user_id,
             'channel_link_id': channel_id,
             'text': text
         }
         parent_comment['sub_comments'].append(sub_comment)
-        save_data(COMMENTS_DATA_FILE, comments)
+        # Ответ дописывается к строке в базе, а не заменяет её: ответы других процессов остаются
+        comments.save(parent_comment, deltas={'sub_comments': [sub_comment]})
     return redirect(url_for('video', si=parent_comment['video_id']))
 
 # ======================
 # Аутентификация
 # ======================
+class PasswordHasherBusy(Exception):
+    """Очередь хэширования паролей заполнена"""
+
+class PasswordHasher:
+    """Хэширование паролей в ограниченном пуле потоков
+
+    hashlib (scrypt, pbkdf2) отпускает GIL, поэтому хэши считаются параллельно,
+    а потоки запросов в это время отрисовывают страницы. Одновременно считается
+    не больше workers хэшей; если ждущих больше max_pending, запрос сразу
+    получает отказ вместо очереди, в которой застрянут все потоки сервера.
+    """
+
+    def __init__(self, workers, max_pending):
+        self.workers = workers
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.executor = None
+        self.lock = threading.Lock()
+        self.dummy_hash = None
+
+    def run(self, func, *args):
+        if not self.slots.acquire(blocking=False):
+            raise PasswordHasherBusy()
+        try:
+            with self.lock:
+                if self.executor is None:
+                    self.executor = ThreadPoolExecutor(self.workers, thread_name_prefix='password-hash')
+            with PASSWORD_HASH_SECONDS.time(op=func.__name__):
+                return self.executor.submit(func, *args).result()
+        finally:
+            self.slots.release()
+
+    def hash(self, password):
+        return self.run(generate_password_hash, password)
+
+    def verify(self, password_hash, password):
+        """Проверка пароля; для несуществующего пользователя (password_hash None) - за то же время"""
+        if password_hash is None:
+            if self.dummy_hash is None:
+                self.dummy_hash = generate_password_hash(secrets.token_hex(16))
+            self.run(check_password_hash, self.dummy_hash, password)
+            return False
+        return self.run(check_password_hash, password_hash, password)
+
+    def reset_after_fork(self):
+        self.lock = threading.Lock()
+        self.executor = None
+
+class TokenBucket:
+    """Ограничение частоты по ключу: capacity попыток, восполняются за period секунд
+
+    Бакет, к которому не обращались period секунд, снова полон, поэтому
+    хранится в TTLCache и сам исчезает из памяти.
+    """
+
+    def __init__(self, capacity, period, maxsize=100_000):
+        self.capacity = capacity
+        self.rate = capacity / period
+        self.buckets = TTLCache(maxsize, period)
+        self.lock = threading.Lock()
+
+    def _tokens(self, key, now):
+        tokens, last = self.buckets.get(key, (self.capacity, now))
+        return min(self.capacity, tokens + (now - last) * self.rate)
+
+    def consume(self, key):
+        """Списание попытки; 0, если разрешено, иначе через сколько секунд появится попытка"""
+        with self.lock:
+            now = time.monotonic()
+            tokens = self._tokens(key, now)
+            if tokens < 1:
+                self.buckets.set(key, (tokens, now))
+                return (1 - tokens) / self.rate
+            self.buckets.set(key, (tokens - 1, now))
+            return 0
+
+    def wait_time(self, key):
+        """Как consume, но без списания: 0, если попытка есть"""
+        with self.lock:
+            tokens = self._tokens(key, time.monotonic())
+            return 0 if tokens >= 1 else (1 - tokens) / self.rate
+
+password_hasher = PasswordHasher(app.config['PASSWORD_HASH_WORKERS'], app.config['PASSWORD_HASH_QUEUE'])
+login_limiter = TokenBucket(app.config['LOGIN_RATE_LIMIT'], app.config['LOGIN_RATE_PERIOD'])
+
+def too_many_attempts(retry_after, reason):
+    LOGIN_REJECTED.inc(reason=reason)
+    return "Слишком много попыток, попробуйте позже.", 429 if reason == 'rate_limit' else 503, {'Retry-After': str(math.ceil(retry_after))}
+
 @app.route('/login', methods=['GET', 'POST'])
 def login():
     """Авторизация пользователя"""
     if request.method == 'POST':
         email = request.form.get('email')
         password = request.form.get('password')
-        user = next((u for u in users if u['email'] == email), None)
+        # IP платит за каждую попытку, email - только за неверный пароль: перебор к одному email с разных IP
+        # упирается в лимит, а удачные входы владельца его не тратят
+        email_key = ('email', (email or '').strip().lower())
+        retry_after = max(login_limiter.consume(('ip', request.remote_addr)), login_limiter.wait_time(email_key))
+        if retry_after:
+            return too_many_attempts(retry_after, 'rate_limit')
+        user = users.first('email', email)
+        try:
+            valid = password_hasher.verify(user['password'] if user else None, password or '')
+        except PasswordHasherBusy:
+            return too_many_attempts(5, 'hash_queue_full')
         
-        if user and check_password_hash(user['password'], password):
+        if user and valid:
             session['user_id'] = user['id']
             session['avatar'] = user.get('avatar')
             session['theme'] = user.get('theme', 'black')
             
-            channel = next((ch for ch in channels if ch['user_id'] == user['id']), None)
+            channel = channels.first('user_id', user['id'])
             if channel:
                 session['channel_id'] = channel['id']
             
             return redirect(url_for('index'))
+        login_limiter.consume(email_key)
         return "Неверный email или пароль.", 400
     return render_template('login.html')
 
@@ -610,70 +4593,78 @@ def register():
         email = request.form.get('email')
         password = request.form.get('password')
         avatar = request.files.get('avatar')
+        if users.first('email', email):
+            return "Пользователь с таким email уже существует.", 400
+        # Хэш считается до захвата state_lock, чтобы не останавливать остальные запросы
+        try:
+            password_hash = password_hasher.hash(password)
+        except PasswordHasherBusy:
+            return too_many_attempts(5, 'hash_queue_full')
+        with state_lock:
+            return create_account(email, password_hash, avatar)
+    return render_template('register.html')
+
+def create_account(email, password_hash, avatar):
+    """Создание пользователя и его канала (вызывается под state_lock)"""
+    nickname = generate_nickname()
+    channel_id = generate_channel_id()
+    
+    while users.first('nickname', nickname):
         nickname = generate_nickname()
+    while channels.get(channel_id):
         channel_id = generate_channel_id()
         
-        while any(u['nickname'] == nickname for u in users):
-            nickname = generate_nickname()
-        while any(ch['id'] == channel_id for ch in channels):
-            channel_id = generate_channel_id()
-            
-        if any(u['email'] == email for u in users):
-            return "Пользователь с таким email уже существует.", 400
-            
-        user_id = len(users) + 1
-        avatar_filename = f"avatar_{user_id}.jpg"
-        
-        if avatar and avatar.filename:
-            try:
-                upload_folder = app.config['UPLOAD_FOLDER_IMG']
-                if not os.path.exists(upload_folder):
-                    os.makedirs(upload_folder)
-                img = Image.open(avatar)
-                img = img.resize((128, 128))
-                img.save(os.path.join(upload_folder, avatar_filename))
-            except Exception as e:
-                return f"Ошибка при сохранении аватара: {e}", 500
-        else:
-            try:
-                default_avatar_path = os.path.join('static', 'ui', 'user.png')
-                upload_folder = app.config['UPLOAD_FOLDER_IMG']
-                if not os.path.exists(upload_folder):
-                    os.makedirs(upload_folder)
-                
-                destination_path = os.path.join(upload_folder, avatar_filename)
-                
-                if os.path.abspath(default_avatar_path) != os.path.abspath(destination_path):
-                    shutil.copy2(default_avatar_path, destination_path)
-                else:
-                    avatar_filename = "user.png"
-                    
-            except Exception as e:
-                return f"Ошибка при сохранении аватара по умолчанию: {e}", 500
+    # Пока считался хэш, этот email мог занять параллельный запрос
+    if users.first('email', email):
+        return "Пользователь с таким email уже существует.", 400
         
-        new_user = {
-            'id': user_id,
-            'nickname': nickname,
-            'email': email,
-            'password': generate_password_hash(password),
-            'avatar': avatar_filename,
-            'group': "user",
-            'theme': "black"
-        }
-        users.append(new_user)
-        save_data(USER_DATA_FILE, users)
+    user_id = user_ids.next()
+    avatar_filename = f"avatar_{user_id}.jpg"
+    
+    # Пока загруженный аватар обрабатывается в фоне, показывается стандартный
+    try:
+        default_avatar_path = os.path.join('static', 'ui', 'user.png')
+        upload_folder = app.config['UPLOAD_FOLDER_IMG']
+        if not os.path.exists(upload_folder):
+            os.makedirs(upload_folder)
         
-        new_channel = {
-            'id': channel_id,
-            'user_id': new_user['id'],
-            'description': "Без описания",
-            'subscribers': []
-        }
-        channels.append(new_channel)
-        save_data(CHANNEL_DATA_FILE, channels)
+        destination_path = os.path.join(upload_folder, avatar_filename)
         
-        return redirect(url_for('login'))
-    return render_template('register.html')
+        if os.path.abspath(default_avatar_path) != os.path.abspath(destination_path):
+            shutil.copy2(default_avatar_path, destination_path)
+        else:
+            avatar_filename = "user.png"
+            
+    except Exception as e:
+        return f"Ошибка при сохранении аватара по умолчанию: {e}", 500
+    
+    new_user = User({
+        'id': user_id,
+        'nickname': nickname,
+        'email': email,
+        'password': password_hash,
+        'avatar': avatar_filename,
+        'group': "user",
+        'theme': "black"
+    })
+    users.append(new_user)
+    users.save(new_user)
+    if avatar and avatar.filename:
+        try:
+            queue_avatar_processing(user_id, avatar)
+        except Exception as e:
+            app.logger.error("Error saving avatar for user %s: %s", user_id, e)
+    
+    new_channel = Channel({
+        'id': channel_id,
+        'user_id': new_user['id'],
+        'description': "Без описания",
+        'subscribers': set()
+    })
+    channels.append(new_channel)
+    channels.save(new_channel)
+    
+    return redirect(url_for('login'))
 
 @app.route('/logout')
 def logout():
@@ -691,10 +4682,11 @@ def logout():
 def settings():
     """Страница настроек"""
     user_id = session.get('user_id')
-    user = next((u for u in users if u['id'] == user_id), None)
+    user = g.current_user
     return render_template('settings.html', user=user, user_id=user_id)
 
 @app.route('/save-avatar', methods=['POST'])
+@synchronized
 def save_avatar():
     """Сохранение аватара"""
     if 'user_id' not in session:
@@ -705,21 +4697,13 @@ def save_avatar():
     file = request.files['avatar']
     if file.filename == '':
         return "No selected file", 400
-    filename = secure_filename(f"avatar_{user_id}.jpg")
-    upload_folder = app.config['UPLOAD_FOLDER_IMG']
+    if g.current_user is None:
+        return "User not found", 404
     try:
-        img = Image.open(file)
-        img = img.resize((128, 128))
-        img.save(os.path.join(upload_folder, filename))
+        queue_avatar_processing(user_id, file)
     except Exception as e:
         return f"Error saving avatar: {e}", 500
-    user = next((u for u in users if u['id'] == user_id), None)
-    if user:
-        user['avatar'] = filename
-        save_data('user_data.json', users)
-    else:
-        return "User not found", 404
-    user_channel = next((ch for ch in channels if ch['user_id'] == user_id), None)
+    user_channel = channels.first('user_id', user_id)
     if user_channel:
         channel_id = user_channel['id']
         return redirect(url_for('channel', id=channel_id))
@@ -727,6 +4711,7 @@ def save_avatar():
         return "Channel not found", 404
 
 @app.route('/save-nickname', methods=['POST'])
+@synchronized
 def save_nickname():
     """Сохранение никнейма"""
     if 'user_id' not in session:
@@ -735,11 +4720,11 @@ def save_nickname():
     new_nickname = request.form.get('nickname')
     if len(new_nickname) > 50:
         return "Никнейм не может быть длиннее 50 символов", 400
-    user = next((u for u in users if u['id'] == user_id), None)
+    user = g.current_user
     if user:
-        user['nickname'] = new_nickname
-        save_data('user_data.json', users)
-        user_channel = next((ch for ch in channels if ch['user_id'] == user_id), None)
+        users.update(user, 'nickname', new_nickname)
+        users.save(user)
+        user_channel = channels.first('user_id', user_id)
         if user_channel:
             channel_id = user_channel['id']
             return redirect(url_for('channel', id=channel_id))
@@ -749,6 +4734,7 @@ def save_nickname():
         return "User not found", 404
 
 @app.route('/save-description', methods=['POST'])
+@synchronized
 def save_description():
     """Сохранение описания канала"""
     if 'user_id' not in session:
@@ -757,45 +4743,189 @@ def save_description():
     description = request.form.get('description')
     if not description:
         return "Описание не может быть пустым", 400
-    user_channel = next((ch for ch in channels if ch['user_id'] == user_id), None)
+    user_channel = channels.first('user_id', user_id)
     if not user_channel:
         return "Канал не найден", 404
     user_channel['description'] = description
-    save_data(CHANNEL_DATA_FILE, channels)
+    channels.save(user_channel)
     return redirect(url_for('channel', id=user_channel['id']))
 
 @app.route('/update_theme', methods=['POST'])
+@synchronized
 def update_theme():
     """Обновление темы"""
     user_id = session.get('user_id')
     if not user_id:
         return redirect(url_for('register'))
     new_theme = request.form.get('theme')
-    user = next((u for u in users if u['id'] == user_id), None)
+    user = g.current_user
     if user:
         user['theme'] = new_theme
-        save_data(USER_DATA_FILE, users)
+        users.save(user)
         session['theme'] = new_theme
         return redirect(url_for('settings'))
     return 'User not found', 404
 
+# ======================
+# Отдача видео
+# ======================
+VIDEO_PATH_RE = re.compile(r'^user_\d+/videos/[A-Za-z0-9_-]+\.mp4$')
+RANGE_SPEC_RE = re.compile(r'^(\d*)-(\d*)$')
+STREAM_CHUNK_SIZE = 256 * 1024
+
+def parse_byte_ranges(header, size):
+    """Разбор заголовка Range в отсортированные непересекающиеся диапазоны (start, stop)
+
+    В отличие от werkzeug допускает пересекающиеся и неупорядоченные диапазоны,
+    которые присылают некоторые плееры. None - заголовок некорректен.
+    """
+    units, _, specs = header.partition('=')
+    if units.strip() != 'bytes':
+        return None
+    result = []
+    for spec in specs.split(','):
+        match = RANGE_SPEC_RE.match(spec.strip())
+        if not match or not any(match.groups()):
+            return None
+        first, last = match.groups()
+        if not first:
+            start, stop = max(size - int(last), 0), size
+        else:
+            start, stop = int(first), size if not last else min(int(last) + 1, size)
+        if start < stop:
+            result.append((start, stop))
+    result.sort()
+    merged = []
+    for start, stop in result:
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], stop))
+        else:
+            merged.append((start, stop))
+    return merged
+
+def multipart_ranges_response(path, ranges, size, etag, last_modified):
+    """Ответ 206 multipart/byteranges для запроса нескольких диапазонов"""
+    boundary = ''.join(random.choices(string.ascii_letters + string.digits, k=24))
+    headers = [
+        f"--{boundary}\r\nContent-Type: video/mp4\r\nContent-Range: bytes {start}-{stop - 1}/{size}\r\n\r\n".encode()
+        for start, stop in ranges
+    ]
+    closing = f"\r\n--{boundary}--\r\n".encode()
+    length = sum(len(h) for h in headers) + sum(stop - start for start, stop in ranges) + 2 * (len(ranges) - 1) + len(closing)
+
+    def generate():
+        with open(path, 'rb') as f:
+            for i, ((start, stop), header) in enumerate(zip(ranges, headers)):
+                yield (b'\r\n' if i else b'') + header
+                f.seek(start)
+                remaining = stop - start
+                while remaining > 0:
+                    chunk = f.read(min(STREAM_CHUNK_SIZE, remaining))
+                    if not chunk:
+                        return
+                    remaining -= len(chunk)
+                    yield chunk
+        yield closing
+
+    response = Response(generate(), status=206, mimetype=f'multipart/byteranges; boundary={boundary}')
+    response.content_length = length
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.accept_ranges = 'bytes'
+    response.cache_control.public = True
+    response.cache_control.max_age = app.config['VIDEO_MAX_AGE']
+    return response
+
+@app.route('/stream/<path:filename>')
+def stream_video(filename):
+    """Отдача видео с поддержкой Range, условных запросов и передачи файла прокси"""
+    if not VIDEO_PATH_RE.match(filename):
+        return "Видео не найдено.", 404
+    path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return "Видео не найдено.", 404
+
+    # Прокси сам отдаёт файл (sendfile, Range, ETag), воркер только указывает путь
+    offload = app.config['VIDEO_OFFLOAD']
+    if offload == 'x-accel-redirect':
+        response = Response(mimetype='video/mp4')
+        response.headers['X-Accel-Redirect'] = app.config['VIDEO_OFFLOAD_PREFIX'] + filename
+        return response
+    if offload == 'x-sendfile':
+        response = Response(mimetype='video/mp4')
+        response.headers['X-Sendfile'] = os.path.abspath(path)
+        return response
+
+    etag = f"{stat.st_mtime_ns:x}-{stat.st_size:x}"
+    last_modified = datetime.fromtimestamp(int(stat.st_mtime), timezone.utc)
+    range_header = request.headers.get('Range', '')
+    if_range = request.if_range
+    if_range_matches = (if_range.etag == etag if if_range.etag
+                        else if_range.date is None or if_range.date >= last_modified)
+    if ',' in range_header and not request.if_none_match.contains(etag) and if_range_matches:
+        ranges = parse_byte_ranges(range_header, stat.st_size)
+        if ranges == []:
+            return Response(status=416, headers={'Content-Range': f'bytes */{stat.st_size}'})
+        if ranges and len(ranges) > 1:
+            return multipart_ranges_response(path, ranges, stat.st_size, etag, last_modified)
+        if ranges:
+            # Диапазоны слились в один - его отдаёт обычный ответ 206
+            request.environ['HTTP_RANGE'] = f'bytes={ranges[0][0]}-{ranges[0][1] - 1}'
+
+    # Один диапазон, 304 и полный ответ (через wsgi.file_wrapper/sendfile сервера) - средствами werkzeug;
+    # относительный путь send_file считал бы от папки приложения, а не от текущей, как os.stat выше
+    return send_file(os.path.abspath(path), mimetype='video/mp4', conditional=True, etag=etag,
+                     last_modified=stat.st_mtime, max_age=app.config['VIDEO_MAX_AGE'])
+
 # ======================
 # Вспомогательные маршруты
 # ======================
 @app.route('/static/<path:filename>')
 def custom_static(filename):
     """Обработка статических файлов"""
+    if filename.startswith('users/') and VIDEO_PATH_RE.match(filename[len('users/'):]):
+        return stream_video(filename[len('users/'):])
+    if HASHED_IMAGE_RE.search(filename):
+        # Имя меняется вместе с содержимым - можно кэшировать навсегда
+        response = send_from_directory('static', filename, max_age=app.config['IMAGE_MAX_AGE'])
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+        return response
     return send_from_directory('static', filename)
 
+# Встроенный маршрут /static регистрируется раньше и перехватывал бы все запросы
+app.view_functions['static'] = custom_static
+
 @app.route('/robots.txt')
 def robots():
     """robots.txt"""
     return render_template('robots.txt')
     
 @app.route('/sitemap.xml')
-def sitemap():
-    """sitemap.xml"""
-    return render_template('sitemap.xml')
+def sitemap_index():
+    """Индекс sitemap (собирается в фоне)"""
+    path = os.path.abspath(os.path.join(SITEMAP_FOLDER, 'sitemap.xml'))
+    if not os.path.exists(path):
+        return Response("Sitemap is being built", status=503, headers={'Retry-After': '60'}, mimetype='text/plain')
+    return send_file(path, mimetype='application/xml', conditional=True)
+
+@app.route('/sitemaps/<name>')
+def sitemap_shard(name):
+    """Готовая сжатая часть sitemap"""
+    path = os.path.abspath(os.path.join(SITEMAP_FOLDER, name))
+    if not SITEMAP_SHARD_RE.match(name) or not os.path.exists(path):
+        return "Файл не найден", 404
+    return send_file(path, mimetype='application/x-gzip', conditional=True)
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Метрики процесса для Prometheus"""
+    allowed = app.config['METRICS_ALLOWED_IPS']
+    if allowed is not None and request.remote_addr not in allowed:
+        return "Доступ запрещён", 403
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4; charset=utf-8')
 
 @app.route('/ip_not_allowed.html')
 def ip_not_allowed():
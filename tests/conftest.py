@@ -0,0 +1,50 @@
+import importlib
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def app_module(tmp_path, monkeypatch):
+    """Приложение с хранилищем SQLite во временной папке"""
+    monkeypatch.chdir(tmp_path)
+    sys.modules.pop('app', None)
+    module = importlib.import_module('app')
+    # Без фоновых потоков: они пережили бы тест и писали по относительным путям уже в другую папку
+    module.background_started = True
+    yield module
+    sys.modules.pop('app', None)
+
+
+@pytest.fixture
+def catalog(app_module):
+    """Пользователи 1-3, канал ch1 пользователя 1, его видео v1 и комментарий 1 к нему"""
+    m = app_module
+    with m.state_lock:
+        for user_id in (1, 2, 3):
+            user = m.User({'id': user_id, 'nickname': f'user{user_id}', 'email': f'user{user_id}@example.com', 'password': ''})
+            m.users.append(user)
+            m.users.save(user)
+        video = m.Video({'id': 'v1', 'user_id': 1, 'channel_id': 'ch1', 'title': 'v1', 'description': '', 'filename': 'user_1/videos/v1.mp4',
+                         'cover': 'v1.webp', 'likes': 0, 'dislikes': 0, 'views': 0, 'upload_date': '2024-01-01T00:00:00'})
+        m.videos.append(video)
+        m.videos.save(video)
+        channel = m.Channel({'id': 'ch1', 'user_id': 1, 'description': '', 'subscribers': set()})
+        m.channels.append(channel)
+        m.channels.save(channel)
+        comment = m.Comment({'id': 1, 'video_id': 'v1', 'user_id': 1, 'channel_link_id': 'ch1', 'text': 'first',
+                             'likes': 0, 'dislikes': 0, 'sub_comments': []})
+        m.comments.append(comment)
+        m.comments.save(comment)
+    return m
+
+
+def client_for(m, user_id):
+    client = m.app.test_client()
+    with client.session_transaction() as session:
+        session['user_id'] = user_id
+    return client
+
@@ -0,0 +1,117 @@
+import os
+import shutil
+import struct
+import subprocess
+
+import pytest
+
+needs_ffmpeg = pytest.mark.skipif(shutil.which('ffmpeg') is None or shutil.which('ffprobe') is None,
+                                  reason='ffmpeg is not installed')
+
+
+def top_level_boxes(path):
+    """Типы атомов верхнего уровня mp4 по порядку"""
+    boxes = []
+    with open(path, 'rb') as f:
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                return boxes
+            size, kind = struct.unpack('>I4s', header)
+            if size == 1:
+                size = struct.unpack('>Q', f.read(8))[0]
+                f.seek(size - 16, os.SEEK_CUR)
+            elif size == 0:
+                boxes.append(kind.decode())
+                return boxes
+            else:
+                f.seek(size - 8, os.SEEK_CUR)
+            boxes.append(kind.decode())
+
+
+@pytest.fixture
+def clip(catalog):
+    """Тестовое видео 640x360 со звуком вместо файла v1 (moov в конце, как пишет ffmpeg по умолчанию)"""
+    m = catalog
+    m.user_media_folders(1)
+    path = os.path.join(m.app.config['UPLOAD_FOLDER'], 'user_1/videos/v1.mp4')
+    subprocess.run(['ffmpeg', '-y', '-v', 'error', '-f', 'lavfi', '-i', 'testsrc=duration=4:size=640x360:rate=25',
+                    '-f', 'lavfi', '-i', 'sine=duration=4', '-c:v', 'libx264', '-c:a', 'aac', '-shortest', path], check=True)
+    return path
+
+
+@needs_ffmpeg
+def test_package_video_builds_faststart_mp4_and_hls_ladder(catalog, clip):
+    m = catalog
+    boxes = top_level_boxes(clip)
+    assert boxes.index('mdat') < boxes.index('moov')
+
+    assert m.package_video({'video_id': 'v1'})['renditions'] == [240, 360]
+
+    boxes = top_level_boxes(clip)
+    assert boxes.index('moov') < boxes.index('mdat')
+    video = m.videos.get('v1')
+    assert video['hls'] == 'user_1/videos/v1_hls/master.m3u8'
+    assert (video['width'], video['height']) == (640, 360)
+    target = os.path.join(m.app.config['UPLOAD_FOLDER'], 'user_1/videos/v1_hls')
+    with open(os.path.join(target, 'master.m3u8')) as f:
+        master = f.read()
+    assert 'RESOLUTION=426x240\n240p/index.m3u8' in master
+    assert 'RESOLUTION=640x360\n360p/index.m3u8' in master
+    for height in (240, 360):
+        with open(os.path.join(target, f'{height}p', 'index.m3u8')) as f:
+            assert '#EXT-X-ENDLIST' in f.read()
+        assert os.path.isfile(os.path.join(target, f'{height}p', 'seg_00000.ts'))
+
+
+@needs_ffmpeg
+def test_hls_files_are_served(catalog, clip):
+    m = catalog
+    m.package_video({'video_id': 'v1'})
+    client = m.app.test_client()
+    target = os.path.join(m.app.config['UPLOAD_FOLDER'], 'user_1/videos/v1_hls')
+    served = 0
+    for folder, _, files in os.walk(target):
+        for name in files:
+            filename = os.path.relpath(os.path.join(folder, name), m.app.config['UPLOAD_FOLDER']).replace(os.sep, '/')
+            assert m.HLS_PATH_RE.match(filename)
+            response = client.get(f'/hls/{filename}')
+            assert response.status_code == 200
+            assert response.mimetype == ('application/vnd.apple.mpegurl' if name.endswith('.m3u8') else 'video/mp2t')
+            served += 1
+    assert served >= 5
+    assert client.get('/hls/user_1/videos/v1.mp4').status_code == 404
+    assert client.get('/hls/user_1/videos/v1_hls/240p/../../v1.mp4').status_code == 404
+
+
+def test_playlists_and_segments_are_served_only_by_hls_path(catalog):
+    m = catalog
+    target = os.path.join(m.app.config['UPLOAD_FOLDER'], 'user_1/videos/v1_hls')
+    os.makedirs(os.path.join(target, '240p'))
+    for name, content in (('master.m3u8', b'#EXTM3U\n'), ('240p/index.m3u8', b'#EXTM3U\n'), ('240p/seg_00000.ts', b'G' * 188),
+                          ('240p/notes.txt', b'')):
+        with open(os.path.join(target, name), 'wb') as f:
+            f.write(content)
+    client = m.app.test_client()
+    response = client.get('/hls/user_1/videos/v1_hls/master.m3u8')
+    assert response.status_code == 200
+    assert response.mimetype == 'application/vnd.apple.mpegurl'
+    response = client.get('/hls/user_1/videos/v1_hls/240p/seg_00000.ts')
+    assert response.status_code == 200
+    assert response.mimetype == 'video/mp2t'
+    assert response.get_data() == b'G' * 188
+    assert client.get('/hls/user_1/videos/v1_hls/240p/notes.txt').status_code == 404
+    assert client.get('/hls/user_1/videos/v1_hls/240p/seg_00001.ts').status_code == 404
+
+
+def test_watch_page_uses_configured_hls_js(catalog):
+    m = catalog
+    with m.state_lock:
+        video = m.videos.get('v1')
+        video['hls'] = 'user_1/videos/v1_hls/master.m3u8'
+        m.videos.save(video)
+    client = m.app.test_client()
+    assert b'data-hls-js="/static/js/hls.min.js"' in client.get('/watch?si=v1').data
+    m.app.config['HLS_JS_URL'] = 'https://media.example.com/hls.min.js'
+    m.page_cache.clear()
+    assert b'data-hls-js="https://media.example.com/hls.min.js"' in client.get('/watch?si=v1').data
@@ -0,0 +1,112 @@
+import json
+import os
+
+import pytest
+
+
+@pytest.fixture
+def journal(app_module, tmp_path):
+    """Открытие JournalStorage в папке journal заново, как при перезапуске"""
+    return lambda: app_module.JournalStorage(str(tmp_path / 'journal'))
+
+
+def video(video_id, title='video'):
+    return {'id': video_id, 'title': title}
+
+
+def journal_files(m, storage):
+    prefix = f"{os.path.splitext(m.VIDEO_DATA_FILE)[0]}."
+    return sorted(name for name in os.listdir(storage.folder) if name.startswith(prefix) and name.endswith('.journal'))
+
+
+def test_torn_last_record_is_truncated_on_reopen(app_module, journal):
+    m = app_module
+    storage = journal()
+    data = storage.load(m.VIDEO_DATA_FILE)
+    assert storage.upsert_many(m.VIDEO_DATA_FILE, data, [video('a'), video('b')])
+    path = storage.journal_path(m.VIDEO_DATA_FILE, 1)
+    size = os.path.getsize(path)
+    with open(path, 'ab') as f:
+        f.write(storage.encode('P', video('c')).encode()[:-10])
+
+    assert sorted(record['id'] for record in journal().load(m.VIDEO_DATA_FILE)) == ['a', 'b']
+    assert os.path.getsize(path) == size
+
+
+def test_crc_mismatch_before_the_tail_stops_loading(app_module, journal):
+    m = app_module
+    storage = journal()
+    data = storage.load(m.VIDEO_DATA_FILE)
+    assert storage.upsert_many(m.VIDEO_DATA_FILE, data, [video('a'), video('b')])
+    path = storage.journal_path(m.VIDEO_DATA_FILE, 1)
+    with open(path) as f:
+        lines = f.readlines()
+    lines[0] = lines[0].replace('"a"', '"x"')
+    with open(path, 'w') as f:
+        f.writelines(lines)
+
+    with pytest.raises(m.StorageError):
+        journal().load(m.VIDEO_DATA_FILE)
+
+
+def test_corrupted_snapshot_stops_loading(app_module, journal):
+    m = app_module
+    storage = journal()
+    storage.save(m.VIDEO_DATA_FILE, [video('a'), video('b')])
+    path = storage.snapshot_path(m.VIDEO_DATA_FILE)
+    with open(path) as f:
+        content = f.read()
+    with open(path, 'w') as f:
+        f.write(content.replace('"b"', '"c"'))
+
+    with pytest.raises(m.StorageError):
+        journal().load(m.VIDEO_DATA_FILE)
+
+
+def test_compaction_rotates_generation(app_module, journal):
+    m = app_module
+    m.app.config['JOURNAL_COMPACT_BYTES'] = 300
+    storage = journal()
+    data = storage.load(m.VIDEO_DATA_FILE)
+    for i in range(20):
+        record = video(str(i), title=f'title {i}')
+        data.append(record)
+        assert storage.upsert(m.VIDEO_DATA_FILE, data, record)
+    record = data.pop(0)
+    assert storage.delete(m.VIDEO_DATA_FILE, data, record)
+
+    generation = storage.journals[m.VIDEO_DATA_FILE]['generation']
+    assert generation > 1
+    assert journal_files(m, storage) == [os.path.basename(storage.journal_path(m.VIDEO_DATA_FILE, generation))]
+    assert os.path.getsize(storage.journal_path(m.VIDEO_DATA_FILE, generation)) <= 300
+    reopened = journal()
+    assert reopened.load(m.VIDEO_DATA_FILE) == data
+    assert reopened.journals[m.VIDEO_DATA_FILE]['generation'] == generation
+
+
+def test_journal_of_previous_generation_is_removed_after_interrupted_compaction(app_module, journal):
+    m = app_module
+    storage = journal()
+    data = storage.load(m.VIDEO_DATA_FILE)
+    assert storage.upsert_many(m.VIDEO_DATA_FILE, data, [video('a')])
+    # Сбой между заменой снимка и открытием журнала нового поколения
+    storage.write_snapshot(m.VIDEO_DATA_FILE, [video('a')], 2)
+
+    reopened = journal()
+    assert reopened.load(m.VIDEO_DATA_FILE) == [video('a')]
+    assert journal_files(m, reopened) == [os.path.basename(reopened.journal_path(m.VIDEO_DATA_FILE, 2))]
+
+
+def test_legacy_json_is_imported_once(app_module, journal):
+    m = app_module
+    with open(m.VIDEO_DATA_FILE, 'w') as f:
+        json.dump([video('a', 'old a'), video('b', 'old b')], f)
+
+    storage = journal()
+    data = storage.load(m.VIDEO_DATA_FILE)
+    assert data == [video('a', 'old a'), video('b', 'old b')]
+    assert os.path.exists(storage.snapshot_path(m.VIDEO_DATA_FILE))
+    assert storage.upsert(m.VIDEO_DATA_FILE, data, video('a', 'new a'))
+
+    # Дальше читается снимок с журналом, а не JSON файл
+    assert journal().load(m.VIDEO_DATA_FILE) == [video('a', 'new a'), video('b', 'old b')]
@@ -0,0 +1,16 @@
+import logging
+
+
+def test_extra_fields_are_logged_as_key_value(app_module):
+    m = app_module
+    assert isinstance(m.default_handler.formatter, m.ExtraFieldsFormatter)
+    record = m.app.logger.makeRecord(m.app.logger.name, logging.ERROR, __file__, 1, "Error saving %s", ('video_data.json',), None,
+                                     extra={'backend': 'sqlite', 'collection': 'video data.json', 'attempt': 2})
+    assert m.default_handler.formatter.format(record).endswith(
+        'Error saving video_data.json backend="sqlite" collection="video data.json" attempt=2')
+
+
+def test_record_without_extra_keeps_default_format(app_module):
+    m = app_module
+    record = m.app.logger.makeRecord(m.app.logger.name, logging.INFO, __file__, 1, "Imported %s records", (3,), None)
+    assert m.default_handler.formatter.format(record).endswith('INFO in test_logging: Imported 3 records')
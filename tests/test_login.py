@@ -0,0 +1,31 @@
+import pytest
+from werkzeug.security import generate_password_hash
+
+
+@pytest.fixture
+def account(catalog):
+    m = catalog
+    with m.state_lock:
+        user = m.users.get(1)
+        user['password'] = generate_password_hash('secret')
+        m.users.save(user)
+    return m
+
+
+def login(client, password, ip):
+    return client.post('/login', data={'email': 'user1@example.com', 'password': password},
+                       environ_base={'REMOTE_ADDR': ip}).status_code
+
+
+def test_successful_logins_do_not_use_email_attempts(account):
+    client = account.app.test_client()
+    limit = account.app.config['LOGIN_RATE_LIMIT']
+    assert [login(client, 'secret', f'10.0.0.{i}') for i in range(limit + 5)] == [302] * (limit + 5)
+    assert login(client, 'wrong', '10.0.1.1') == 400
+
+
+def test_failed_logins_to_one_email_are_limited_across_ips(account):
+    client = account.app.test_client()
+    limit = account.app.config['LOGIN_RATE_LIMIT']
+    assert [login(client, 'wrong', f'10.0.0.{i}') for i in range(limit)] == [400] * limit
+    assert login(client, 'wrong', '10.0.1.1') == 429
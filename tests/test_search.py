@@ -0,0 +1,69 @@
+import pytest
+
+
+def video(video_id, title, description=''):
+    return {'id': video_id, 'title': title, 'description': description}
+
+
+@pytest.fixture
+def index(app_module):
+    return app_module.SearchIndex
+
+
+@pytest.fixture
+def indexed(catalog):
+    """Каталог с видео v1 в поисковом индексе"""
+    catalog.search_index.add(catalog.videos.get('v1'))
+    return catalog
+
+
+def test_bm25_ranks_title_matches_rare_terms_and_short_documents_higher(index):
+    search_index = index([
+        video('desc', 'обзор', 'гитара'),
+        video('title', 'гитара', 'обзор'),
+        video('long', 'гитара обзор урок звук струны аккорды'),
+        video('rare', 'гитара укулеле'),
+        video('other', 'барабаны'),
+    ])
+    assert search_index.search('гитара ') == ['title', 'rare', 'desc', 'long']
+    # Редкое слово весит больше частого
+    assert search_index.search('гитара укулеле ')[0] == 'rare'
+    assert search_index.search('скрипка ') == []
+
+
+def test_yo_is_folded_to_ye(index):
+    search_index = index([video('tree', 'Ёлка'), video('hedgehog', 'ежик')])
+    assert search_index.search('елка ') == ['tree']
+    assert search_index.search('ЁЖИК ') == ['hedgehog']
+
+
+def test_word_forms_match_by_stem(index):
+    search_index = index([video('cats', 'Играем с кошками'), video('games', 'Played games')])
+    assert search_index.search('кошка ') == ['cats']
+    assert search_index.search('кошек ') == []
+    assert search_index.search('playing ') == ['games']
+
+
+def test_last_word_is_expanded_as_prefix_while_typing(index):
+    search_index = index([video('code', 'Программирование на Python'), video('progress', 'Прогресс'),
+                          video('other', 'Прогулка')])
+    assert sorted(search_index.search('прогр')) == ['code', 'progress']
+    assert search_index.search('прогр ') == []
+    assert search_index.search('python прогр') == ['code', 'progress']
+
+
+def test_search_skips_videos_missing_from_the_collection(indexed):
+    m = indexed
+    m.search_index.add(video('ghost', 'v1'))
+    client = m.app.test_client()
+    assert client.get('/search?q=v1').status_code == 200
+    response = client.get('/search_videos?query=v1')
+    assert [found['id'] for found in response.get_json()['videos']] == ['v1']
+
+
+def test_search_videos_offset_is_validated(indexed):
+    client = indexed.app.test_client()
+    for offset in ('abc', '-5'):
+        response = client.get(f'/search_videos?query=v1&offset={offset}')
+        assert response.status_code == 200
+        assert [found['id'] for found in response.get_json()['videos']] == ['v1']
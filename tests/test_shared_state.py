@@ -0,0 +1,81 @@
+import multiprocessing
+import os
+import sys
+
+from conftest import client_for
+
+
+def run_workers(m, target, *args):
+    """Запуск target(m, barrier, arg) в отдельном процессе на каждый arg и ожидание всех"""
+    context = multiprocessing.get_context('fork')
+    barrier = context.Barrier(len(args))
+    workers = [context.Process(target=target, args=(m, barrier, arg)) for arg in args]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join(60)
+        assert worker.exitcode == 0
+    m.change_sync.sync()
+
+
+def like_and_subscribe(m, barrier, user_id):
+    """Лайк видео v1 и подписка на канал ch1, сброс одновременно с другим процессом"""
+    client = client_for(m, user_id)
+    assert client.post('/like_dislike', data={'video_id': 'v1', 'action': 'like'}).status_code == 302
+    assert client.post('/subscribe', data={'channel_id': 'ch1'}).status_code == 302
+    barrier.wait()
+    m.write_behind.flush()
+    os._exit(0)
+
+
+def test_concurrent_votes_and_subscriptions_are_merged(catalog):
+    m = catalog
+    run_workers(m, like_and_subscribe, 2, 3)
+    assert m.likes_dislikes.get('v1')['likes'] == {2, 3}
+    assert m.videos.get('v1')['likes'] == 2
+    assert m.channels.get('ch1')['subscribers'] == {2, 3}
+
+
+def reply(m, barrier, user_id):
+    client = client_for(m, user_id)
+    barrier.wait()
+    assert client.post('/add_sub_comment', data={'parent_id': 1, 'text': f'reply from {user_id}'}).status_code == 302
+    os._exit(0)
+
+
+def test_concurrent_replies_are_kept(catalog):
+    m = catalog
+    run_workers(m, reply, 2, 3)
+    replies = m.comments.get(1)['sub_comments']
+    assert sorted(reply['user_id'] for reply in replies) == [2, 3]
+    assert [reply['id'] for reply in replies] == sorted(reply['id'] for reply in replies)
+
+
+def vote_or_package(m, barrier, role):
+    """Лайк, который сбрасывается после того, как другой процесс сохранил результат package_video"""
+    if role == 'vote':
+        client = client_for(m, 2)
+        assert client.post('/like_dislike', data={'video_id': 'v1', 'action': 'like'}).status_code == 302
+        barrier.wait()
+        barrier.wait()
+        m.write_behind.flush()
+    else:
+        m.app.config['FFMPEG_BINARY'] = sys.executable
+        m.probe_video = lambda path: {'width': 320, 'height': 240, 'duration': 5.0, 'audio': False}
+        m.run_ffmpeg = lambda args, binary='FFMPEG_BINARY': open(args[-1], 'wb').close()
+        m.package_hls = lambda source, target, probe: os.makedirs(target) or [240]
+        m.user_media_folders(1)
+        barrier.wait()
+        assert m.package_video({'video_id': 'v1'})['renditions'] == [240]
+        barrier.wait()
+    os._exit(0)
+
+
+def test_vote_does_not_overwrite_packaged_video(catalog):
+    m = catalog
+    run_workers(m, vote_or_package, 'vote', 'package')
+    video = m.videos.get('v1')
+    assert video['hls'] == 'user_1/videos/v1_hls/master.m3u8'
+    assert video['renditions'] == [240]
+    assert video['likes'] == 1
+    assert '"renditions": [240]' in m.storage.fetch(m.VIDEO_DATA_FILE, 'v1')
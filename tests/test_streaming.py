@@ -0,0 +1,101 @@
+import os
+import re
+
+import pytest
+
+SIZE = 10000
+DATA = bytes(i % 251 for i in range(SIZE))
+
+
+@pytest.fixture
+def clip(app_module):
+    """Файл видео на SIZE байт и клиент, который его запрашивает"""
+    m = app_module
+    folder = os.path.join(m.app.config['UPLOAD_FOLDER'], 'user_1', 'videos')
+    os.makedirs(folder)
+    with open(os.path.join(folder, 'v1.mp4'), 'wb') as f:
+        f.write(DATA)
+    return m.app.test_client()
+
+
+def get(client, **headers):
+    return client.get('/stream/user_1/videos/v1.mp4', headers=headers)
+
+
+def parts(response):
+    """(Content-Range, тело) частей ответа multipart/byteranges"""
+    boundary = response.mimetype_params['boundary'].encode()
+    body = response.get_data()
+    assert body.endswith(b'\r\n--' + boundary + b'--\r\n')
+    result = []
+    for chunk in body.split(b'--' + boundary)[1:-1]:
+        head, _, content = chunk.partition(b'\r\n\r\n')
+        content_range = re.search(rb'Content-Range: (.+)', head).group(1).decode().strip()
+        result.append((content_range, content[:-2] if content.endswith(b'\r\n') else content))
+    return result
+
+
+def test_parse_suffix_and_open_ranges(app_module):
+    parse = app_module.parse_byte_ranges
+    assert parse('bytes=-500', SIZE) == [(SIZE - 500, SIZE)]
+    assert parse('bytes=-20000', SIZE) == [(0, SIZE)]
+    assert parse('bytes=9000-', SIZE) == [(9000, SIZE)]
+    assert parse('bytes=9000-20000', SIZE) == [(9000, SIZE)]
+
+
+def test_parse_merges_overlapping_and_unordered_ranges(app_module):
+    parse = app_module.parse_byte_ranges
+    assert parse('bytes=500-999, 0-99, 50-149', SIZE) == [(0, 150), (500, 1000)]
+    assert parse('bytes=100-199,200-299', SIZE) == [(100, 300)]
+    assert parse('bytes=-100, 0-9', SIZE) == [(0, 10), (SIZE - 100, SIZE)]
+
+
+def test_parse_rejects_invalid_and_drops_unsatisfiable_ranges(app_module):
+    parse = app_module.parse_byte_ranges
+    assert parse('items=0-10', SIZE) is None
+    assert parse('bytes=a-b', SIZE) is None
+    assert parse('bytes=-', SIZE) is None
+    assert parse('bytes=20000-, 0-9', SIZE) == [(0, 10)]
+    assert parse('bytes=20000-, 30000-', SIZE) == []
+
+
+def test_suffix_range_response(clip):
+    response = get(clip, Range='bytes=-500')
+    assert response.status_code == 206
+    assert response.headers['Content-Range'] == f'bytes {SIZE - 500}-{SIZE - 1}/{SIZE}'
+    assert response.get_data() == DATA[-500:]
+
+
+def test_overlapping_ranges_are_served_as_one(clip):
+    response = get(clip, Range='bytes=200-299, 0-99, 50-249')
+    assert response.status_code == 206
+    assert response.headers['Content-Range'] == f'bytes 0-299/{SIZE}'
+    assert response.get_data() == DATA[:300]
+
+
+def test_multipart_response_length_matches_body(clip):
+    response = get(clip, Range='bytes=9000-, 0-99, -10')
+    assert response.status_code == 206
+    assert response.mimetype == 'multipart/byteranges'
+    assert response.content_length == len(response.get_data())
+    assert parts(response) == [(f'bytes 0-99/{SIZE}', DATA[:100]), (f'bytes 9000-9999/{SIZE}', DATA[9000:])]
+
+
+@pytest.mark.parametrize('header', ['bytes=20000-', 'bytes=20000-, 30000-'])
+def test_unsatisfiable_ranges_get_416(clip, header):
+    response = get(clip, Range=header)
+    assert response.status_code == 416
+    assert response.headers['Content-Range'] == f'bytes */{SIZE}'
+
+
+@pytest.mark.parametrize('header', ['bytes=0-99', 'bytes=0-99, 200-299'])
+def test_if_range_with_current_etag_returns_ranges(clip, header):
+    etag = get(clip).headers['ETag']
+    assert get(clip, Range=header, **{'If-Range': etag}).status_code == 206
+
+
+@pytest.mark.parametrize('header', ['bytes=0-99', 'bytes=0-99, 200-299'])
+def test_if_range_with_stale_etag_returns_whole_file(clip, header):
+    response = get(clip, Range=header, **{'If-Range': '"stale"'})
+    assert response.status_code == 200
+    assert response.get_data() == DATA
@@ -0,0 +1,139 @@
+import base64
+import hashlib
+import io
+import multiprocessing
+import os
+import time
+
+from PIL import Image
+
+from conftest import client_for
+
+DATA = bytes(range(256)) * 40
+
+
+def create_upload(client, size=len(DATA), checksum=None):
+    form = {'size': size}
+    if checksum:
+        form['checksum'] = checksum
+    response = client.post('/uploads', data=form)
+    assert response.status_code == 201
+    return response.get_json()['upload_id']
+
+
+def send(client, upload_id, offset, chunk, checksum=None):
+    headers = {'Upload-Offset': str(offset)}
+    if checksum is not None:
+        headers['Upload-Checksum'] = f'sha256 {checksum}'
+    return client.patch(f'/uploads/{upload_id}', data=chunk, headers=headers)
+
+
+def sha256_b64(data):
+    return base64.b64encode(hashlib.sha256(data).digest()).decode()
+
+
+def finish(client, upload_id):
+    cover = io.BytesIO()
+    Image.new('RGB', (16, 9)).save(cover, 'PNG')
+    cover.seek(0)
+    return client.post(f'/uploads/{upload_id}/finish', data={'title': 't', 'cover': (cover, 'cover.png')})
+
+
+def part_path(m, upload_id):
+    return m.upload_part_path(m.uploads.get(upload_id))
+
+
+def test_chunk_at_wrong_offset_is_rejected_with_current_offset(catalog):
+    client = client_for(catalog, 1)
+    upload_id = create_upload(client)
+    assert send(client, upload_id, 0, DATA[:1000]).status_code == 200
+    response = send(client, upload_id, 500, DATA[500:1500])
+    assert response.status_code == 409
+    assert response.headers['Upload-Offset'] == '1000'
+    assert send(client, upload_id, 0, DATA[:1000]).status_code == 409
+
+
+def test_chunk_with_bad_checksum_is_discarded(catalog):
+    m = catalog
+    client = client_for(m, 1)
+    upload_id = create_upload(client)
+    assert send(client, upload_id, 0, DATA[:1000], sha256_b64(DATA[:1000])).status_code == 200
+    response = send(client, upload_id, 1000, DATA[1000:2000], sha256_b64(b'something else'))
+    assert response.status_code == 460
+    assert response.headers['Upload-Offset'] == '1000'
+    assert os.path.getsize(part_path(m, upload_id)) == 1000
+
+
+def test_upload_is_resumed_from_offset_reported_by_head(catalog):
+    m = catalog
+    client = client_for(m, 1)
+    upload_id = create_upload(client, checksum=hashlib.sha256(DATA).hexdigest())
+    assert send(client, upload_id, 0, DATA[:4000]).status_code == 200
+    # Обрыв: вторая часть дошла не целиком
+    assert send(client, upload_id, 4000, DATA[4000:6000], sha256_b64(DATA[4000:7000])).status_code == 460
+    response = client.head(f'/uploads/{upload_id}')
+    assert response.status_code == 200
+    offset = int(response.headers['Upload-Offset'])
+    assert offset == 4000
+    assert send(client, upload_id, offset, DATA[offset:]).status_code == 200
+    assert finish(client, upload_id).get_json()['success']
+    with open(os.path.join(m.app.config['UPLOAD_FOLDER'], 'user_1', 'videos', f"{m.jobs[-1]['payload']['video_id']}.mp4"), 'rb') as f:
+        assert f.read() == DATA
+    assert m.uploads.get(upload_id) is None
+
+
+def test_file_with_wrong_checksum_is_not_published(catalog):
+    m = catalog
+    client = client_for(m, 1)
+    upload_id = create_upload(client, checksum=hashlib.sha256(b'other file').hexdigest())
+    assert send(client, upload_id, 0, DATA).status_code == 200
+    assert finish(client, upload_id).status_code == 460
+    assert m.uploads.get(upload_id) is None
+    assert client.head(f'/uploads/{upload_id}').status_code == 404
+
+
+def send_first_chunk(m, barrier, upload_id, fill, results):
+    client = client_for(m, 1)
+    barrier.wait()
+    results.put((fill, send(client, upload_id, 0, bytes([fill]) * 3000).status_code))
+    results.close()
+    results.join_thread()
+    os._exit(0)
+
+
+def test_concurrent_chunks_from_two_processes_write_only_one(catalog):
+    m = catalog
+    upload_id = create_upload(client_for(m, 1))
+    context = multiprocessing.get_context('fork')
+    barrier = context.Barrier(2)
+    results = context.Queue()
+    workers = [context.Process(target=send_first_chunk, args=(m, barrier, upload_id, fill, results)) for fill in (1, 2)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join(60)
+        assert worker.exitcode == 0
+    statuses = dict(results.get(timeout=5) for _ in workers)
+    assert sorted(statuses.values()) == [200, 409]
+    winner = next(fill for fill, status in statuses.items() if status == 200)
+    with open(part_path(m, upload_id), 'rb') as f:
+        assert f.read() == bytes([winner]) * 3000
+
+
+def test_cleanup_removes_abandoned_uploads_and_orphan_parts(catalog):
+    m = catalog
+    client = client_for(m, 1)
+    abandoned = create_upload(client)
+    active = create_upload(client)
+    abandoned_path = part_path(m, abandoned)
+    orphan_path = os.path.join(os.path.dirname(abandoned_path), 'orphan.mp4.part')
+    open(orphan_path, 'wb').close()
+    old = time.time() - m.app.config['UPLOAD_EXPIRY'] - 60
+    m.uploads.get(abandoned)['updated_at'] = old
+    for path in (abandoned_path, orphan_path):
+        os.utime(path, (old, old))
+    assert m.cleanup_abandoned_uploads() == 2
+    assert m.uploads.get(abandoned) is None
+    assert not os.path.exists(abandoned_path)
+    assert not os.path.exists(orphan_path)
+    assert os.path.exists(part_path(m, active))